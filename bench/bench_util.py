@@ -0,0 +1,67 @@
+""" Fixtures of recorded 'less' output shared by record.py and run.py.
+
+    A fixture is a JSON file:
+        {"version": 1, "name": ..., "cols": 80, "rows": 24,
+         "steps": [{"task": "fwd", "arg": null, "chunks": [<base64>, ...]}, ...]}
+    where chunks are the data PlugLess has received by channel.recv()
+    while serving the request.
+"""
+import base64
+import glob
+import json
+import os
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(BENCH_DIR, 'fixtures')
+FIXTURE_VERSION = 1
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from plugs import PlugLess
+
+TASKS = dict((task[0], task) for task in PlugLess.TASKS)
+
+
+class BenchLess(PlugLess):
+    """ PlugLess which leaves data in the channel before a command is sent.
+        flush() drops data which would otherwise be recorded and replayed,
+        so the recorded stream would depend on timing of the session.
+    """
+    def flush(self):
+        pass
+
+
+def save_fixture(path, fixture):
+    data = dict(fixture, version=FIXTURE_VERSION)
+    data['steps'] = [dict(step, chunks=[base64.b64encode(c) for c in step['chunks']])
+                     for step in fixture['steps']]
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+
+
+def load_fixture(path):
+    with open(path) as f:
+        data = json.load(f)
+    if data.get('version') != FIXTURE_VERSION:
+        raise ValueError("'%s' has unsupported version %s"%(path, data.get('version')))
+    data['steps'] = [dict(step, chunks=[base64.b64decode(c) for c in step['chunks']])
+                     for step in data['steps']]
+    return data
+
+
+def fixture_paths(names=None):
+    """ @return paths of fixtures with given names, all fixtures if names is empty """
+    if names:
+        return [os.path.join(FIXTURES_DIR, name+'.json') for name in names]
+    return sorted(glob.glob(os.path.join(FIXTURES_DIR, '*.json')))
+
+
+def commit():
+    """ @return short hash of the commit benchmarks are run on, None out of git """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCH_DIR,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
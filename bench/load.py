@@ -0,0 +1,300 @@
+""" Load test of the web client server against a local stand-in SSH server.
+
+        python bench/load.py [--clients 1,8,32] [--duration 20] [--size 2048] [--out result.json]
+
+    Three processes run on this box: the stand-in SSH server (ssh_stand_in.py)
+    with real 'less' over a synthetic log, the event loop server of
+    web_client.py and this driver. For every number of clients the driver
+    starts that many viewers, each one connects, opens the log and moves
+    through it by the JSON protocol for --duration seconds.
+
+    For every number of clients it reports latency percentiles per command,
+    requests and pages per second, CPU used by the server and its RSS.
+    Answers with errors, requests left unanswered for REPLY_TIMEOUT and
+    other failures of viewers are reported apart.
+    The log is kept in the temp directory and reused by the next runs.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import warnings
+
+import bench_util
+import ssh_stand_in
+from event_loop import EventLoop, EXECUTOR_WORKERS
+from web_client import WebClient
+
+RESULT_VERSION = 1
+CLIENT_COUNTS = '1,8,32'
+DURATION = 20           # seconds every number of clients is run for
+LOG_SIZE = 2048         # MB
+REPLY_TIMEOUT = 60      # seconds to wait for an answer
+USERS = 4               # distinct ssh users, every one gets its own pooled connection
+SAMPLE_PERIOD = 0.5     # seconds between samples of server RSS
+PERCENTILES = (50, 90, 99)
+MAX_POSITION = 90       # log_pos stays off the end: less 590 END prompt is not matched yet
+
+# moves of a viewer: (weight, command, arguments)
+MOVES = [(50, 'log_next', lambda rnd: {}),
+         (20, 'log_prev', lambda rnd: {}),
+         (15, 'log_pos', lambda rnd: {'position': rnd.randint(0, MAX_POSITION)}),
+         (10, 'log_pages', lambda rnd: {'count': rnd.randint(2, 5)}),
+         (5, 'log_page', lambda rnd: {})]
+
+
+def make_log(path, size):
+    """ Writes a log of size bytes by repeating a block of generated lines """
+    lines = []
+    for i in range(20000):
+        lines.append('2016-03-%02d %02d:%02d:%02d.%03d [%s] worker-%d: request %08x took %d ms\n'
+                     %(1+i//86400, i//3600%24, i//60%60, i%60, i*7%1000,
+                       ('INFO', 'DEBUG', 'WARN')[i%3], i%8, i*2654435761%(1<<32), i*37%500))
+        if i%50 == 7:
+            lines.append('Traceback: ' + ' -> '.join('module_%d.func_%d()'%(n, i%13)
+                                                     for n in range(20)) + '\n')
+    block = ''.join(lines)
+    with open(path+'.tmp', 'w') as f:
+        left = size
+        while left > 0:
+            f.write(block[:left])
+            left = left - len(block)
+    os.rename(path+'.tmp', path)
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    values = sorted(values)
+    res = dict(('p%d'%p, values[min(len(values)-1, len(values)*p//100)]*1000)
+               for p in PERCENTILES)
+    res['max'] = values[-1]*1000
+    res['count'] = len(values)
+    return res
+
+
+class ServerProcess(object):
+    """ Resources used by a child process, read from /proc """
+    TICK = float(os.sysconf('SC_CLK_TCK'))
+
+    def __init__(self, target, args):
+        self.proc = multiprocessing.Process(target=target, args=args)
+        self.proc.daemon = True
+        self.proc.start()
+
+    def cpu(self):
+        """ @return seconds of CPU used by the process """
+        with open('/proc/%d/stat'%self.proc.pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12]))/self.TICK
+
+    def rss(self):
+        """ @return resident set size in bytes """
+        with open('/proc/%d/status'%self.proc.pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+        return 0
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.join()
+
+
+def _serve_web(sock, workers):
+    # host key of the stand-in is new every run
+    warnings.simplefilter('ignore', UserWarning)
+    loop = EventLoop(sock, WebClient, workers=workers)
+    loop.run()
+
+
+class Viewer(threading.Thread):
+    """ Simulated client: opens the log and moves through it until the deadline """
+    def __init__(self, addr, ssh_addr, user, path, cols, rows, deadline, think, seed):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.addr = addr
+        self.ssh_addr = ssh_addr
+        self.user = user
+        self.path = path
+        self.cols = cols
+        self.rows = rows
+        self.deadline = deadline
+        self.think = think
+        self.rnd = random.Random(seed)
+        self.latencies = {}     # key: command; value: list of seconds
+        self.errors = []       # answers which are not 'ok'
+        self.pages = 0
+        self.failure = None
+        self.timeout = None     # command the server has not answered in REPLY_TIMEOUT
+        self.cmd = None         # command sent last
+        self._buff = ''
+
+    def request(self, req):
+        """ @return answer to the request, latency is recorded """
+        self.cmd = req['cmd']
+        start = time.time()
+        self.sock.sendall(json.dumps(req)+'\r\n')
+        while True:
+            answer = json.loads(self._read_line())
+            if answer.get('cmd') == req['cmd']:
+                break
+        self.latencies.setdefault(req['cmd'], []).append(time.time()-start)
+        if answer.get('res') != 'ok':
+            self.errors.append('%s: %s'%(req['cmd'], answer.get('data', answer.get('res'))))
+        data = answer.get('data')
+        if data is not None:
+            self.pages = self.pages + (len(data) if isinstance(data, list) else 1)
+        return answer
+
+    def _read_line(self):
+        while '\r\n' not in self._buff:
+            data = self.sock.recv(64*1024)
+            if not data:
+                raise IOError('server has closed the connection')
+            self._buff = self._buff + data
+        line, self._buff = self._buff.split('\r\n', 1)
+        return line
+
+    def run(self):
+        try:
+            self.sock = socket.create_connection(self.addr)
+            self.sock.settimeout(REPLY_TIMEOUT)
+            try:
+                self._view()
+            finally:
+                self.sock.close()
+        except socket.timeout:
+            self.timeout = self.cmd
+        except Exception as e:
+            self.failure = '%s: %s'%(self.cmd, str(e))
+
+    def _view(self):
+        res = self.request({'cmd': 'connect', 'host': self.ssh_addr[0], 'port': self.ssh_addr[1],
+                            'user': self.user, 'secret': 'bench'})
+        if res.get('res') != 'ok':
+            raise IOError('unable to connect: %s'%res)
+        conn_id = res['conn_id']
+        res = self.request({'cmd': 'log_open', 'conn_id': conn_id, 'path': self.path,
+                            'cols': self.cols, 'rows': self.rows})
+        if res.get('res') != 'ok':
+            raise IOError('unable to open log: %s'%res)
+        log_id = res['log_id']
+        total = sum(move[0] for move in MOVES)
+        while time.time() < self.deadline:
+            pick = self.rnd.uniform(0, total)
+            for weight, cmd, args in MOVES:
+                pick = pick - weight
+                if pick <= 0:
+                    break
+            self.request(dict(args(self.rnd), cmd=cmd, log_id=log_id))
+            if self.think:
+                time.sleep(self.rnd.uniform(0, 2*self.think))
+        self.request({'cmd': 'log_close', 'log_id': log_id})
+        # 'close' is not answered
+        self.sock.sendall(json.dumps({'cmd': 'close', 'conn_id': conn_id})+'\r\n')
+
+
+def run_step(server, args, addr, ssh_addr, path, clients):
+    """ Runs the number of viewers against the server
+        @return results of the step
+    """
+    idle_rss = server.rss()
+    cpu = server.cpu()
+    start = time.time()
+    viewers = [Viewer(addr, ssh_addr, 'viewer%d'%(n%args.users), path, args.cols, args.rows,
+                      start+args.duration, args.think, n) for n in range(clients)]
+    for viewer in viewers:
+        viewer.start()
+    peak_rss = idle_rss
+    while any(viewer.is_alive() for viewer in viewers):
+        time.sleep(SAMPLE_PERIOD)
+        peak_rss = max(peak_rss, server.rss())
+    wall = time.time() - start
+    cpu = server.cpu() - cpu
+
+    latencies = {}
+    for viewer in viewers:
+        for cmd, values in viewer.latencies.items():
+            latencies.setdefault(cmd, []).extend(values)
+    moves = sum([values for cmd, values in latencies.items()
+                 if cmd in [move[1] for move in MOVES]], [])
+    pages = sum(viewer.pages for viewer in viewers)
+    return {'clients': clients, 'seconds': wall,
+            'requests': len(moves), 'requests_s': len(moves)/wall, 'pages_s': pages/wall,
+            'errors': sum([viewer.errors for viewer in viewers], []),
+            'failures': [viewer.failure for viewer in viewers if viewer.failure],
+            'timeouts': [viewer.timeout for viewer in viewers if viewer.timeout],
+            'latency_ms': _percentiles(moves),
+            'commands': dict((cmd, _percentiles(values)) for cmd, values in latencies.items()),
+            'cpu_percent': cpu/wall*100,
+            'cpu_ms_per_request': cpu/len(moves)*1000 if moves else None,
+            'rss_mb': peak_rss/1024.0/1024,
+            'rss_per_client_kb': (peak_rss-idle_rss)/1024.0/clients}
+
+
+def _listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    return sock
+
+
+def main():
+    parser = argparse.ArgumentParser(description='load test of the web client server')
+    parser.add_argument('--clients', default=CLIENT_COUNTS,
+                        help='comma separated numbers of concurrent clients')
+    parser.add_argument('--duration', type=float, default=DURATION,
+                        help='seconds every number of clients is run for')
+    parser.add_argument('--think', type=float, default=0,
+                        help='mean pause of a client between requests, seconds')
+    parser.add_argument('--size', type=int, default=LOG_SIZE, help='log size, MB')
+    parser.add_argument('--log', help='log to show, generated in the temp directory by default')
+    parser.add_argument('--cols', type=int, default=80)
+    parser.add_argument('--rows', type=int, default=24)
+    parser.add_argument('--users', type=int, default=USERS)
+    parser.add_argument('--workers', type=int, default=EXECUTOR_WORKERS)
+    parser.add_argument('--out', help='file to write the result to, stdout by default')
+    args = parser.parse_args()
+
+    path = args.log
+    if path is None:
+        size = args.size*1024*1024
+        path = os.path.join(tempfile.gettempdir(), 'rt-pager-load-%dM.log'%args.size)
+        if not os.path.exists(path) or os.path.getsize(path) != size:
+            sys.stderr.write('generating %s\n'%path)
+            make_log(path, size)
+
+    ssh_sock = _listen()
+    web_sock = _listen()
+    ssh_server = ServerProcess(ssh_stand_in.serve, (ssh_sock,))
+    server = ServerProcess(_serve_web, (web_sock, args.workers))
+    result = {'version': RESULT_VERSION, 'commit': bench_util.commit(),
+              'python': platform.python_version(), 'log_size': os.path.getsize(path),
+              'duration': args.duration, 'think': args.think, 'steps': []}
+    try:
+        for clients in [int(n) for n in args.clients.split(',')]:
+            sys.stderr.write('running %d clients\n'%clients)
+            result['steps'].append(run_step(server, args, web_sock.getsockname(),
+                                            ssh_sock.getsockname(), path, clients))
+    finally:
+        server.stop()
+        ssh_server.stop()
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text+'\n')
+    else:
+        sys.stdout.write(text+'\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+""" Records output of 'less' served by PlugLess into a benchmark fixture.
+
+    By default 'less' runs by local shell in a pseudo terminal and shows a
+    generated log, so fixtures can be recorded without a remote host:
+
+        python bench/record.py --cols 80 --rows 24
+        python bench/record.py --host example.org --user me --path /var/log/syslog
+
+    The fixture goes to bench/fixtures/<name>.json, name defaults to
+    less_<cols>x<rows>.
+"""
+import argparse
+import fcntl
+import os
+import pty
+import select
+import signal
+import struct
+import sys
+import tempfile
+import termios
+
+from bench_util import BenchLess, TASKS, FIXTURES_DIR, save_fixture
+from plugs import PlugLessException
+
+RECORD_TIMEOUT = 5      # seconds to wait for 'less' to answer a request
+
+# requests sent to 'less': (task name, argument)
+SCENARIO = [('open', None)] + [('fwd', None)]*8 + [('back', None)]*4 + \
+           [('pos', 50)] + [('fwd', None)]*4 + [('redraw', None)] + [('back', None)]*2 + \
+           [('pos', 90), ('fwd', 2), ('pos', 10), ('pages', 5), ('back', 3), ('redraw', None)]
+
+
+class PtyChannel(object):
+    """ Local shell in a pseudo terminal, looks like a paramiko shell channel """
+    def __init__(self):
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.environ['TERM'] = 'vt100'
+            os.environ['PS1'] = '$ '
+            os.environ.pop('LESS', None)
+            os.execvp('sh', ['sh'])
+
+    def resize_pty(self, width=80, height=24):
+        fcntl.ioctl(self.fd, termios.TIOCSWINSZ, struct.pack('HHHH', height, width, 0, 0))
+
+    def fileno(self):
+        return self.fd
+
+    def recv_ready(self):
+        return bool(select.select([self.fd], [], [], 0)[0])
+
+    def recv(self, size):
+        try:
+            return os.read(self.fd, size)
+        except OSError:
+            return ''
+
+    def send(self, data):
+        return os.write(self.fd, data)
+
+    def exit_status_ready(self):
+        return os.waitpid(self.pid, os.WNOHANG)[0] != 0
+
+    def close(self):
+        os.close(self.fd)
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+            os.waitpid(self.pid, 0)
+        except OSError:
+            pass
+
+
+class LocalShell(object):
+    """ Stands for ssh_channel.SSHChannel """
+    host = 'localhost'
+    port = 0
+
+    def get_shell(self):
+        return PtyChannel()
+
+    def close(self):
+        pass
+
+
+class RecordingChannel(object):
+    """ Keeps data received by the channel in the current list of chunks """
+    def __init__(self, channel):
+        self._channel = channel
+        self.chunks = []
+
+    def recv(self, size):
+        data = self._channel.recv(size)
+        if data:
+            self.chunks.append(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._channel, name)
+
+
+def make_log(path, lines=5000):
+    """ Writes a log with lines of different length, some of them are wrapped """
+    with open(path, 'w') as f:
+        for i in range(lines):
+            f.write('2016-03-%02d %02d:%02d:%02d.%03d [%s] worker-%d: request %08x took %d ms\n'
+                    %(1+i//86400, i//3600%24, i//60%60, i%60, i*7%1000,
+                      ('INFO', 'DEBUG', 'WARN')[i%3], i%8, i*2654435761%(1<<32), i*37%500))
+            if i%50 == 7:
+                f.write('Traceback: ' + ' -> '.join('module_%d.func_%d()'%(n, i%13)
+                                                    for n in range(20)) + '\n')
+
+
+def record(ssh, path, cols, rows, scenario=SCENARIO):
+    """ @return fixture with data received while scenario was served """
+    pl = BenchLess(ssh=ssh, path=path, cols=cols, rows=rows, cache_size=0)
+    channel = pl.channel = RecordingChannel(pl.channel)
+    steps = []
+    try:
+        for name, arg in scenario:
+            channel.chunks = []
+            try:
+                pl.put_request(TASKS[name], arg)
+            except PlugLessException as e:
+                sys.stderr.write("'%s' is skipped: %s\n"%(name, e))
+                continue
+            while pl.has_task:
+                if not select.select([channel], [], [], RECORD_TIMEOUT)[0]:
+                    raise RuntimeError("'less' has not answered '%s'"%name)
+                pl.check_response()
+            steps.append({'task': name, 'arg': arg, 'chunks': channel.chunks})
+    finally:
+        pl.close()
+    return {'cols': cols, 'rows': rows, 'steps': steps}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='records less output for benchmarks')
+    parser.add_argument('--cols', type=int, default=80)
+    parser.add_argument('--rows', type=int, default=24)
+    parser.add_argument('--name', help='fixture name')
+    parser.add_argument('--path', help='log to show, a generated one by default')
+    parser.add_argument('--host', help='run less on the host by ssh instead of local shell')
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('--user', default='')
+    parser.add_argument('--secret', default='')
+    args = parser.parse_args()
+
+    path = args.path
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix='.log')
+        os.close(fd)
+        make_log(path)
+    try:
+        if args.host:
+            from ssh_channel import SSHChannel
+            ssh = SSHChannel(args.host, args.port, args.user, args.secret)
+            ssh.connect()
+        else:
+            ssh = LocalShell()
+        fixture = record(ssh, path, args.cols, args.rows)
+        ssh.close()
+    finally:
+        if args.path is None:
+            os.remove(path)
+    fixture['name'] = args.name or 'less_%dx%d'%(args.cols, args.rows)
+    out = os.path.join(FIXTURES_DIR, fixture['name']+'.json')
+    save_fixture(out, fixture)
+    sys.stdout.write("%d requests are recorded to %s\n"%(len(fixture['steps']), out))
+
+if __name__ == '__main__':
+    main()
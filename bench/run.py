@@ -0,0 +1,193 @@
+""" Replays recorded 'less' output through ScreenBuff and PlugLess.
+
+        python bench/run.py [--repeat N] [--out result.json] [--compare base.json] [fixture ...]
+
+    For every fixture (all of bench/fixtures by default) it reports:
+        screen  - ScreenBuff.put_data() over the whole stream, MB/s
+        anchors - anchor matching alone (put_data(anchor_only=True)), MB/s
+        plug    - PlugLess serving the recorded requests, pages/s,
+                  with time spent on every kind of request
+        memory  - allocations made by one replay of the plug (Python 3 only)
+    Times are the best of --repeat runs. The result is JSON with stable keys,
+    so results of different commits can be compared by --compare.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import timeit
+
+from bench_util import BenchLess, TASKS, commit, fixture_paths, load_fixture
+from plugs import PlugLess, ScreenBuff
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+RESULT_VERSION = 1
+REPEAT = 5
+
+
+class ReplayChannel(object):
+    """ Gives back the chunks recorded for the current request """
+    def __init__(self):
+        self.chunks = []
+
+    def feed(self, chunks):
+        self.chunks = list(reversed(chunks))
+
+    def recv_ready(self):
+        return bool(self.chunks)
+
+    def recv(self, size):
+        chunk = self.chunks.pop()
+        if len(chunk) > size:
+            self.chunks.append(chunk[size:])
+            chunk = chunk[:size]
+        return chunk
+
+    def send(self, data):
+        return len(data)
+
+    def resize_pty(self, width=80, height=24):
+        pass
+
+    def exit_status_ready(self):
+        return False
+
+    def close(self):
+        pass
+
+
+class ReplayShell(object):
+    host = 'replay'
+    port = 0
+
+    def get_shell(self):
+        return ReplayChannel()
+
+
+def _best(func, repeat):
+    """ @return the shortest time of func() out of repeat runs """
+    times = []
+    for n in range(repeat):
+        gc.collect()
+        start = timeit.default_timer()
+        func()
+        times.append(timeit.default_timer() - start)
+    return min(times)
+
+
+def bench_screen(fixture, anchor_only=False):
+    def run():
+        sb = ScreenBuff(fixture['cols'], fixture['rows'])
+        for step in fixture['steps']:
+            matcher = PlugLess.MATCHERS[TASKS[step['task']]]
+            sb.wait_new_anchor(matcher)
+            for chunk in step['chunks']:
+                if anchor_only:
+                    sb.wait_new_anchor(matcher)
+                sb.put_data(chunk, anchor_only)
+    return run
+
+
+def bench_plug(fixture, tasks=None):
+    """ @param tasks - dict the time spent on every kind of request is added to """
+    def run():
+        pl = BenchLess(ssh=ReplayShell(), path='replay', cols=fixture['cols'],
+                       rows=fixture['rows'], cache_size=0)
+        pages = 0
+        for step in fixture['steps']:
+            start = timeit.default_timer()
+            pl.put_request(TASKS[step['task']], step['arg'])
+            pl.channel.feed(step['chunks'])
+            while pl.has_task and pl.channel.recv_ready():
+                pl.check_response()
+            if pl.has_task:
+                raise RuntimeError("replay of '%s' has diverged at '%s'"
+                                   %(fixture['name'], step['task']))
+            result = pl.get_result()
+            pages = pages + (len(result) if isinstance(result, list) else 1)
+            if tasks is not None:
+                tasks[step['task']] = tasks.get(step['task'], 0) + timeit.default_timer() - start
+        return pages
+    return run
+
+
+def bench_memory(fixture):
+    """ @return allocations made by one replay of the plug """
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        bench_plug(fixture)()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    return {'peak_bytes': peak, 'blocks_left': blocks}
+
+
+def run_fixture(path, repeat):
+    fixture = load_fixture(path)
+    size = sum(len(c) for step in fixture['steps'] for c in step['chunks'])
+    mb = size/1024.0/1024
+    screen = _best(bench_screen(fixture), repeat)
+    anchors = _best(bench_screen(fixture, anchor_only=True), repeat)
+    pages = bench_plug(fixture)()
+    plug = _best(bench_plug(fixture), repeat)
+    tasks = {}
+    bench_plug(fixture, tasks)()
+    return {'bytes': size, 'requests': len(fixture['steps']), 'pages': pages,
+            'cols': fixture['cols'], 'rows': fixture['rows'],
+            'screen': {'seconds': screen, 'mb_s': mb/screen},
+            'anchors': {'seconds': anchors, 'mb_s': mb/anchors},
+            'plug': {'seconds': plug, 'pages_s': pages/plug, 'mb_s': mb/plug,
+                     'tasks': tasks},
+            'memory': bench_memory(fixture)}
+
+
+def compare(result, base):
+    """ @return lines with ratios of throughput to the base result """
+    lines = ['%-20s %10s %10s %10s'%('fixture', 'screen', 'anchors', 'plug')]
+    for name, res in sorted(result['fixtures'].items()):
+        old = base['fixtures'].get(name)
+        if old is None:
+            continue
+        ratios = [res[key]['mb_s']/old[key]['mb_s'] for key in ('screen', 'anchors', 'plug')]
+        lines.append('%-20s %9.2fx %9.2fx %9.2fx'%tuple([name]+ratios))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ScreenBuff and PlugLess benchmarks')
+    parser.add_argument('fixtures', nargs='*', help='fixture names, all by default')
+    parser.add_argument('--repeat', type=int, default=REPEAT)
+    parser.add_argument('--out', help='file to write the result to, stdout by default')
+    parser.add_argument('--compare', help='result of another run to compare with')
+    args = parser.parse_args()
+
+    result = {'version': RESULT_VERSION, 'commit': commit(),
+              'python': platform.python_version(), 'repeat': args.repeat,
+              'fixtures': {}}
+    for path in fixture_paths(args.fixtures):
+        name = os.path.splitext(os.path.basename(path))[0]
+        result['fixtures'][name] = run_fixture(path, args.repeat)
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text+'\n')
+    else:
+        sys.stdout.write(text+'\n')
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        sys.stderr.write('\n'.join(compare(result, base))+'\n')
+
+if __name__ == '__main__':
+    main()
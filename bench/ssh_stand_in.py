@@ -0,0 +1,208 @@
+""" Local SSH server which stands for the remote host in load tests.
+
+    Any user name and password is accepted. Shell requests get 'sh' running
+    in a pseudo terminal of the requested size, exec requests run the command
+    by 'sh -c', so 'less', 'tail', 'awk' and friends used by the plugs are the
+    real ones. SFTP is not served.
+"""
+import fcntl
+import logging
+import os
+import pty
+import select
+import signal
+import socket
+import struct
+import subprocess
+import termios
+import threading
+import time
+
+import paramiko
+
+PUMP_SIZE = 32*1024     # bytes moved between channel and process at once
+HOST_KEY_BITS = 1024
+CLOSE_WAIT = 1          # seconds finished command waits for client to close the channel
+
+logger = logging.getLogger('%s'%(__name__))
+logger.addHandler(logging.NullHandler())
+
+
+def _set_winsize(fd, cols, rows):
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, struct.pack('HHHH', rows, cols, 0, 0))
+
+
+class _Shell(object):
+    """ 'sh' in a pseudo terminal connected to a channel """
+    def __init__(self, channel, term, cols, rows):
+        self.channel = channel
+        self.pid, self.fd = pty.fork()
+        if self.pid == 0:
+            os.environ['TERM'] = term
+            os.environ['PS1'] = '$ '
+            os.environ.pop('LESS', None)
+            os.execvp('sh', ['sh'])
+        _set_winsize(self.fd, cols, rows)
+
+    def resize(self, cols, rows):
+        _set_winsize(self.fd, cols, rows)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def serve(self):
+        try:
+            while not self.channel.closed:
+                reads = select.select([self.channel, self.fd], [], [], 1)[0]
+                if self.channel in reads:
+                    data = self.channel.recv(PUMP_SIZE)
+                    if not data:
+                        break
+                    os.write(self.fd, data)
+                if self.fd in reads:
+                    try:
+                        data = os.read(self.fd, PUMP_SIZE)
+                    except OSError:     # EIO: shell has exited
+                        data = ''
+                    if not data:
+                        break
+                    self.channel.sendall(data)
+        except (socket.error, EnvironmentError) as e:
+            logger.info('Shell channel is broken: %s'%str(e))
+        finally:
+            self.kill()
+            os.waitpid(self.pid, 0)
+            os.close(self.fd)
+            self.channel.close()
+
+
+class _Command(object):
+    """ Command run by 'sh -c', its stdin, stdout and stderr go to the channel """
+    def __init__(self, channel, command):
+        self.channel = channel
+        self.proc = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                     preexec_fn=os.setsid)
+
+    def kill(self):
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def serve(self):
+        outputs = {self.proc.stdout.fileno(): self.channel.sendall,
+                   self.proc.stderr.fileno(): self.channel.sendall_stderr}
+        reads = [self.channel] + list(outputs)
+        try:
+            while outputs and not self.channel.closed:
+                for obj in select.select(reads, [], [], 1)[0]:
+                    if obj is self.channel:
+                        data = self.channel.recv(PUMP_SIZE)
+                        if data:
+                            self.proc.stdin.write(data)
+                            self.proc.stdin.flush()
+                        else:
+                            self.proc.stdin.close()
+                            reads.remove(obj)
+                        continue
+                    data = os.read(obj, PUMP_SIZE)
+                    if data:
+                        outputs[obj](data)
+                    else:
+                        del outputs[obj]
+                        reads.remove(obj)
+        except (socket.error, EnvironmentError) as e:
+            logger.info('Command channel is broken: %s'%str(e))
+        if outputs:
+            self.kill()
+        status = self.proc.wait()
+        if self.channel.closed:
+            return
+        self.channel.send_exit_status(status if status >= 0 else 255)
+        self.channel.shutdown_write()
+        # the answer to exec request is sent after it has started the command,
+        # closing the channel before that makes the request fail on client side
+        deadline = time.time() + CLOSE_WAIT
+        while not self.channel.closed and time.time() < deadline:
+            time.sleep(0.01)
+        self.channel.close()
+
+
+class StandInServer(paramiko.ServerInterface):
+    """ Serves channels of a single SSH connection """
+    def __init__(self, sessions):
+        self._ptys = {}         # key: channel id; value: (term, cols, rows)
+        self._sessions = sessions
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height,
+                                  pixelwidth, pixelheight, modes):
+        self._ptys[channel.get_id()] = (term, width, height)
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height,
+                                            pixelwidth, pixelheight):
+        term = self._ptys.get(channel.get_id(), ('vt100',))[0]
+        self._ptys[channel.get_id()] = (term, width, height)
+        session = self._sessions.get(channel)
+        if isinstance(session, _Shell):
+            session.resize(width, height)
+        return True
+
+    def check_channel_shell_request(self, channel):
+        term, cols, rows = self._ptys.get(channel.get_id(), ('vt100', 80, 24))
+        self._start(channel, _Shell(channel, term, cols, rows))
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        self._start(channel, _Command(channel, command))
+        return True
+
+    def _start(self, channel, session):
+        self._sessions[channel] = session
+
+        def serve():
+            try:
+                session.serve()
+            finally:
+                self._sessions.pop(channel, None)
+
+        t = threading.Thread(target=serve)
+        t.daemon = True
+        t.start()
+
+
+def serve(sock):
+    """ Accepts SSH connections on the listening socket until SIGTERM,
+        then kills everything started by the channels
+    """
+    key = paramiko.RSAKey.generate(HOST_KEY_BITS)
+    sessions = {}       # key: channel; value: _Shell or _Command
+
+    def stop(signum, frame):
+        for session in sessions.values():
+            session.kill()
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    transports = []
+    while True:
+        conn, addr = sock.accept()
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(key)
+        transport.start_server(server=StandInServer(sessions))
+        transports.append(transport)
@@ -0,0 +1,271 @@
+import os
+import errno
+import fcntl
+import logging
+import select
+import threading
+import time
+import Queue
+from collections import deque
+from ssh_channel import SSH_POOL
+from timers import Timers
+
+EXECUTOR_WORKERS = 8
+POLL_TIMEOUT = 5            # max seconds to wait for events, stop() is noticed within it
+HOUSEKEEPING_PERIOD = 5     # seconds between SSH_POOL.expire() calls
+
+_READ_EVENTS = select.POLLIN | select.POLLPRI
+_ERROR_EVENTS = select.POLLERR | select.POLLNVAL
+
+logger = logging.getLogger('%s'%(__name__))
+logger.addHandler(logging.NullHandler())
+
+
+class Executor(object):
+    """ Bounded pool of threads used to run blocking (paramiko) calls.
+        Callbacks are not called by workers: finished jobs are queued and
+        the event loop is woken up through a pipe to run them.
+    """
+    def __init__(self, workers=EXECUTOR_WORKERS):
+        self._jobs = Queue.Queue()
+        self._done = deque()
+        self._rfd, self._wfd = os.pipe()
+        for fd in (self._rfd, self._wfd):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self._workers = []
+        for n in range(workers):
+            t = threading.Thread(target=self._work, name='executor-%d'%n)
+            t.daemon = True
+            t.start()
+            self._workers.append(t)
+
+    def fileno(self):
+        """ Becomes readable when there are finished jobs """
+        return self._rfd
+
+    def submit(self, owner, func, args, callback):
+        """ Schedules func(*args), callback(result, error) will be called 
+            by the loop thread through run_callbacks()
+            @param owner - object the job is made for, returned by run_callbacks()
+        """
+        self._jobs.put((owner, func, args, callback))
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            owner, func, args, callback = job
+            try:
+                res, err = func(*args), None
+            except Exception as e:
+                res, err = None, e
+            self._done.append((owner, callback, res, err))
+            self.wake()
+
+    def wake(self):
+        """ Makes fileno() readable, safe to call from signal handlers """
+        try:
+            os.write(self._wfd, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN: # pipe is full, loop is awake anyway
+                raise
+
+    def run_callbacks(self):
+        """ Calls callbacks of finished jobs
+            @return list of owners of the finished jobs
+        """
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+        owners = []
+        while self._done:
+            owner, callback, res, err = self._done.popleft()
+            try:
+                callback(res, err)
+            except Exception:
+                logger.exception("Callback of blocking call has failed")
+            owners.append(owner)
+        return owners
+
+    def close(self):
+        for t in self._workers:
+            self._jobs.put(None)
+        os.close(self._rfd)
+        os.close(self._wfd)
+
+
+class EventLoop(object):
+    """ Serves all clients from a single thread.
+
+        WebClient instances are not started as threads here: the loop polls
+        their sockets and log channels and calls WebClient.handle_read(),
+        send_to_client() and handle_error(). Blocking calls made by clients
+        go to the Executor. WebClient._pool_expired() is called when
+        the deadline the client has reported by next_deadline() comes.
+    """
+    def __init__(self, server_sock, client_class, workers=EXECUTOR_WORKERS, profiler=None):
+        """
+            @param server_sock - listening socket
+            @param client_class - web_client.WebClient or its subclass, called
+                                  as client_class(sock, addr, executor=...) for new clients
+            @param workers - number of threads used for blocking calls
+            @param profiler - tracing.LoopProfiler sampling iterations of the loop
+        """
+        self.server = server_sock
+        self.client_class = client_class
+        self.profiler = profiler
+        self.executor = Executor(workers)
+        self.running = True
+        self._poll = select.poll()
+        self._poll.register(self.server, _READ_EVENTS)
+        self._poll.register(self.executor, _READ_EVENTS)
+        self._fds = {}          # key: fd; value: (client, object, events)
+        self._calls = deque()   # (func, args) to be called by the loop, see call_soon()
+        self._client_fds = {}   # key: client; value: set of fds registered for it
+        self._timers = Timers() # key: client or SSH_POOL; value: time it has to be expired at
+        self._timers.schedule(SSH_POOL, time.time() + HOUSEKEEPING_PERIOD)
+
+    @property
+    def clients(self):
+        return self._client_fds.keys()
+
+    def run(self):
+        while self.running:
+            if self.profiler is not None and self.profiler.begin():
+                try:
+                    self.run_once(POLL_TIMEOUT)
+                finally:
+                    self.profiler.end()
+            else:
+                self.run_once(POLL_TIMEOUT)
+
+    def run_once(self, timeout):
+        """ Waits for events at most 'timeout' seconds (less if a deadline
+            comes earlier) and processes them
+        """
+        timeout = self._timers.timeout(time.time(), timeout)
+        try:
+            events = self._poll.poll(timeout*1000)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        touched = set()
+        for fd, ev in events:
+            if fd == self.server.fileno():
+                self._accept()
+            elif fd == self.executor.fileno():
+                touched.update(self.executor.run_callbacks())
+            elif fd in self._fds:
+                client, obj, registered = self._fds[fd]
+                touched.add(client)
+                if not client.running:
+                    continue
+                if ev & _ERROR_EVENTS:
+                    self._serve(client, client.handle_error, obj)
+                    continue
+                if ev & (_READ_EVENTS | select.POLLHUP):
+                    if not self._serve(client, client.handle_read, obj):
+                        continue
+                if ev & select.POLLOUT:
+                    self._serve(client, client.send_to_client)
+
+        now = time.time()
+        for key in self._timers.pop_due(now):
+            if key is SSH_POOL:
+                SSH_POOL.expire()
+                self._timers.schedule(SSH_POOL, now + HOUSEKEEPING_PERIOD)
+                continue
+            if key.running:
+                self._serve(key, key._pool_expired)
+            touched.add(key)
+
+        for client in touched:
+            self._sync(client)
+
+        while self._calls:
+            func, args = self._calls.popleft()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception("Call made by the loop has failed")
+
+    def call_soon(self, func, *args):
+        """ Makes the loop thread call func(*args) after the current iteration.
+            Takes no locks, so it is safe to call from signal handlers.
+        """
+        self._calls.append((func, args))
+        self.executor.wake()
+
+    def _serve(self, client, func, *args):
+        """ Calls func(*args) of the client, the client is dropped if it fails
+            so others are served further
+            @return result of func, False if it has failed
+        """
+        try:
+            return func(*args)
+        except Exception:
+            logger.exception("Client %shas failed, dropping it"%client.name)
+            try:
+                client._client_disconnect()
+            except Exception:
+                logger.exception("Unable to disconnect client %s"%client.name)
+            client.running = False
+            return False
+
+    def _accept(self):
+        sock, addr = self.server.accept()
+        logger.info("New client %s"%str(addr))
+        client = self.client_class(sock, addr, executor=self.executor)
+        self._client_fds[client] = set()
+        self._sync(client)
+
+    def _sync(self, client):
+        """ Updates poll registration according to client's fd lists """
+        if client not in self._client_fds:
+            return
+        wanted = {}
+        if client.running:
+            for obj in client._sock_read_fd:
+                wanted[obj.fileno()] = [obj, _READ_EVENTS]
+            for obj in client._sock_write_fd:
+                wanted.setdefault(obj.fileno(), [obj, 0])[1] |= select.POLLOUT
+
+        registered = self._client_fds[client]
+        for fd in registered - set(wanted):
+            self._poll.unregister(fd)
+            del self._fds[fd]
+        for fd, (obj, events) in wanted.iteritems():
+            if fd not in self._fds:
+                self._poll.register(fd, events)
+            elif self._fds[fd][2] != events:
+                self._poll.modify(fd, events)
+            self._fds[fd] = (client, obj, events)
+
+        deadline = client.next_deadline() if client.running else None
+        if deadline is None:
+            self._timers.cancel(client)
+        else:
+            self._timers.schedule(client, deadline)
+
+        if client.running:
+            self._client_fds[client] = set(wanted)
+        else:
+            logger.info("Client %shas gone"%client.name)
+            del self._client_fds[client]
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """ Disconnects all clients and stops executor """
+        for client in self.clients:
+            if client.running:
+                client._client_disconnect()
+            self._sync(client)
+        self.executor.close()
@@ -0,0 +1,129 @@
+import bisect
+import logging
+import pipes
+import threading
+from collections import OrderedDict
+
+LINE_INDEX_STEP = 1000      # lines between index checkpoints
+LINE_INDEX_FILES = 64       # max files indexes are kept for
+
+logger = logging.getLogger('lib.%s'%(__name__))
+logger.addHandler(logging.NullHandler())
+
+
+class LineIndexException(Exception):
+    pass
+
+
+class LineIndex(object):
+    """ Sparse index of a remote file: byte offset of every step-th line.
+
+        The index is built by a single pass of 'awk' on the remote side and
+        is extended by the same pass over the appended data when the file
+        grows. Only complete lines are indexed. Lines are counted from 0.
+        All methods which take ssh are blocking calls.
+    """
+    def __init__(self, step=LINE_INDEX_STEP):
+        self.step = step
+        self.offsets = [0]      # offsets[i] is the start of line i*step
+        self.lines = 0          # number of complete lines indexed
+        self.size = 0           # end of the last complete line indexed
+        self.file_size = 0      # size of the file known by the last update
+        self.inode = None
+        self._lock = threading.Lock()
+
+    def total_lines(self):
+        """ @return number of lines in the file, incomplete last line counts """
+        return self.lines + (1 if self.file_size > self.size else 0)
+
+    def update(self, ssh, path):
+        """ Builds the index or extends it if the file has grown """
+        with self._lock:
+            out, err = ssh.exec_remote("stat -L -c '%i %s' "+pipes.quote(path))
+            if err or not out:
+                raise LineIndexException("Unable to stat '%s': %s"%(path, ' '.join(err)))
+            inode, size = [int(v) for v in out[0].split()]
+            if inode != self.inode or size < self.size:
+                if self.inode is not None:
+                    logger.info("'%s' has been replaced, line index is rebuilt"%path)
+                self.offsets = [0]
+                self.lines = 0
+                self.size = 0
+                self.inode = inode
+            self.file_size = size
+            if size > self.size:
+                self._extend(ssh, path, size)
+
+    def _extend(self, ssh, path, size):
+        base = self.size
+        logger.info("indexing lines of '%s' from offset %d"%(path, base))
+        cmd = "tail -c +%d %s | head -c %d | LC_ALL=C awk -v k=%d -v n=%d " \
+              "'{ if ((n+NR-1)%%k == 0) print n+NR-1, o+0; p = o; o += length($0)+1 } " \
+              "END { print \"end\", NR, o+0, p+0 }'" \
+              %(base+1, pipes.quote(path), size-base, self.step, self.lines)
+        out, err = ssh.exec_remote(cmd)
+        if err or not out or not out[-1].startswith('end'):
+            raise LineIndexException("Unable to index '%s': %s"%(path, ' '.join(err)))
+        for line in out[:-1]:
+            num, offset = [int(v) for v in line.split()]
+            if num == len(self.offsets)*self.step:
+                self.offsets.append(base+offset)
+        records, end, last = [int(v) for v in out[-1].split()[1:]]
+        if base+end > size:
+            # the last line has no '\n' yet
+            self.lines += records-1
+            self.size = base+last
+        else:
+            self.lines += records
+            self.size = base+end
+
+    def offset_of(self, ssh, path, line):
+        """ @return offset of the line start, file size if there is no such line """
+        idx = min(line//self.step, len(self.offsets)-1)
+        offset = self.offsets[idx]
+        skip = line - idx*self.step
+        if not skip:
+            return offset
+        out, err = ssh.exec_remote("tail -c +%d %s | head -n %d | wc -c"
+                                   %(offset+1, pipes.quote(path), skip))
+        if err or not out:
+            raise LineIndexException("Unable to seek line %d: %s"%(line, ' '.join(err)))
+        return offset+int(out[0])
+
+    def line_at(self, ssh, path, offset):
+        """ @return number of the line which contains offset,
+                    None if the offset is not indexed yet
+        """
+        if offset > self.size:
+            return None
+        idx = bisect.bisect_right(self.offsets, offset)-1
+        start = self.offsets[idx]
+        if offset == start:
+            return idx*self.step
+        out, err = ssh.exec_remote("tail -c +%d %s | head -c %d | wc -l"
+                                   %(start+1, pipes.quote(path), offset-start))
+        if err or not out:
+            raise LineIndexException("Unable to count lines: %s"%' '.join(err))
+        return idx*self.step+int(out[0])
+
+
+class LineIndexes(object):
+    """ Line indexes shared by all logs which show the same remote file """
+    def __init__(self, max_files=LINE_INDEX_FILES):
+        self.max_files = max_files
+        self._lock = threading.Lock()
+        self._indexes = OrderedDict()   # key: (host, port, path); value: LineIndex
+
+    def get(self, ssh, path):
+        key = (ssh.host, ssh.port, path)
+        with self._lock:
+            index = self._indexes.pop(key, None)
+            if index is None:
+                index = LineIndex()
+            self._indexes[key] = index      # most recently used goes last
+            while len(self._indexes) > self.max_files:
+                self._indexes.popitem(last=False)
+        return index
+
+
+LINE_INDEXES = LineIndexes()
@@ -0,0 +1,229 @@
+""" Process-wide metrics: counters, gauges and histograms.
+
+    Metrics are kept by METRICS registry and are declared by modules which
+    update them. The registry gives a snapshot used by the 'stats' protocol
+    command and Prometheus text format served by MetricsServer.
+"""
+import bisect
+import logging
+import threading
+import BaseHTTPServer
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_PATH = '/metrics'
+
+logger = logging.getLogger('%s'%(__name__))
+logger.addHandler(logging.NullHandler())
+
+
+def _label_text(names, values, extra=None):
+    pairs = zip(names, values)
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}'%','.join('%s="%s"'%(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+                           for name, value in pairs)
+
+
+def _number_text(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labels=()):
+        """
+            @param name - metric name, counters end with '_total'
+            @param help - description shown by Prometheus
+            @param labels - names of the labels values are split by
+        """
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}       # key: tuple of label values; value: metric data
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        """ @return list of (name suffix, label values, extra label, value) """
+        assert False, "Override!"
+
+    def snapshot(self):
+        """ @return list of {'labels': {...}, 'value': ...}, JSON serializable """
+        with self._lock:
+            items = sorted(self._values.items())
+        return [{'labels': dict(zip(self.labels, key)), 'value': self._value(data)}
+                for key, data in items]
+
+    def _value(self, data):
+        return data
+
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [('', key, None, value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """ Value is taken by func() when metrics are collected """
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        """ @param func - returns the value or, if the gauge has labels,
+                          dict of values keyed by tuples of label values
+        """
+        _Metric.__init__(self, name, help, labels)
+        self._func = func
+
+    def _collect(self):
+        try:
+            value = self._func()
+        except Exception:
+            logger.exception("Unable to collect '%s'"%self.name)
+            return []
+        if self.labels:
+            return sorted(value.items())
+        return [((), value)]
+
+    def samples(self):
+        return [('', key, None, value) for key, value in self._collect()]
+
+    def snapshot(self):
+        return [{'labels': dict(zip(self.labels, key)), 'value': value}
+                for key, value in self._collect()]
+
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        """ @param buckets - sorted upper bounds of the buckets, +Inf is added """
+        _Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                # counts of every bucket (not cumulative), +Inf last; sum of values
+                data = self._values[key] = [[0]*(len(self.buckets)+1), 0]
+            data[0][bisect.bisect_left(self.buckets, value)] += 1
+            data[1] = data[1] + value
+
+    def _value(self, data):
+        counts, total = data
+        cumulative = []
+        count = 0
+        for bound, n in zip(self.buckets, counts):
+            count = count + n
+            cumulative.append([bound, count])
+        return {'count': count + counts[-1], 'sum': total, 'buckets': cumulative}
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, (list(data[0]), data[1])) for key, data in self._values.items())
+        for key, (counts, total) in items:
+            count = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                count = count + n
+                samples.append(('_bucket', key, ('le', _number_text(float(bound))), count))
+            samples.append(('_sum', key, None, total))
+            samples.append(('_count', key, None, count))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def _add(self, metric):
+        with self._lock:
+            for known in self._metrics:
+                if known.name == metric.name:
+                    return known    # module is imported again (e.g. by tests)
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, func, labels=()):
+        return self._add(Gauge(name, help, func, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def snapshot(self):
+        """ @return dict of all metrics keyed by names, JSON serializable """
+        with self._lock:
+            metrics = list(self._metrics)
+        return dict((metric.name, metric.snapshot()) for metric in metrics)
+
+    def prometheus_text(self):
+        """ @return all metrics in Prometheus text exposition format """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s'%(metric.name, metric.help))
+            lines.append('# TYPE %s %s'%(metric.name, metric.TYPE))
+            for suffix, key, extra, value in metric.samples():
+                lines.append('%s%s%s %s'%(metric.name, suffix,
+                                          _label_text(metric.labels, key, extra),
+                                          _number_text(value)))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = Registry()
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != METRICS_PATH:
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus_text()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s'%(self.address_string(), format%args))
+
+
+class MetricsServer(threading.Thread):
+    """ Serves METRICS_PATH in Prometheus text format by its own thread """
+    def __init__(self, host='127.0.0.1', port=9998, registry=METRICS):
+        threading.Thread.__init__(self, name='metrics')
+        self.daemon = True
+        self.httpd = BaseHTTPServer.HTTPServer((host, port), _MetricsHandler)
+        self.httpd.registry = registry
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
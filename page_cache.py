@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+PAGE_CACHE_SIZE = 1024*1024     # bytes of page text kept per log
+
+
+class PageCache(object):
+    """ LRU cache of rendered pages, bounded by total length of pages text """
+    def __init__(self, max_bytes=PAGE_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pages = OrderedDict()     # key: page position; value: (text, extra data)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, key):
+        return key in self._pages
+
+    def get(self, key):
+        """ @return (text, extra data) or None if there is no such page """
+        page = self._pages.pop(key, None)
+        if page is not None:
+            self._pages[key] = page     # most recently used goes last
+        return page
+
+    def peek(self, key):
+        """ Same as get() but does not touch the page """
+        return self._pages.get(key)
+
+    def put(self, key, text, extra=None):
+        self.discard(key)
+        if len(text) > self.max_bytes:
+            return
+        self._pages[key] = (text, extra)
+        self.size = self.size + len(text)
+        while self.size > self.max_bytes:
+            old_key, (old_text, old_extra) = self._pages.popitem(last=False)
+            self.size = self.size - len(old_text)
+
+    def discard(self, key):
+        page = self._pages.pop(key, None)
+        if page is not None:
+            self.size = self.size - len(page[0])
+
+    def clear(self):
+        self._pages.clear()
+        self.size = 0
@@ -0,0 +1,48 @@
+import re
+
+_ROW = re.compile('[^\n]*\n|[^\n]+')
+
+
+def split_rows(text):
+    """ @return list of page lines, every line but the last one ends with '\\n' """
+    return _ROW.findall(text)
+
+
+def page_delta(old, new):
+    """ Finds how to get the new page from the old one.
+        @param old, new - lists of page rows
+        @return (scroll, runs) - new row i is old row i+scroll unless it is
+                replaced by a run; runs is a list of [first row, [row texts]]
+    """
+    where = {}          # key: row text; value: indexes of the text in old page
+    for j, row in enumerate(old):
+        where.setdefault(row, []).append(j)
+    votes = {}          # key: scroll; value: rows it keeps
+    for i, row in enumerate(new):
+        for j in where.get(row, ()):
+            votes[j-i] = votes.get(j-i, 0) + 1
+    scroll = 0
+    if votes:
+        scroll = max(votes, key=lambda k: (votes[k], -abs(k)))
+    runs = []
+    run = None
+    for i, row in enumerate(new):
+        j = i + scroll
+        if 0 <= j < len(old) and old[j] == row:
+            run = None
+            continue
+        if run is None:
+            run = [i, []]
+            runs.append(run)
+        run[1].append(row)
+    return scroll, runs
+
+
+def apply_delta(old, scroll, runs, count):
+    """ Reverse of page_delta(): builds the new page rows from the old ones
+        @param count - number of rows in the new page
+    """
+    rows = [old[i+scroll] if 0 <= i+scroll < len(old) else None for i in range(count)]
+    for first, texts in runs:
+        rows[first:first+len(texts)] = texts
+    return rows
@@ -1,16 +1,47 @@
 import os
-import StringIO
 import logging
+import pipes
 import re
+import threading
+import time
+from collections import deque
 from ssh_channel import SSHChannel
+from page_cache import PageCache, PAGE_CACHE_SIZE
+from line_index import LINE_INDEXES
+from metrics import METRICS
 
 _ESC_POSITIVE = b'\x1b[m'
 _ESC_ERASE_RIGHT = b'\x1b[K'
 _ESC_RETURN_BUFFER = b'\x1b[?1049l'
 
+# run of chars which are put on the screen as is (see ScreenBuff._put_char)
+_TEXT_RUN = re.compile(r'[^\x1b\x08\r\n]+')
+# complete CSI sequence: ESC [ <params> <final char>
+_CSI_SEQ = re.compile(r'\x1b\[([^\x40-\x5a\x60-\x7e]*)([\x40-\x5a\x60-\x7e])')
+_CSI_POS = re.compile(r'(\d*);(\d*)')
+
+PAGE_CACHE_CHECK_PERIOD = 5     # seconds between checks if cached file has changed
+RANGE_BACK_READ_LIMIT = 1024*1024   # max bytes PlugRange reads back to find a line start
+PAGES_BATCH_LIMIT = 50          # max pages returned by a single PAGES request
+RECV_MIN_SIZE = 256             # bounds of adaptive read size of channel
+RECV_MAX_SIZE = 64*1024
+RECV_DRAIN_LIMIT = 1024*1024    # max bytes taken from channel at once
+SEARCH_LIMIT = 1000             # max matches returned by a single search
+SEARCH_CONTEXT_LIMIT = 10       # max context lines around a match
+SEARCH_TEXT_LIMIT = 1024        # longer lines are cut in search results
+FOLLOW_BATCH_SIZE = 16*1024     # appended lines are sent when there are this many bytes of them
+FOLLOW_BATCH_DELAY = 0.2        # or when the oldest of them waits this many seconds
+SCAN_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1)
+
 logger = logging.getLogger('lib.%s'%(__name__))
 logger.addHandler(logging.NullHandler())
 
+RECEIVED_BYTES = METRICS.counter('rtpager_channel_received_bytes_total',
+                                 'Bytes received by channels of plugs', ('plug',))
+ANCHOR_SCAN = METRICS.histogram('rtpager_anchor_scan_seconds',
+                                'Time ScreenBuff takes to process received data up to the anchor',
+                                buckets=SCAN_BUCKETS)
+
 class PlugLessException(Exception):
     pass
 
@@ -23,7 +54,32 @@ def repr_unprint(s):
             out.append("\\x%02x"%ord(ch))
     return "".join(out)
 
+def _batch_count(count):
+    """ @return number of pages to fetch by PAGES request or to move by """
+    if count is None:
+        return 1
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        logger.warning("wrong number of pages: '%s', using 1"%count)
+        return 1
+    return max(1, min(count, PAGES_BATCH_LIMIT))
+
+def _char_start(data, pos, low):
+    """ @return pos moved back to the start of UTF-8 char it splits, but not to low or below """
+    start = pos
+    while start > low+1 and pos-start < 3 and '\x80' <= data[start] <= '\xbf':
+        start -= 1
+    if '\x80' <= data[start] <= '\xbf':
+        return pos          # not UTF-8, bytes are cut as they are
+    return start
+
 class PlugGeneric:
+    BLOCKING = False    # True if put_request() waits for the result instead of
+                        # using channel which has to be polled by check_response()
+    result_ready = False    # True if the result of the last put_request() can be taken
+                            # though has_task is set by a request made in background
+
     def __init__(self, ssh=None, **kwargs):
         if not ssh:
             self._ssh_owner = True
@@ -40,6 +96,10 @@ class PlugGeneric:
 
         self.shell = False
         self.channel = None
+        self._recv_size = RECV_MIN_SIZE
+        self.received = 0       # bytes received by the channel
+        self.index = None       # line index of the file shown by the plug
+        self._located = None    # (offset, line) found by the last locate_line()
 
     def start_shell(self, cols=80, rows=24):
         if not self.shell:
@@ -55,12 +115,38 @@ class PlugGeneric:
 
     def flush(self):
         if self.shell:
-            while self.channel.recv_ready():
-                self.channel.recv(256)
+            self.recv_all()
+
+    def recv_all(self):
+        """ Drains data available in the channel.
+            Read size grows while reads fill it up and falls back when they
+            are much smaller.
+            @return data received, '' if there is no data
+        """
+        chunks = []
+        total = 0
+        while total < RECV_DRAIN_LIMIT and self.channel.recv_ready():
+            data = self.channel.recv(self._recv_size)
+            if not data:
+                break
+            chunks.append(data)
+            total = total + len(data)
+            if len(data) == self._recv_size:
+                self._recv_size = min(self._recv_size*2, RECV_MAX_SIZE)
+            elif len(data) < self._recv_size//4:
+                self._recv_size = max(self._recv_size//2, RECV_MIN_SIZE)
+        if total:
+            self.received = self.received + total
+            RECEIVED_BYTES.inc(total, plug=self.__class__.__name__)
+        return ''.join(chunks)
 
     def fileno(self):
         return self.channel.fileno()
 
+    def is_closed(self):
+        """ @return True if the channel has been closed by remote side """
+        return self.channel is not None and self.channel.exit_status_ready()
+
     def check_response(self):
         """ Used to process Plug data received from remote side. 
             Must be overriden in child
@@ -84,55 +170,229 @@ class PlugGeneric:
         """
         assert False, "Override!"
 
+    def prefetch(self):
+        """ Used to start fetching data client may ask for next
+            @return True if background request was started
+        """
+        return False
+
+    def position(self):
+        """ @return (line, total lines) of the page shown, None if unknown
+                    Both values start from 1, any of them may be None
+        """
+        return None
+
+    def update_index(self):
+        """ Blocking call, builds or extends the line index of log_path
+            @return the line index
+        """
+        if self.index is None:
+            self.index = LINE_INDEXES.get(self.ssh, self.log_path)
+        self.index.update(self.ssh, self.log_path)
+        return self.index
+
+    def locate_line(self, line):
+        """ Blocking call
+            @param line - line number, starting from 1
+            @return offset of the line start
+        """
+        line = max(0, int(line)-1)
+        offset = self.update_index().offset_of(self.ssh, self.log_path, line)
+        self._located = (offset, line)
+        return offset
+
+    def has_file_check(self):
+        """ @return True if the plug keeps data which start_file_check() may make stale """
+        return False
+
+    def start_file_check(self):
+        """ Used to find out if the remote file has to be checked for changes.
+            If True is returned, stat_file() has to be called and its 
+            result has to be passed to file_checked()
+        """
+        return False
+
     
+class AnchorMatcher(object):
+    """ Aho-Corasick automaton built over a set of anchors.
+
+        The automaton is compiled once, matching state is kept by the caller,
+        so the same matcher can be shared by all screen buffers.
+        If several anchors end at the same position, the one which comes
+        first in 'anchors' wins.
+    """
+    def __init__(self, anchors):
+        assert anchors
+        self.anchors = tuple([a for a in anchors if len(a)])
+        assert self.anchors, "No anchors to seek for"
+
+        # trie
+        goto = [{}]
+        out = [None]        # index of anchor which ends in the state
+        for idx, text in enumerate(self.anchors):
+            state = 0
+            for ch in text:
+                nxt = goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto.append({})
+                    out.append(None)
+                    goto[state][ch] = nxt
+                state = nxt
+            if out[state] is None:
+                out[state] = idx
+
+        # complete transition table, failure links are folded into it
+        delta = [None]*len(goto)
+        delta[0] = dict(goto[0])
+        fail = [0]*len(goto)
+        queue = deque(goto[0].values())
+        while queue:
+            state = queue.popleft()
+            f = fail[state]
+            if out[f] is not None and (out[state] is None or out[f] < out[state]):
+                out[state] = out[f]
+            delta[state] = dict(delta[f])
+            for ch, nxt in goto[state].items():
+                delta[state][ch] = nxt
+                if state:
+                    fail[nxt] = delta[f].get(ch, 0)
+                queue.append(nxt)
+
+        self._delta = delta
+        self._out = out
+        # used to skip input which cannot start any anchor
+        self._start = re.compile('[%s]'%''.join([re.escape(ch) for ch in goto[0]]))
+
+    def scan(self, buff, state=0, pos=0):
+        """ Feeds buff[pos:] to the automaton until an anchor is found
+            @param state - automaton state returned by previous scan
+            @return (state, end, anchor): end is the index right after 
+                    the anchor found, anchor is None if nothing was found
+        """
+        delta = self._delta
+        out = self._out
+        end = len(buff)
+        while pos < end:
+            if state == 0:
+                m = self._start.search(buff, pos)
+                if not m:
+                    return 0, end, None
+                pos = m.start()
+            state = delta[state].get(buff[pos], 0)
+            pos = pos + 1
+            if out[state] is not None:
+                return state, pos, self.anchors[out[state]]
+        return state, end, None
+
+
 class ScreenBuff(object):
+    """ Virtual screen. 
+        Rows are fixed width slices of a single bytearray, row order is kept
+        by a circular index (_top), so scrolling does not move or allocate rows.
+        Text of every row is rendered once and kept until the row is changed.
+    """
+    __slots__ = ('cols', 'rows', 'posx', 'posy', 'last_anchor', 'line_counter',
+                 '_matcher', '_a_state', '_cells', '_view', '_len', '_wrap', '_top',
+                 '_text', '_ESC_mode', '_ESC_buff', '_skip_prompt')
+
     def __init__(self, cols = 80, rows = 24):
         self.cols = cols
         self.rows = rows
         self.posx = 1
         self.posy = 1
-        self.anchor = []
         self.last_anchor = None
-        self.a_len = 0
-        self._buff = [StringIO.StringIO() for row in range(self.rows)]
-        self._wrap = [False for r in range(self.rows)]
+        self._matcher = None
+        self._a_state = 0
+        self._cells = bytearray(cols*rows)
+        self._view = memoryview(self._cells)
+        self._len = [0]*rows            # used length of each (physical) row
+        self._wrap = [False]*rows       # True if (physical) row continues on the next one
+        self._top = 0                   # physical row displayed at the top of the screen
+        self._text = [None]*rows        # rendered (physical) row, None if row is dirty
         self._ESC_mode = None
+        self._ESC_buff = ''
         self.line_counter = 0 
         self._skip_prompt = False
 
     def wait_new_anchor(self, anchors):
-        assert anchors
-        for a in anchors:
-            if len(a):
-                self.anchor.append((a,0,len(a),))
+        """ @param anchors - AnchorMatcher or sequence of anchors to seek for """
+        if not isinstance(anchors, AnchorMatcher):
+            anchors = AnchorMatcher(anchors)
+        self._matcher = anchors
+        self._a_state = 0
+
+    def _row(self, y):
+        """ @return physical row index of screen row y (1-based) """
+        return (self._top + y - 1) % self.rows
+
+    def _clear_row(self, row):
+        self._len[row] = 0
+        self._wrap[row] = False
+        self._text[row] = None
     
     def _new_line(self, reverse=False, wrap=False):
         if not reverse:
             #if self.line_counter < self.rows-1:
             self.line_counter = self.line_counter + 1
+            row = self._row(self.posy)
+            if self._wrap[row] != wrap:
+                self._wrap[row] = wrap
+                self._text[row] = None
             if self.posy==self.rows:
-                self._buff.pop(0)
-                self._buff.append(StringIO.StringIO())
-                self._wrap[self.posy-1] = wrap
-                self._wrap.pop(0)
-                self._wrap.append(False)
+                # top row becomes the new bottom one
+                self._clear_row(self._top)
+                self._top = (self._top + 1) % self.rows
             else:
-                self._wrap[self.posy-1] = wrap
                 self.posy = self.posy + 1
         else:
             if self.posy==1:
-                self._buff.pop()
-                self._buff.insert(0,StringIO.StringIO())
-                self._wrap.pop()
-                self._wrap.insert(0,False)
+                # bottom row becomes the new top one
+                self._top = (self._top - 1) % self.rows
+                self._clear_row(self._top)
             else:
                 self.posy = self.posy - 1
 
     def _trunc_end_line(self, pos = 1):
-        self._buff[self.posy-1].seek(pos-1)
-        self._buff[self.posy-1].truncate()
+        row = self._row(self.posy)
+        if self._len[row] > pos-1:
+            self._len[row] = pos-1
+            self._text[row] = None
+
+    def _write(self, text):
+        """ Writes text at cursor position and moves cursor. Text must fit the row """
+        row = self._row(self.posy)
+        off = row*self.cols
+        col = self.posx - 1
+        end = col + len(text)
+        used = self._len[row]
+        if col > used:
+            self._cells[off+used:off+col] = ' '*(col-used)
+        self._cells[off+col:off+end] = text
+        self._text[row] = None
+        if end > used:
+            self._len[row] = end
+        self.posx = end + 1
+
+    def _leave_row(self):
+        """ Called before cursor is moved to another row by ESC sequence.
+            'less' puts '\\r\\n' after a line which ends at the right margin,
+            so if the cursor leaves the full row without it (that is how
+            'less' draws upside down), the line continues on the next row.
+        """
+        if self.posx > self.cols:
+            row = self._row(self.posy)
+            self._wrap[row] = True
+            self._text[row] = None
+
+    def _clear_below(self):
+        """ Clears screen from cursor to the end """
+        self._trunc_end_line(self.posx)
+        for y in range(self.posy+1, self.rows+1):
+            self._clear_row(self._row(y))
 
     def _safe_move(self, col, row):
+        self._leave_row()
         if col>0 and col<=self.cols:
             self.posx = col
         else:
@@ -158,6 +418,7 @@ class ScreenBuff(object):
             if ch in '=>':                  # these are known to appear in 'less' output
                 self._ESC_mode = None
             elif ch=='M':                   # move position line up
+                self._leave_row()
                 self._new_line(reverse=True)
                 self._ESC_mode = None    
             elif ch=='[':   # CSI           
@@ -174,22 +435,7 @@ class ScreenBuff(object):
         elif self._ESC_mode=='CSI':
             
             if ord(ch)>95 and ord(ch)<127 or ord(ch)>63 and ord(ch)<91:  # means end of sequence
-                if ch == 'K' and self._ESC_buff == '':      # clear everything to the right
-                    self._trunc_end_line(self.posx)         
-                
-                elif ch == 'H':
-                    # move to (y;x) default (1;1)
-                    ret = re.search("(\d*);(\d*)", self._ESC_buff)
-                    row,col = 1,1                
-                    if ret:
-                        (tr,tc) = ret.groups()
-                        col = int(tc) if tc else 1
-                        row = int(tr) if tr else 1
-                    self._safe_move(col,row)
-                
-                else:
-                    logger.warning("Unaccounted ESC CSI sequence ESC%s%s"%(self._ESC_buff,ch))    
-                
+                self._ESC_CSI(self._ESC_buff, ch)
                 self._ESC_mode = None                
 
             else:
@@ -205,6 +451,27 @@ class ScreenBuff(object):
         # true means 'skip this'
         return True
         
+    def _ESC_CSI(self, params, ch):
+        """ Executes complete CSI sequence 'ESC [ <params> <ch>' """
+        if ch == 'K' and params == '':      # clear everything to the right
+            self._trunc_end_line(self.posx)         
+
+        elif ch == 'J' and params in ('', '0'):     # clear everything below
+            self._clear_below()
+        
+        elif ch == 'H':
+            # move to (y;x) default (1;1)
+            ret = _CSI_POS.search(params)
+            row,col = 1,1                
+            if ret:
+                (tr,tc) = ret.groups()
+                col = int(tc) if tc else 1
+                row = int(tr) if tr else 1
+            self._safe_move(col,row)
+        
+        else:
+            logger.warning("Unaccounted ESC CSI sequence ESC%s%s"%(params,ch))    
+
     def set_skip_prompt(self):
         self._skip_prompt = True
 
@@ -227,73 +494,136 @@ class ScreenBuff(object):
             self._new_line()
         else:
             if self.posx > self.cols:
-                self.posx = 2
                 self._new_line(wrap=True)
-            else:
-                self.posx = self.posx + 1
-            self._buff[self.posy-1].write(ch)
+                self.posx = 1
+            self._write(ch)
+
+    def _put_text(self, text):
+        """ Puts a run of printable chars to the screen. 
+            Same as calling _put_char() for every char of text, but writes
+            each row's part of the run at once.
+        """
+        head = self.cols + 1 - self.posx    # chars left before line wrap
+        if head > 0:
+            self._write(text[:head])
+        for pos in range(max(head, 0), len(text), self.cols):
+            self._new_line(wrap=True)
+            self.posx = 1
+            self._write(text[pos:pos+self.cols])
+
+    def _put_chunk(self, buff, end, start=0):
+        """ Puts buff[start:end] to the screen.
+            Runs of text and complete CSI sequences are processed in bulk,
+            everything else goes char by char through _put_char()
+        """
+        i = start
+        while i < end:
+            if self._ESC_mode==None:
+                m = _TEXT_RUN.match(buff, i, end)
+                if m:
+                    self._put_text(m.group())
+                    i = m.end()
+                    continue
+                m = _CSI_SEQ.match(buff, i, end)
+                if m:
+                    self._ESC_CSI(m.group(1), m.group(2))
+                    i = m.end()
+                    continue
+            self._put_char(buff[i])
+            i = i + 1
 
-    def put_data(self, buff, anchor_only=False):
+    def _seek_anchor(self, buff, start=0):
+        """ Runs anchor matching over buff[start:]
+            @return (found, end) where end is a position in buff the part
+                    which has to be put to the screen ends at
+        """
+        pos = start
+        while self._matcher:
+            self._a_state, pos, text = self._matcher.scan(buff, self._a_state, pos)
+            if text is None:
+                break
+            if self._skip_prompt:
+                self._skip_prompt = False
+                continue
+            logger.info("Pattern '%s' was found"%repr_unprint(text))
+            self.last_anchor = text 
+            self._matcher = None
+            if pos<len(buff) and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Pattern was found but buffer is not empty: %s"%repr_unprint(buff[pos-1:]))
+            return True, pos
+        return False, len(buff)
+
+    def put_data(self, buff, anchor_only=False, start=0):
         """
             Used to process ASCII data returned by 'less' over ssh
             @param buff - data to process
             @param anchor_only - Used if you need to find anchors in input stream only
+            @param start - position in buff the data starts at
+            @return position in buff the processed part ends at,
+                    the rest follows the anchor
         """
-        found = False
-        for i,ch in enumerate(buff):
-            
-            #seeking for anchor
-            updated = []
-            for text, pos, lenh in self.anchor:
-                if ch == text[pos]:
-                    pos = pos+1
-                    if pos == lenh:
-                        if self._skip_prompt:
-                            self._skip_prompt = False
-                            pos = 0
-                        else:
-                            logger.info("Pattern '%s' was found"%repr_unprint(text))
-                            self.last_anchor = text 
-                            self.anchor = []
-                            if i<len(buff)-1:
-                                logger.warning("Pattern was found but buffer is not empty: %s"%repr_unprint(buff[i:]))
-                            found = True
-                            break
-                else:
-                    pos = 0        
-                updated.append((text,pos,lenh,))
-            if not anchor_only: self._put_char(ch)
-            if found: 
-                self._ESC_mode = None
-                break
-            self.anchor = updated
+        found, end = self._seek_anchor(buff, start)
+        if not anchor_only: self._put_chunk(buff, end, start)
+        if found: 
+            self._ESC_mode = None
+        return end
 
     def anchor_found(self):
-        return self.anchor == []
+        return self._matcher is None
         
     def curr_line(self):
-        return self._buff[self.posy-1].getvalue()
+        row = self._row(self.posy)
+        off = row*self.cols
+        return self._view[off:off+self._len[row]].tobytes()
+
+    def screen_rows(self):
+        """ @return list of texts of screen rows but the last one,
+                    text ends with '\\n' unless the line continues on the next row.
+            Only rows changed since the previous call are rendered.
+        """
+        view, cols, lens, texts = self._view, self.cols, self._len, self._text
+        rows = []
+        for y in range(1, self.rows):
+            row = self._row(y)
+            text = texts[row]
+            if text is None:
+                text = view[row*cols:row*cols+lens[row]].tobytes()
+                if not self._wrap[row]:
+                    text = text + '\n'
+                texts[row] = text
+            rows.append(text)
+        return rows
 
     def __repr__(self):
         ''' Returns buffer representation. Ignores last line '''
-        nl =  lambda row: '\n' if not self._wrap[row] else '' 
-        text = [self._buff[row].getvalue() + nl(row)  for row in range(self.rows-1)]
-        return ''.join(text)
+        return ''.join(self.screen_rows())
     
+class _Step(object):
+    """ Single command sent to 'less' while a request is served """
+    __slots__ = ('task', 'arg', 'target', 'absolute', 'batch', 'typed')
+
+    def __init__(self, task, arg=None, target=None, absolute=False, batch=False, typed=False):
+        self.task = task
+        self.arg = arg          # lines to move by for FWD/BACK, position for POS
+        self.target = target    # page 'less' moves to, None if unknown
+        self.absolute = absolute    # True if the step sets a new origin
+        self.batch = batch      # the screen is one of pages requested by PAGES
+        self.typed = typed      # keys were sent along with the previous step
+
+
 class PlugLess(PlugGeneric):
     # cmd ::= ('cmd_name',('anchor1','anchor2',...))
     OPEN = ('open', (_ESC_POSITIVE+_ESC_ERASE_RIGHT, '(END) \x1b', 'No such file'))
     CLOSE = ('close', (_ESC_ERASE_RIGHT,''))
-    FWD = ('fwd', (':'+_ESC_ERASE_RIGHT, '(END) \x1b'))
+    FWD = ('fwd', (':'+_ESC_ERASE_RIGHT, '(END) \x1b'))   # FWD and BACK take number of pages
     REDRAW = ('redraw', (':'+_ESC_ERASE_RIGHT, '(END) \x1b'))
     BACK = ('back', (':'+_ESC_ERASE_RIGHT, '\x07\x0d\x1b'))
     POS = ('pos', (';1H\x0d\x1b[K:', '(END) \x1b', ':'+_ESC_ERASE_RIGHT))
-    TASKS = [OPEN, CLOSE, FWD, BACK, POS, REDRAW]
+    LINE = ('line', POS[1])     # argument is offset of the line start
+    PAGES = ('pages', FWD[1])   # argument is number of pages to go forward by
+    TASKS = [OPEN, CLOSE, FWD, BACK, POS, LINE, PAGES, REDRAW]
+    MATCHERS = dict((task, AnchorMatcher(task[1])) for task in TASKS)
             
-    
-    REDRAW_AFTER_BACK = True    # BACK or POS commands cause 'less' to draw screen upside down
-                                # so it is impossible to determine line wrap
-                                # Set the flag to 'True' to redraw screen after BACK or POS commands 
 
     def __init__(self, **kwargs):
         PlugGeneric.__init__(self, **kwargs)
@@ -309,38 +639,294 @@ class PlugLess(PlugGeneric):
         self.launched = False
         self._first_screen = True
         self._last_screen = False
+        self._steps = deque()   # steps left to serve the current request
+        self._step = None
+
+        # Pages are cached by (origin, page) where origin is the last absolute
+        # move (open or pos) and page is a number of screens moved from it.
+        # None in _origin means position is unknown and cache is not used,
+        # None in _less_page means 'less' is not aligned to the pages grid
+        cache_size = kwargs.get('cache_size', PAGE_CACHE_SIZE)
+        self.cache = PageCache(cache_size) if cache_size else None
+        self._origin = None
+        self._page = 0          # page shown to the client
+        self._less_page = None  # page shown by 'less'
+        self._result = None     # page text taken from cache
+        self._file_id = None    # (inode, size) of the file
+        self._file_checked = 0
+        self._file_checking = False
+
+        # Pages next to the client's one may be fetched in background
+        self.prefetch_pages = kwargs.get('prefetch', 0) if self.cache is not None else 0
+        self.prefetch_back = kwargs.get('prefetch_back', False) if self.cache is not None else False
+        self._background = False    # the current request is a prefetch
+        self._client_flags = None   # (first, last) of client's page while prefetching
+        self._deferred = None       # client's request which waits for prefetch
+        self._pages = None          # pages captured by PAGES request
+        self._batch_done = False    # the end was reached by PAGES request
     
     def put_request(self, new_task, args=None):
-        assert not self.has_task, "Unable to add a new request: in progress"
+        assert not self.has_task or self._background and not self._deferred, \
+                "Unable to add a new request: in progress"
         assert new_task in self.TASKS, "Unknown new task %s"%new_task
         
-        if self._first_screen and new_task==self.BACK or \
-            self._last_screen and new_task==self.FWD:
-            logger.error(self.name+"Cannot move beyond")
+        if self._background:
+            first, last = self._client_flags
+        else:
+            first, last = self._first_screen, self._last_screen
+        if first and new_task==self.BACK or last and new_task in [self.FWD, self.PAGES]:
+            logger.error("Cannot move beyond")
             raise PlugLessException("Cannot move beyond")      
 
         if not self.launched and new_task!=self.OPEN:
             raise PlugLessException("Open first!")
 
+        self._result = None
+        self._pages = None
+        self.result_ready = False
+        if self._from_cache(new_task, args):
+            self.result_ready = True    # even if prefetch is running
+            return
 
-        logger.info("New task: '%s'", new_task[0])
+        if self.has_task:
+            logger.info("Task '%s' waits for prefetch to complete", new_task[0])
+            self._deferred = (new_task, args)
+            return
+
+        self._start_request(new_task, args)
+
+    def _start_request(self, new_task, args=None):
+        """ Plans steps needed to complete new_task and starts the first one """
+        self._steps.clear()
+        if new_task in [self.FWD, self.BACK, self.REDRAW] and self._origin is not None:
+            self._plan_move(self._move_target(new_task, args))
+        elif new_task in [self.FWD, self.BACK] and _batch_count(args) > 1:
+            lines = _batch_count(args)*(self.screen_buff.rows - 1)
+            self._steps.append(_Step(new_task, lines))
+        elif new_task in [self.POS, self.LINE]:
+            self._steps.append(_Step(new_task, args, 0, absolute=True))
+        elif new_task == self.OPEN:
+            self._steps.append(_Step(self.OPEN, target=0, absolute=True))
+        elif new_task == self.PAGES:
+            self._plan_pages(_batch_count(args))
+        else:
+            self._steps.append(_Step(new_task))
         self.has_task = True
+        self._next_step()
+
+    def _move_target(self, task, count):
+        """ @return page FWD, BACK or REDRAW by count pages moves the client to """
+        step = {self.FWD: 1, self.BACK: -1, self.REDRAW: 0}[task]
+        target = self._page + step*_batch_count(count)
+        if self._origin[0] == 'open':
+            target = max(target, 0)
+        return target
+
+    def _plan_move(self, target):
+        """ Adds steps which move 'less' to the target page """
+        rows = self.screen_buff.rows - 1
+        start = self._less_page
+        if start is None:
+            # 'less' is not aligned to pages, return it to the origin first
+            if self._origin[0] == 'line':
+                self._steps.append(_Step(self.LINE, self._origin[1], 0))
+            else:
+                pos = self._origin[1] if self._origin[0] == 'pos' else 0
+                self._steps.append(_Step(self.POS, pos, 0))
+            start = 0
+        lines = (target - start)*rows
+        if lines > 0:
+            self._steps.append(_Step(self.FWD, lines if lines != rows else None, target))
+        elif lines < 0:
+            self._steps.append(_Step(self.BACK, -lines if lines != -rows else None, target))
+        elif self._less_page is not None:
+            self._steps.append(_Step(self.REDRAW, target=target))
+
+    def _plan_pages(self, count):
+        """ Adds steps which capture count pages going forward.
+            Keys of all pages are sent at once, every page is taken
+            when its prompt is drawn.
+        """
+        self._pages = []
+        self._batch_done = False
+        start = None
+        if self._origin is not None:
+            if self._less_page != self._page:
+                self._plan_move(self._page)
+            start = self._page
+        for n in range(1, count+1):
+            target = start+n if start is not None else None
+            self._steps.append(_Step(self.FWD, count if n==1 else None, target,
+                                     batch=True, typed=n>1))
+
+    def _batch_page(self):
+        """ Keeps the screen as one of pages requested by PAGES """
+        self._cache_page()
+        self._pages.append(repr(self.screen_buff))
+        self._batch_done = self._last_screen
+
+    def _next_step(self):
+        step = self._step = self._steps.popleft()
+        new_task = step.task
+        logger.info("New task: '%s'", new_task[0])
         self.task = new_task
-        self.screen_buff.wait_new_anchor(new_task[1])
+        self.screen_buff.wait_new_anchor(self.MATCHERS[new_task])
         self.screen_buff.line_counter = 0            
-        if self.task == self.OPEN:
+        if step.typed:
+            pass
+        elif step.batch:
+            self.cmd_pages(step.arg)
+        elif self.task == self.OPEN:
             self.cmd_open()
         elif self.task == self.CLOSE:
             self.cmd_close()
         elif self.task == self.FWD:
-            self.cmd_fwd()
+            self.cmd_fwd(step.arg)
         elif self.task == self.BACK:
-            self.cmd_back()
+            self.cmd_back(step.arg)
+        if self.task in [self.FWD, self.BACK] and step.arg and not step.batch:
+            # typed number is echoed with the prompt
+            self.screen_buff.set_skip_prompt()
         elif self.task == self.POS:
-            self.cmd_pos(args)
+            step.arg = self.cmd_pos(step.arg)
+            self.screen_buff.set_skip_prompt()
+        elif self.task == self.LINE:
+            step.arg = self.cmd_line(step.arg)
             self.screen_buff.set_skip_prompt()
         elif self.task == self.REDRAW:
             self.cmd_redraw()
+
+    def _from_cache(self, task, count=None):
+        """ Takes result of FWD, BACK or REDRAW from the page cache
+            @return True if the page has been found
+        """
+        if not self.cache or task not in [self.FWD, self.BACK, self.REDRAW] or \
+                self._origin is None:
+            return False
+        target = self._move_target(task, count)
+        page = self.cache.get((self._origin, target))
+        if page is None:
+            return False
+        logger.info("Page %d is taken from cache", target)
+        self._result, flags = page
+        self._page = target
+        if self._background:
+            self._client_flags = flags
+        else:
+            self._first_screen, self._last_screen = flags
+            self.task = None
+        return True
+
+    def prefetch(self):
+        """ Starts fetching a page next to the client's one in background
+            @return True if prefetch was started
+        """
+        if self.has_task or not self.prefetch_pages or self._origin is None \
+                or not self.launched:
+            return False
+        target = None
+        page, last = self._page, self._last_screen
+        for n in range(self.prefetch_pages):
+            if last:
+                break
+            cached = self.cache.peek((self._origin, page+1))
+            if cached is None:
+                target = page+1
+                break
+            page, last = page+1, cached[1][1]
+        if target is None and self.prefetch_back and not self._first_screen and \
+                (self._origin, self._page-1) not in self.cache and \
+                (self._origin[0] == 'open' or self._page > 0):
+            target = self._page-1
+        if target is None:
+            return False
+
+        logger.info("Prefetching page %d", target)
+        self._background = True
+        self._client_flags = (self._first_screen, self._last_screen)
+        self._steps.clear()
+        self._plan_move(target)
+        self.has_task = True
+        self._next_step()
+        return True
+
+    def _update_position(self):
+        """ Tracks position of 'less' when the current step is over """
+        step = self._step
+        target = step.target
+        if step.absolute:
+            if step.task in [self.POS, self.LINE]:
+                self._origin = (step.task[0], step.arg)
+            else:
+                self._origin = ('open',) if self.launched else None
+        elif target is None:
+            self._origin = None
+        elif step.task == self.BACK and self.screen_buff.last_anchor == self.BACK[1][1]:
+            target = self._less_page    # 'less' has not moved
+        elif step.task == self.FWD and not step.batch and step.arg \
+                and step.arg > self.screen_buff.rows-1 \
+                and self.screen_buff.last_anchor == self.FWD[1][1]:
+            # move by several pages has been stopped by the end of file somewhere
+            self._origin = None
+        
+        if self._origin is None:
+            self._less_page = None
+            return
+        if target < 0 and self._origin[0] != 'open':
+            # may have been stopped by the beginning of file
+            self._origin = None
+            self._less_page = None
+            return
+        if self._origin[0] == 'open' and target == 0:
+            self._first_screen = True
+        self._less_page = target
+        if not self._background:
+            self._page = target
+
+    def _cache_page(self):
+        """ Puts the screen into page cache when the current request is over """
+        if self.cache is None or self._origin is None or self._less_page is None:
+            return
+        self.cache.put((self._origin, self._less_page), repr(self.screen_buff),
+                       (self._first_screen, self._last_screen))
+        if self._last_screen:
+            # the last move might be shorter than a screen
+            self._less_page = None
+
+    def has_file_check(self):
+        return self.cache is not None
+
+    def start_file_check(self):
+        if not self.cache or not self.launched or self._file_checking:
+            return False
+        if self._file_checked + PAGE_CACHE_CHECK_PERIOD > time.time():
+            return False
+        self._file_checking = True
+        return True
+
+    def stat_file(self):
+        """ Blocking call
+            @return (inode, size) of the remote file
+        """
+        out, err = self.ssh.exec_remote("stat -L -c '%i %s' "+pipes.quote(self.log_path))
+        if err or not out:
+            raise PlugLessException("Unable to stat '%s': %s"%(self.log_path, ' '.join(err)))
+        inode, size = out[0].split()
+        return (int(inode), int(size))
+
+    def file_checked(self, file_id, error=None):
+        """ Drops page cache if the file was changed since the previous check
+            @param file_id - result of stat_file()
+        """
+        self._file_checking = False
+        self._file_checked = time.time()
+        if error:
+            logger.warning("File check has failed: %s"%str(error))
+            return
+        if self._file_id is not None and file_id != self._file_id:
+            logger.info("File has been changed, page cache is dropped")
+            self.cache.clear()
+        self._file_id = file_id
         
     def check_response(self):
         """
@@ -348,20 +934,27 @@ class PlugLess(PlugGeneric):
             @return True if task was finished or if there is no tasks currently
                     False otherwise 
         """
-        if self.channel.recv_ready():
-            buff = self.channel.recv(256)
+        buff = self.recv_all()
+        if buff and logger.isEnabledFor(logging.DEBUG):
             logger.debug("new_data:\n"+repr_unprint(buff))
-        else:    
-            buff = ''
         
-        if self.has_task and buff:        
-            self.screen_buff.put_data(buff, anchor_only=(self.REDRAW_AFTER_BACK and self.task in [self.BACK, self.POS]))
-            if self.screen_buff.anchor_found():
+        pos = 0
+        while self.has_task and pos < len(buff):
+            scan_start = time.time()
+            pos = self.screen_buff.put_data(buff, start=pos)
+            ANCHOR_SCAN.observe(time.time()-scan_start)
+            if not self.screen_buff.anchor_found():
+                return False
 
-                if self.task in [self.FWD, self.POS]: self._first_screen = False
-                if self.task in [self.BACK, self.POS]: self._last_screen = False
+            step = self._step
+            if step.batch and self._batch_done:
+                # 'less' has reached the end, keys left are answered by '(END)'
+                pass
+            else:
+                if self.task in [self.FWD, self.POS, self.LINE]: self._first_screen = False
+                if self.task in [self.BACK, self.POS, self.LINE]: self._last_screen = False
                 if self.screen_buff.last_anchor == self.task[1][1]:
-                    if self.task in [self.OPEN, self.FWD, self.POS]:
+                    if self.task in [self.OPEN, self.FWD, self.POS, self.LINE]:
                         self._last_screen = True
                         logger.info("Last screen is reached")
                     if self.task==self.BACK:
@@ -375,25 +968,46 @@ class PlugLess(PlugGeneric):
                     else:
                         logger.warning("File was not found!")
                 
-                if self.REDRAW_AFTER_BACK:
-                    if self.task in [self.BACK, self.POS]:
-                        self.has_task = False
-                        self.put_request(self.REDRAW)
-                        return False
-
-                self.has_task = False
-                self.task = None
-                logger.info("LINE counter = %d"%self.screen_buff.line_counter)
-                return True
-
-        elif not self.has_task:
+                self._update_position()
+                if step.batch:
+                    self._batch_page()
+            if self._steps:
+                self._next_step()
+                continue    # the rest of buff belongs to the next step
+
+            if not step.batch:
+                self._cache_page()
+            self.has_task = False
+            self.task = None
+            logger.info("LINE counter = %d"%self.screen_buff.line_counter)
+            if self._background:
+                return self._prefetched()
             return True
-        
+
+        return not self.has_task
+
+    def _prefetched(self):
+        """ Completes prefetch, starts client's request if it was deferred
+            @return True if client's request is completed
+        """
+        self._background = False
+        self._first_screen, self._last_screen = self._client_flags
+        if not self._deferred:
+            return True
+        new_task, args = self._deferred
+        self._deferred = None
+        if self._from_cache(new_task, args):
+            return True
+        self._start_request(new_task, args)
         return False
         
     def get_result(self):
-        if self.has_task:
+        if self.has_task and not self.result_ready:
             logger.error("Trying to read while task is not completed")
+        if self._pages is not None:
+            return list(self._pages)
+        if self._result is not None:
+            return self._result
         return repr(self.screen_buff)
     
     def cmd_open(self):
@@ -402,20 +1016,33 @@ class PlugLess(PlugGeneric):
         cmd_line = 'less '+self.log_path + '\n' 
         self.channel.send(cmd_line)
 
-    def cmd_fwd(self):
+    def cmd_fwd(self, lines=None):
+        self.flush()
+        if lines:
+            logger.info("going forward by %d lines"%lines)
+            self.channel.send('%df'%lines)
+        else:
+            logger.info("going forward")
+            self.channel.send('f')
+
+    def cmd_pages(self, count):
         self.flush()
-        logger.info("going forward")
-        self.channel.send('f')
+        logger.info("going forward by %d pages"%count)
+        self.channel.send('f'*count)
 
     def cmd_redraw(self):
         self.flush()
         logger.info("redraw")
         self.channel.send('r')
 
-    def cmd_back(self):
+    def cmd_back(self, lines=None):
         self.flush()
-        logger.info("going back")
-        self.channel.send('b')
+        if lines:
+            logger.info("going back by %d lines"%lines)
+            self.channel.send('%db'%lines)
+        else:
+            logger.info("going back")
+            self.channel.send('b')
 
     def cmd_close(self):
         self.flush()
@@ -434,6 +1061,447 @@ class PlugLess(PlugGeneric):
         else:
             logger.info("moving to %f%%"%fl_pos)
         self.channel.send('%f%%'%fl_pos)
+        return fl_pos
+
+    def cmd_line(self, offset):
+        self.flush()
+        offset = max(0, int(offset))
+        logger.info("moving to offset %d"%offset)
+        self.channel.send('%dP'%offset)
+        return offset
+
+    def position(self):
+        """ Line number is known on the page 'less' was moved to only """
+        line = None
+        if self._origin is not None and self._page == 0:
+            if self._origin[0] == 'open':
+                line = 1
+            elif self._origin[0] == 'line' and self._located and \
+                    self._located[0] == self._origin[1]:
+                line = self._located[1]+1
+        lines = self.index.total_lines() if self.index else None
+        if line is None and lines is None:
+            return None
+        return (line, lines)
+
+class PlugRange(PlugGeneric):
+    """ Pages through the file by reading byte ranges of it over SFTP,
+        'less' is not used.
+
+        Pages have the same format as PlugLess ones: rows-1 screen rows,
+        every row is ended by '\n' unless the line is wrapped.
+        Every byte takes one column, but rows are not cut inside UTF-8 chars.
+        All requests are blocking calls.
+    """
+    BLOCKING = True
+
+    def __init__(self, **kwargs):
+        PlugGeneric.__init__(self, **kwargs)
+
+        self.log_path = kwargs.get('path', '/var/log/dmesg')
+        self.cols = kwargs.get('cols', 80)
+        self.rows = kwargs.get('rows', 24) - 1   # the last row is kept for the prompt
+
+        self.has_task = False
+        self.launched = False
+        self.size = 0           # file size known by the last OPEN or POS
+        self.top = 0            # offset of the first byte shown
+        self.bottom = 0         # offset right after the last byte shown
+        self.line = None        # number of the line at top, starting from 0
+        self._last_read = (0, '')   # (offset, data) of the last range read
+        self._file = None           # ssh_channel.RemoteFile of the log
+        self._first_screen = True
+        self._last_screen = False
+        self._page = ''
+        self._pages = None      # pages read by PAGES request
+        self._lock = threading.Lock()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._ssh_owner:
+            self.ssh.close()
+        self.launched = False
+
+    def put_request(self, new_task, args=None):
+        if not self._lock.acquire(False):
+            raise PlugLessException("Unable to add a new request: in progress")
+        try:
+            self.has_task = True
+            assert new_task in PlugLess.TASKS, "Unknown new task %s"%new_task
+            if self._first_screen and new_task==PlugLess.BACK or \
+                    self._last_screen and new_task in [PlugLess.FWD, PlugLess.PAGES]:
+                logger.error("Cannot move beyond")
+                raise PlugLessException("Cannot move beyond")
+            if new_task!=PlugLess.OPEN and not self.launched:
+                raise PlugLessException("File is not opened")
+            self._pages = None
+
+            if new_task==PlugLess.OPEN:
+                self._open()
+            elif new_task==PlugLess.CLOSE:
+                self.launched = False
+            elif new_task==PlugLess.FWD:
+                for n in range(_batch_count(args)):
+                    self._show(self.bottom)
+                    if self._last_screen:
+                        break
+            elif new_task==PlugLess.BACK:
+                self._show(self._rows_before(self.top, self.rows*_batch_count(args)))
+            elif new_task==PlugLess.POS:
+                self._show(self._pos_offset(args))
+            elif new_task==PlugLess.LINE:
+                self._show(max(0, int(args)))
+            elif new_task==PlugLess.PAGES:
+                self._pages = []
+                for n in range(_batch_count(args)):
+                    self._show(self.bottom)
+                    self._pages.append(self._page)
+                    if self._last_screen:
+                        break
+            else:
+                self._show(self.top)
+        finally:
+            self.has_task = False
+            self._lock.release()
+        return False
+
+    def check_response(self):
+        return True
+
+    def get_result(self):
+        if self._pages is not None:
+            return list(self._pages)
+        return self._page
+
+    def _open(self):
+        logger.info("opening '%s'"%self.log_path)
+        try:
+            if self._file is None:
+                self._file = self.ssh.open_file(self.log_path)
+            self.size = self._file.size()
+        except IOError as e:
+            logger.warning("Unable to open '%s': %s"%(self.log_path, str(e)))
+            self.launched = False
+            self._page = str(e)
+            return
+        self.launched = True
+        self.line = 0
+        self._show(0)
+
+    def _pos_offset(self, pos):
+        """ @return offset of the line start nearest to pos percents of the file """
+        try:
+            fl_pos = float(pos)
+            assert fl_pos<=100 and fl_pos>=0
+        except:
+            logger.warning("wrong position to move: '%s', moving to 0%%"%pos)
+            fl_pos = 0
+        else:
+            logger.info("moving to %f%%"%fl_pos)
+        self.size = self._file.size()
+        offset = int(self.size*fl_pos/100)
+        if offset==0 or offset>=self.size:
+            return offset
+        data = self._read(offset-1, self.rows*(self.cols+1))
+        nl = data.find('\n')
+        return offset if nl==-1 else offset+nl
+
+    def _read(self, offset, length):
+        data = self._file.read(offset, length)
+        self._last_read = (offset, data)
+        return data
+
+    def _line_at(self, offset, ref, ref_line):
+        """ @return number of the line which contains offset or None
+            @param ref, ref_line - offset and number of a known line
+        """
+        if offset==0:
+            return 0
+        if self._located and self._located[0]==offset:
+            return self._located[1]
+        start, data = self._last_read
+        low, high = min(offset, ref), max(offset, ref)
+        if ref_line is not None and start<=low and high<=start+len(data):
+            count = data.count('\n', low-start, high-start)
+            return ref_line+count if offset>=ref else ref_line-count
+        if self.index is not None:
+            return self.index.line_at(self.ssh, self.log_path, offset)
+        return None
+
+    def position(self):
+        line = self.line+1 if self.line is not None else None
+        lines = self.index.total_lines() if self.index else None
+        if line is None and lines is None:
+            return None
+        return (line, lines)
+
+    def _show(self, top):
+        """ Makes the page which starts at top, the last page of the file
+            is always a full screen
+        """
+        line = self._line_at(top, self.top, self.line)
+        rows, bottom, at_end = self._render(top)
+        if at_end and len(rows)<self.rows and top>0:
+            full_top = self._rows_before(bottom, self.rows)
+            line = self._line_at(full_top, top, line)
+            top = full_top
+            rows, bottom, at_end = self._render(top)
+        self.line = line
+        self.top = top
+        self.bottom = bottom
+        self._first_screen = top==0
+        self._last_screen = at_end
+        page = [text if wrap else text+'\n' for text, wrap in rows]
+        page.append('\n'*(self.rows-len(rows)))
+        self._page = ''.join(page)
+
+    def _render(self, top):
+        """ @return (rows, bottom, at_end) where rows is a list of (text, wrap) """
+        length = self.rows*(self.cols+1)    # enough for any screen
+        data = self._read(top, length)
+        eof = len(data)<length
+        rows = []
+        pos = 0
+        while len(rows)<self.rows and pos<len(data):
+            nl = data.find('\n', pos, pos+self.cols+1)
+            if nl!=-1:
+                rows.append((data[pos:nl].rstrip('\r'), False))
+                pos = nl+1
+            elif eof and len(data)-pos<=self.cols:
+                rows.append((data[pos:], False))    # the last line has no '\n'
+                pos = len(data)
+            else:
+                cut = self._row_end(data, pos)
+                rows.append((data[pos:cut], True))
+                pos = cut
+        return rows, top+pos, eof and pos==len(data)
+
+    def _row_end(self, data, pos):
+        """ @return offset in data where the wrapped row started at pos ends """
+        end = pos + self.cols
+        if end >= len(data):
+            return end
+        return _char_start(data, end, pos)
+
+    def _row_starts(self, data, start, end):
+        """ @return offsets in data of the rows the line data[start:end] takes """
+        starts = [start]
+        while end - starts[-1] > self.cols:
+            starts.append(self._row_end(data, starts[-1]))
+        return starts
+
+    def _rows_before(self, end, count):
+        """ @return offset of the screen row which is count rows above end """
+        want = count*(self.cols+1)
+        while True:
+            start = max(0, end-want)
+            data = self._read(start, end-start)
+            starts = []             # row starts, the nearest to end goes first
+            line_end = len(data)
+            cut = True              # the line is cut by end
+            while len(starts)<count:
+                nl = data.rfind('\n', 0, line_end)
+                if nl==-1 and start>0 and want<RANGE_BACK_READ_LIMIT:
+                    break           # line start is not read yet
+                if not cut or line_end>nl+1:
+                    starts.extend(start+row for row in
+                                  reversed(self._row_starts(data, nl+1, line_end)))
+                if nl==-1:
+                    break
+                line_end = nl
+                cut = False
+            if len(starts)>=count:
+                return starts[count-1]
+            if start==0 or want>=RANGE_BACK_READ_LIMIT:
+                return starts[-1] if starts else start
+            want *= 2
+
+
+class PlugSearch(PlugGeneric):
+    """ Searches the log for a regular expression by remote 'grep'.
+
+        Forward search starts at the offset (the file start by default) and goes
+        to the end of file, backward search takes the last matches before the
+        offset (the end of file by default).
+        Matches are taken from the channel as 'grep' finds them, every
+        match is {'line', 'offset', 'text', 'before', 'after'} where line
+        starts from 1 and before/after are lists of context lines.
+    """
+    # output line of grep -n -b: line number, ':' for a match or '-' for context, offset
+    _GREP_LINE = re.compile(r'(\d+)([:-])(\d+)[:-]')
+
+    def __init__(self, **kwargs):
+        PlugGeneric.__init__(self, **kwargs)
+        self.log_path = kwargs.get('path', '/var/log/dmesg')
+        self.pattern = kwargs.get('pattern', '')
+        self.backward = kwargs.get('direction', 'fwd') == 'back'
+        offset = kwargs.get('offset')
+        self.offset = int(offset) if offset not in (None, '') else None
+        self.limit = max(1, min(int(kwargs.get('limit') or SEARCH_LIMIT), SEARCH_LIMIT))
+        self.context = max(0, min(int(kwargs.get('context') or 0), SEARCH_CONTEXT_LIMIT))
+        self.done = False
+        self.error = None
+        self._buff = ''
+        self._base = None       # number of lines before the searched part
+        self._hits = []         # matches found but not taken by get_result()
+        self._before = deque(maxlen=self.context)   # context lines seen after the last match
+        self._errors = []       # output lines which are not grep results
+
+    def put_request(self):
+        """ Blocking call, starts the search """
+        grep = "grep -a -b -n -E -e %s"%pipes.quote(self.pattern)
+        if self.context:
+            grep = grep + " -C %d"%self.context
+        path = pipes.quote(self.log_path)
+        if self.backward:
+            part = "cat %s"%path if self.offset is None else "head -c %d %s"%(self.offset, path)
+            cmd = "echo 0; %s | %s | tail -n %d"%(part, grep, self.limit*(2*self.context+2))
+        else:
+            offset = self.offset or 0
+            cmd = "head -c %d %s | wc -l; tail -c +%d %s | %s -m %d" \
+                  %(offset, path, offset+1, path, grep, self.limit)
+        logger.info("searching '%s' in '%s'"%(self.pattern, self.log_path))
+        self.channel = self.ssh.exec_channel("LC_ALL=C; export LC_ALL; "+cmd)
+
+    def check_response(self):
+        """ @return True if there are new matches or the search is over """
+        data = self.recv_all()
+        if data:
+            self._buff = self._buff + data
+        elif not self.channel.recv_ready() and (self.channel.eof_received or self.channel.closed):
+            self.done = True
+        lines = self._buff.split('\n')
+        self._buff = lines.pop()
+        if self.done and self._buff:
+            lines.append(self._buff)
+            self._buff = ''
+        for line in lines:
+            self._parse(line)
+        if self.done:
+            self._finish()
+        return self.done or self._ready() > 0
+
+    def _parse(self, line):
+        if self._base is None:
+            try:
+                self._base = int(line)
+            except ValueError:
+                self._errors.append(line)
+            return
+        m = self._GREP_LINE.match(line)
+        if not m:
+            if line != '--':
+                self._errors.append(line)
+            return
+        num = self._base + int(m.group(1))
+        offset = int(m.group(3)) + (0 if self.backward else self.offset or 0)
+        text = line[m.end():m.end()+SEARCH_TEXT_LIMIT].decode('utf-8', 'replace')
+        if m.group(2) == ':':
+            self._hits.append({'line': num, 'offset': offset, 'text': text,
+                               'before': list(self._before), 'after': []})
+            self._before.clear()
+            return
+        if self._hits and num - self._hits[-1]['line'] <= self.context:
+            self._hits[-1]['after'].append(text)
+        self._before.append(text)
+
+    def _ready(self):
+        """ @return number of matches which will get no more context lines,
+                    backward search takes matches when it is over
+        """
+        if self.backward and not self.done:
+            return 0
+        if self.done or not self.context:
+            return len(self._hits)
+        return len(self._hits) - 1 if self._hits else 0
+
+    def _finish(self):
+        if self.backward:
+            # nearest matches go first
+            self._hits = self._hits[-self.limit:]
+            self._hits.reverse()
+        if self._errors and not self._hits:
+            self.error = ' '.join(self._errors)
+            logger.warning("search has failed: %s"%self.error)
+
+    def get_result(self):
+        """ @return list of matches found since the previous call """
+        count = self._ready()
+        hits, self._hits = self._hits[:count], self._hits[count:]
+        return hits
+
+
+class PlugFollow(PlugGeneric):
+    """ Takes lines appended to the log by remote 'tail -F', which goes
+        on with the new file when the log is rotated.
+        Lines are kept until they are taken by get_result() as a batch.
+    """
+    def __init__(self, **kwargs):
+        PlugGeneric.__init__(self, **kwargs)
+        self.log_path = kwargs.get('path', '/var/log/dmesg')
+        self.dropped = 0        # lines dropped since the previous batch
+        self._buff = ''
+        self._lines = deque()
+        self._size = 0          # bytes of lines kept
+        self._since = None      # time the oldest line kept was received
+
+    def put_request(self):
+        """ Blocking call, starts following """
+        logger.info("following '%s'"%self.log_path)
+        self.channel = self.ssh.exec_channel("tail -n 0 -F %s 2>/dev/null"
+                                             %pipes.quote(self.log_path))
+
+    def check_response(self):
+        """ @return True if the batch is ready """
+        data = self.recv_all()
+        if data:
+            lines = (self._buff + data).split('\n')
+            self._buff = lines.pop()
+            if len(self._buff) >= FOLLOW_BATCH_SIZE:
+                lines.append(self._buff)    # too long to wait for its end
+                self._buff = ''
+            if lines and self._since is None:
+                self._since = time.time()
+            for line in lines:
+                self._lines.append(line)
+                self._size = self._size + len(line)
+        return self.batch_ready()
+
+    def batch_ready(self):
+        """ @return True if lines kept are enough or wait for too long """
+        if not self._lines:
+            return False
+        return self._size >= FOLLOW_BATCH_SIZE or \
+                self._since + FOLLOW_BATCH_DELAY <= time.time()
+
+    def batch_deadline(self):
+        """ @return time the batch gets ready by waiting, None if no lines are kept """
+        if not self._lines:
+            return None
+        return self._since + FOLLOW_BATCH_DELAY
+
+    def buffered(self):
+        """ @return number of lines kept """
+        return len(self._lines)
+
+    def drop(self, count):
+        """ Drops count oldest lines kept """
+        for n in range(min(count, len(self._lines))):
+            self._size = self._size - len(self._lines.popleft())
+            self.dropped = self.dropped + 1
+
+    def get_result(self):
+        """ @return (lines, number of lines dropped before them) """
+        lines = [line.decode('utf-8', 'replace') for line in self._lines]
+        dropped = self.dropped
+        self._lines.clear()
+        self._size = 0
+        self._since = None
+        self.dropped = 0
+        return lines, dropped
+
 
 class PlugLs(PlugGeneric):
     def __init__(self, **kwargs):
@@ -1,5 +1,20 @@
+import hashlib
+import logging
+import threading
+import time
 import paramiko
 
+POOL_IDLE_TIMEOUT = 120     # seconds unused connection is kept open
+POOL_HOST_LIMIT = 8         # max connections to the same host:port
+READ_AHEAD_SIZE = 256*1024  # bytes RemoteFile reads ahead of the requested range
+
+logger = logging.getLogger('lib.%s'%(__name__))
+logger.addHandler(logging.NullHandler())
+
+
+class SSHPoolException(Exception):
+    pass
+
 
 class SSHChannel(object):
 
@@ -19,6 +34,13 @@ class SSHChannel(object):
         self.client.set_missing_host_key_policy(paramiko.WarningPolicy())
         self.client.connect(self.host, self.port, self.user, self.secret)
         self.is_connected = True
+
+    def is_alive(self):
+        """ @return True if underlying transport is still active """
+        if not self.is_connected:
+            return False
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
    
     def get_shell(self):
         assert self.is_connected, "Not connected yet"
@@ -38,7 +60,205 @@ class SSHChannel(object):
         
         return (out_lines, err_lines)
 
+    def exec_channel(self, cmd):
+        """ Starts cmd without waiting for its output
+            @return channel the output is read from, stderr goes to stdout
+        """
+        assert self.is_connected, "Not connected yet"
+        channel = self.client.get_transport().open_session()
+        channel.set_combine_stderr(True)
+        channel.exec_command(cmd)
+        return channel
+
+    def open_file(self, path):
+        """ Blocking call
+            @return RemoteFile which reads the file over its own SFTP session
+        """
+        assert self.is_connected, "Not connected yet"
+        return RemoteFile(self.client.open_sftp(), path)
+
     def close(self):
         assert self.is_connected, "Not connected yet"
         self.client.close()
 
+
+class RemoteFile(object):
+    """ Random access reader of a remote file.
+
+        Every read which is not served by the read-ahead window fetches
+        the range and read_ahead bytes more in the direction of the read.
+        The whole range is requested by pipelined SFTP reads, so it takes
+        one round trip. All calls are blocking.
+    """
+    def __init__(self, sftp, path, read_ahead=READ_AHEAD_SIZE):
+        self.path = path
+        self.read_ahead = read_ahead
+        self._sftp = sftp
+        self._file = sftp.open(path, 'rb')
+        self._size = self._file.stat().st_size
+        self._offset = 0        # offset of the read-ahead window
+        self._buff = b''        # read-ahead window
+
+    def size(self):
+        """ @return size of the file, it is updated by the request """
+        self._size = self._file.stat().st_size
+        return self._size
+
+    def read(self, offset, length):
+        """ @return up to length bytes of the file starting at offset """
+        end = offset + length
+        if self._offset <= offset and end <= self._offset + len(self._buff):
+            return self._buff[offset-self._offset:end-self._offset]
+        if end > self._size:
+            self.size()     # file may have grown
+        if offset < self._offset:
+            # reading backwards
+            start, stop = max(0, end - max(length, self.read_ahead)), end
+        else:
+            start, stop = offset, offset + max(length, self.read_ahead)
+        stop = min(stop, self._size)
+        if stop <= start:
+            return b''
+        self._buff = b''.join(self._file.readv([(start, stop-start)]))
+        self._offset = start
+        return self._buff[offset-start:end-start]
+
+    def close(self):
+        self._buff = b''
+        try:
+            self._file.close()
+        finally:
+            self._sftp.close()
+
+
+class _PoolEntry(object):
+    def __init__(self, key, conn):
+        self.key = key
+        self.conn = conn
+        self.refs = 0
+        self.idle_since = None
+        self.ready = threading.Event()  # set when connection attempt is over
+        self.error = None
+
+
+class SSHPool(object):
+    """ Process-wide pool of SSH connections.
+
+        Connections are shared by all clients which use the same host, port,
+        user and secret, every user opens its own channels on the shared
+        transport. Connections are reference counted, unused ones are closed
+        after idle_timeout.
+    """
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, host_limit=POOL_HOST_LIMIT):
+        self.idle_timeout = idle_timeout
+        self.host_limit = host_limit
+        self._lock = threading.Lock()
+        self._entries = {}  # key: (host, port, user, secret fingerprint); value: _PoolEntry
+        self._by_conn = {}  # key: id(SSHChannel); value: _PoolEntry
+
+    @staticmethod
+    def _key(host, port, user, secret):
+        fingerprint = hashlib.sha256('%s\0%s'%(user, secret)).hexdigest()
+        return (host, port, user, fingerprint)
+
+    def acquire(self, host, port=22, user='', secret=''):
+        """ Returns connected SSHChannel, makes a new connection if 
+            there is no alive one for the same credentials.
+            Every acquire() must be paired with release().
+        """
+        key = self._key(host, port, user, secret)
+        owner = False
+        with self._lock:
+            self._expire()
+            entry = self._entries.get(key)
+            if entry and entry.ready.is_set() and not entry.conn.is_alive():
+                logger.info("Pooled connection to %s:%s is dead"%(host, port))
+                self._drop(entry)
+                entry = None
+            if entry is None:
+                self._check_host_limit(host, port)
+                entry = _PoolEntry(key, SSHChannel(host=host, port=port, user=user, secret=secret))
+                self._entries[key] = entry
+                self._by_conn[id(entry.conn)] = entry
+                owner = True
+            entry.refs = entry.refs + 1
+            entry.idle_since = None
+
+        if owner:
+            # handshake is made out of the lock, others wait for this entry only
+            try:
+                entry.conn.connect()
+            except Exception as e:
+                entry.error = e
+                with self._lock:
+                    entry.refs = 0
+                    self._forget(entry)
+                entry.ready.set()
+                raise
+            logger.info("New pooled connection to %s:%s"%(host, port))
+            entry.ready.set()
+        else:
+            entry.ready.wait()
+            if entry.error:
+                raise entry.error
+            logger.info("Reusing pooled connection to %s:%s"%(host, port))
+        return entry.conn
+
+    def release(self, conn):
+        """ Returns connection obtained by acquire() back to the pool """
+        with self._lock:
+            entry = self._by_conn.get(id(conn))
+            if entry is None or entry.conn is not conn:
+                logger.warning("Releasing connection which is not in the pool")
+                return
+            entry.refs = entry.refs - 1
+            if entry.refs <= 0:
+                entry.refs = 0
+                entry.idle_since = time.time()
+                if not entry.conn.is_alive():
+                    self._drop(entry)
+            self._expire()
+
+    def expire(self):
+        """ Closes connections which are unused longer than idle_timeout """
+        with self._lock:
+            self._expire()
+
+    def close(self):
+        """ Closes all unused connections """
+        with self._lock:
+            for entry in self._entries.values():
+                if entry.refs == 0:
+                    self._drop(entry)
+
+    def _expire(self):
+        now = time.time()
+        for entry in self._entries.values():
+            if entry.refs == 0 and entry.idle_since is not None and \
+                    entry.idle_since + self.idle_timeout < now:
+                logger.info("Closing idle connection to %s:%s"%entry.key[:2])
+                self._drop(entry)
+
+    def _check_host_limit(self, host, port):
+        same_host = [e for e in self._entries.values() if e.key[:2] == (host, port)]
+        if len(same_host) < self.host_limit:
+            return
+        idle = [e for e in same_host if e.refs == 0 and e.ready.is_set()]
+        if not idle:
+            raise SSHPoolException("Too many connections to %s:%s"%(host, port))
+        self._drop(min(idle, key=lambda e: e.idle_since))
+
+    def _forget(self, entry):
+        if self._entries.get(entry.key) is entry:
+            del self._entries[entry.key]
+        self._by_conn.pop(id(entry.conn), None)
+
+    def _drop(self, entry):
+        self._forget(entry)
+        try:
+            entry.conn.close()
+        except Exception as e:
+            logger.warning("Unable to close connection: %s"%str(e))
+
+
+SSH_POOL = SSHPool()
@@ -0,0 +1,20 @@
+import os, sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+from bench_util import fixture_paths, load_fixture
+import run
+
+
+class BenchTest(unittest.TestCase):
+    def test_replay(self):
+        """recorded fixtures are still served by PlugLess the way they were recorded"""
+        paths = fixture_paths()
+        self.assertTrue(paths)
+        for path in paths:
+            fixture = load_fixture(path)
+            self.assertTrue(run.bench_plug(fixture)() >= len(fixture['steps']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import event_loop
+import web_client
+import ssh_channel
+import json
+import select
+import socket
+import time
+import unittest
+from mock import Mock, patch
+
+
+class ExecutorTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.ex = event_loop.Executor(workers=2)
+
+    def tearDown(self):
+        self.ex.close()
+
+    def wait_callbacks(self):
+        r,w,x = select.select([self.ex], [], [], 5)
+        self.assertEqual(r, [self.ex])
+        return self.ex.run_callbacks()
+
+    def test_result(self):
+        """callback gets result of the call made by worker"""
+        callback = Mock()
+        self.ex.submit('owner', lambda a, b: a+b, (1, 2), callback)
+        self.assertEqual(self.wait_callbacks(), ['owner'])
+        callback.assert_called_with(3, None)
+
+    def test_error(self):
+        """callback gets exception raised by the call"""
+        callback = Mock()
+        err = ValueError('bad')
+        def fail():
+            raise err
+        self.ex.submit('owner', fail, (), callback)
+        self.assertEqual(self.wait_callbacks(), ['owner'])
+        callback.assert_called_with(None, err)
+
+
+class EventLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(5)
+        self.loop = event_loop.EventLoop(self.server, web_client.WebClient, workers=1)
+        self.clients = []
+
+    def tearDown(self):
+        self.loop.close()
+        self.server.close()
+        [c.close() for c in self.clients]
+
+    def new_client(self):
+        c = socket.create_connection(self.server.getsockname())
+        c.settimeout(5)
+        self.clients.append(c)
+        self.loop.run_once(1)
+        return c
+
+    def read_answer(self, c):
+        data = ''
+        while not data.endswith('\r\n'):
+            self.loop.run_once(0.1)
+            try:
+                c.setblocking(0)
+                data = data + c.recv(4096)
+            except socket.error:
+                pass
+        return json.loads(data)
+
+    @patch('ssh_channel.SSHChannel')
+    def test_connect(self, ssh):
+        """clients are served by one loop, blocking connect goes to executor"""
+        c1 = self.new_client()
+        c2 = self.new_client()
+        self.assertEqual(len(self.loop.clients), 2)
+
+        c1.sendall('{"cmd":"connect","host":"abc"}\r\n')
+        res = self.read_answer(c1)
+        self.assertEqual(res['res'], 'ok')
+        ssh.return_value.connect.assert_called_with()
+        
+        c2.sendall('{"cmd":"connect","host":"abc"}\r\n')
+        self.assertEqual(self.read_answer(c2)['res'], 'ok')
+        # both clients share the same pooled connection
+        self.assertEqual(ssh.return_value.connect.call_count, 1)
+        ssh_channel.SSH_POOL.close()
+
+    def test_disconnect(self):
+        """client is forgotten when its socket is closed"""
+        c = self.new_client()
+        c.close()
+        for i in range(10):
+            self.loop.run_once(0.1)
+            if not self.loop.clients:
+                break
+        self.assertEqual(self.loop.clients, [])
+        self.assertEqual(self.loop._fds, {})
+
+    def test_client_failure(self):
+        """client whose handler raises is dropped, others are served further"""
+        c1 = self.new_client()
+        c2 = self.new_client()
+        failing = [client for client in self.loop.clients
+                   if client.sock.getpeername() == c1.getsockname()][0]
+        with patch.object(failing, 'recv_from_client', side_effect=TypeError('boom')):
+            c1.sendall('{"cmd":"stats"}\r\n')
+            for i in range(10):
+                self.loop.run_once(0.1)
+                if len(self.loop.clients) == 1:
+                    break
+        self.assertNotIn(failing, self.loop.clients)
+        c2.sendall('{"cmd":"stats"}\r\n')
+        self.assertEqual(self.read_answer(c2)['res'], 'ok')
+
+    def test_call_soon(self):
+        """calls asked for by signal handlers wake the loop and are made by it"""
+        func = Mock()
+        self.loop.call_soon(func, 1, 2)
+        self.assertFalse(func.called)
+        start = time.time()
+        self.loop.run_once(5)
+        self.assertTrue(time.time() - start < 1)
+        func.assert_called_once_with(1, 2)
+
+    def test_deadline(self):
+        """client is expired when its deadline comes instead of every iteration"""
+        self.new_client()
+        client = self.loop.clients[0]
+        with patch.object(client, '_pool_expired') as expired:
+            self.loop.run_once(0)
+            self.assertFalse(expired.called)
+            client._timers.schedule(('session', 'xxx'), time.time())
+            self.loop._sync(client)
+            start = time.time()
+            self.loop.run_once(5)
+            self.assertTrue(time.time() - start < 1)
+            expired.assert_called_once_with()
+
+if __name__=='__main__':
+    unittest.main()
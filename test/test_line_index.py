@@ -0,0 +1,86 @@
+from line_index import LineIndex, LineIndexes
+import os, subprocess, tempfile
+import unittest
+from mock import Mock
+
+
+class LocalShell(object):
+    """ Runs 'remote' commands by local shell """
+    host = 'localhost'
+    port = 22
+
+    def exec_remote(self, cmd):
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
+        return (out.splitlines(), err.splitlines())
+
+
+class LineIndexTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.ssh = LocalShell()
+        self.text = ''
+
+    def append(self, text):
+        self.text += text
+        with open(self.path, 'ab') as f:
+            f.write(text)
+
+    def check(self, index):
+        starts = [0]+[i+1 for i, ch in enumerate(self.text) if ch == '\n']
+        for line in range(0, len(starts), 3):
+            self.assertEqual(index.offset_of(self.ssh, self.path, line), starts[line])
+            self.assertEqual(index.line_at(self.ssh, self.path, starts[line]+1), line)
+
+    def test_build(self):
+        """checkpoints are put every step lines, lines are counted"""
+        self.append(''.join('line %d\n'%i for i in range(25)))
+        index = LineIndex(step=10)
+        index.update(self.ssh, self.path)
+        self.assertEqual(index.lines, 25)
+        self.assertEqual(index.offsets, [0, 70, 150])
+        self.assertEqual(index.total_lines(), 25)
+        self.check(index)
+        self.assertEqual(index.offset_of(self.ssh, self.path, 100), len(self.text))
+
+    def test_extend(self):
+        """index is extended when file grows, incomplete line is indexed later"""
+        self.append(''.join('line %d\n'%i for i in range(8))+'incomplete')
+        index = LineIndex(step=5)
+        index.update(self.ssh, self.path)
+        self.assertEqual((index.lines, index.total_lines()), (8, 9))
+        self.assertEqual(index.line_at(self.ssh, self.path, len(self.text)), None)
+        self.append(' line\n'+''.join('line %d\n'%i for i in range(9, 20)))
+        index.update(self.ssh, self.path)
+        self.assertEqual(index.lines, 20)
+        self.assertEqual(len(index.offsets), 4)
+        self.check(index)
+
+    def test_replaced(self):
+        """index is rebuilt if the file is truncated"""
+        self.append('a\nb\nc\n')
+        index = LineIndex(step=2)
+        index.update(self.ssh, self.path)
+        open(self.path, 'w').close()
+        self.text = ''
+        self.append('x\n')
+        index.update(self.ssh, self.path)
+        self.assertEqual((index.lines, index.offsets), (1, [0]))
+
+
+class LineIndexesTest(unittest.TestCase):
+    def test_shared(self):
+        """same file on the same host shares the index"""
+        indexes = LineIndexes(max_files=2)
+        ssh = Mock(host='h', port=22)
+        index = indexes.get(ssh, '/a')
+        self.assertIs(indexes.get(Mock(host='h', port=22), '/a'), index)
+        self.assertIsNot(indexes.get(ssh, '/b'), index)
+        indexes.get(ssh, '/c')
+        self.assertIsNot(indexes.get(ssh, '/a'), index)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+from metrics import Registry, MetricsServer
+import urllib2
+import unittest
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        """counters are split by labels"""
+        c = self.registry.counter('bytes_total', 'Bytes', ('plug',))
+        c.inc(10, plug='PlugLess')
+        c.inc(5, plug='PlugLess')
+        c.inc(1, plug='PlugSearch')
+        self.assertEqual(self.registry.snapshot()['bytes_total'],
+                         [{'labels': {'plug': 'PlugLess'}, 'value': 15},
+                          {'labels': {'plug': 'PlugSearch'}, 'value': 1}])
+
+    def test_histogram(self):
+        """bucket counts are cumulative, +Inf bucket is the total count"""
+        h = self.registry.histogram('lat_seconds', 'Latency', ('cmd',), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            h.observe(value, cmd='log_next')
+        self.assertEqual(self.registry.snapshot()['lat_seconds'],
+                         [{'labels': {'cmd': 'log_next'},
+                           'value': {'count': 4, 'sum': 3.65, 'buckets': [[0.1, 2], [1, 3]]}}])
+        self.assertEqual(self.registry.prometheus_text().splitlines(),
+                         ['# HELP lat_seconds Latency',
+                          '# TYPE lat_seconds histogram',
+                          'lat_seconds_bucket{cmd="log_next",le="0.1"} 2',
+                          'lat_seconds_bucket{cmd="log_next",le="1.0"} 3',
+                          'lat_seconds_bucket{cmd="log_next",le="+Inf"} 4',
+                          'lat_seconds_sum{cmd="log_next"} 3.65',
+                          'lat_seconds_count{cmd="log_next"} 4'])
+
+    def test_gauge(self):
+        """gauges are collected when metrics are read, broken ones are skipped"""
+        values = {('a',): 1}
+        self.registry.gauge('depth', 'Depth', lambda: values, ('queue',))
+        self.registry.gauge('broken', 'Broken', lambda: 1/0)
+        values[('b',)] = 2
+        self.assertEqual(self.registry.prometheus_text().splitlines(),
+                         ['# HELP depth Depth', '# TYPE depth gauge',
+                          'depth{queue="a"} 1', 'depth{queue="b"} 2',
+                          '# HELP broken Broken', '# TYPE broken gauge'])
+
+    def test_same_name(self):
+        """metric declared again is the one registered first"""
+        c = self.registry.counter('x_total', 'X')
+        self.assertTrue(self.registry.counter('x_total', 'X') is c)
+
+    def test_server(self):
+        """metrics are served in Prometheus text format"""
+        self.registry.counter('x_total', 'X').inc()
+        server = MetricsServer(port=0, registry=self.registry)
+        server.start()
+        self.addCleanup(server.stop)
+        url = 'http://127.0.0.1:%d'%server.httpd.server_address[1]
+        self.assertEqual(urllib2.urlopen(url+'/metrics').read(), self.registry.prometheus_text())
+        self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url+'/other')
+
+if __name__ == '__main__':
+    unittest.main()
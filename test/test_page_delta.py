@@ -0,0 +1,33 @@
+from page_delta import split_rows, page_delta, apply_delta
+import unittest
+
+
+class PageDeltaTest(unittest.TestCase):
+    def check(self, old, new):
+        old, new = split_rows(old), split_rows(new)
+        scroll, runs = page_delta(old, new)
+        self.assertEqual(apply_delta(old, scroll, runs, len(new)), new)
+        return scroll, runs
+
+    def test_split_rows(self):
+        """Page is split by lines, wrapped line is a single row"""
+        self.assertEqual(split_rows('a\n0123456789\n\nb'), ['a\n', '0123456789\n', '\n', 'b'])
+        self.assertEqual(split_rows(''), [])
+
+    def test_scroll(self):
+        """Moves by a few lines are sent as scroll and new rows"""
+        page = ''.join('line %d\n'%i for i in range(10))
+        self.assertEqual(self.check(page, page), (0, []))
+        moved = ''.join('line %d\n'%i for i in range(3, 13))
+        self.assertEqual(self.check(page, moved),
+                         (3, [[7, ['line 10\n', 'line 11\n', 'line 12\n']]]))
+        self.assertEqual(self.check(moved, page), (-3, [[0, ['line 0\n', 'line 1\n', 'line 2\n']]]))
+
+    def test_replace(self):
+        """Changed rows are sent as runs, empty rows do not confuse scroll"""
+        self.assertEqual(self.check('a\n\n\nb\nc\n', 'a\n\n\nx\nc\n'), (0, [[3, ['x\n']]]))
+        self.assertEqual(self.check('a\nb\n', 'c\nd\ne\n'), (0, [[0, ['c\n', 'd\n', 'e\n']]]))
+        self.check('a\nb\nc', 'b\nc\nd\ne\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+from plugs import PlugFollow
+import plugs
+import unittest, mock
+
+
+class PlugFollowTest(unittest.TestCase):
+    def setUp(self):
+        self.ssh = mock.Mock()
+        self.channel = self.ssh.exec_channel.return_value
+        self.data = []
+        self.channel.recv_ready.side_effect = lambda: bool(self.data)
+        self.channel.recv.side_effect = lambda size: self.data.pop(0)
+        self.pf = PlugFollow(ssh=self.ssh, path='/var/log/app log')
+        self.pf.put_request()
+
+    def test_request(self):
+        """tail follows the file name to survive rotation"""
+        self.ssh.exec_channel.assert_called_once_with("tail -n 0 -F '/var/log/app log' 2>/dev/null")
+
+    @mock.patch('time.time')
+    def test_batch(self, m_time):
+        """lines are batched by time and size, incomplete line waits"""
+        m_time.return_value = 100
+        self.data = ['a\nb', 'c\nd']
+        self.assertFalse(self.pf.check_response())
+        self.assertEqual(self.pf.buffered(), 2)
+        m_time.return_value = 100 + plugs.FOLLOW_BATCH_DELAY
+        self.assertTrue(self.pf.batch_ready())
+        self.assertEqual(self.pf.get_result(), ([u'a', u'bc'], 0))
+        self.assertFalse(self.pf.batch_ready())
+        self.data = ['\n' + 'x'*plugs.FOLLOW_BATCH_SIZE + '\n']
+        self.assertTrue(self.pf.check_response())
+        self.assertEqual(self.pf.get_result()[0][0], u'd')
+
+    def test_drop(self):
+        """the oldest lines are dropped and counted"""
+        self.data = ['1\n2\n3\n']
+        self.pf.check_response()
+        self.pf.drop(2)
+        self.assertEqual(self.pf.get_result(), ([u'3'], 2))
+        self.assertEqual(self.pf.dropped, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,5 @@
-from plugs import ScreenBuff, PlugLess, repr_unprint
+import plugs
+from plugs import ScreenBuff, PlugLess, PlugLessException, AnchorMatcher, repr_unprint
 import unittest, mock
 
 class ScreenBuffTest(unittest.TestCase):
@@ -14,6 +15,8 @@ class ScreenBuffTest(unittest.TestCase):
                  (sb, "not found",("aa x1b 23",),"aa \x1b 23"),
                  (sb, "found", ("aa","bb"), "ababb"),
                  (sb, "found", ("(END) \x1b","long"), "a (END) \x1b[K"),
+                 (sb, "found", ("aab",), "aaab"),
+                 (sb, "found", ("abcd","bc"), "abce"),
                  ]
         print '\n'
         [self.check_anchor(tc) for tc in cases] 
@@ -23,6 +26,25 @@ class ScreenBuffTest(unittest.TestCase):
         sb = ScreenBuff()
         self.assertRaises(AssertionError, sb.wait_new_anchor, "")
 
+    def test_anchor_split(self):
+        """Test if anchor is found when it is split between chunks"""
+        sb = ScreenBuff()
+        sb.wait_new_anchor(("(END) \x1b",))
+        sb.put_data("abc (EN")
+        self.assertFalse(sb.anchor_found())
+        sb.put_data("D) \x1b[K")
+        self.assertTrue(sb.anchor_found())
+        self.assertEqual(sb.last_anchor, "(END) \x1b")
+
+    def test_anchor_priority(self):
+        """Test if first anchor wins when several anchors end at the same position"""
+        matcher = AnchorMatcher(("bc", "abc", ""))
+        self.assertEqual(matcher.anchors, ("bc", "abc"))
+        self.assertEqual(matcher.scan("xabcx"), (matcher.scan("xabc")[0], 4, "bc"))
+        matcher = AnchorMatcher(("abc", "bc"))
+        self.assertEqual(matcher.scan("xabcx")[1:], (4, "abc"))
+        self.assertEqual(matcher.scan("xyz")[1:], (3, None))
+
     def check_anchor(self, tc):
         if tc[1]=="found":
             sb, anchor, buff = tc[0], tc[2], tc[3]
@@ -86,7 +108,9 @@ class ScreenBuffTest(unittest.TestCase):
                  (1,1,"0123456789\r\nb","0123456789\nb\n\n\n"),
                  (1,1,"abc\x1bM","\nabc\n\n\n"),
                  (1,1,"abcde\x1b[1;2H\x1b[K","a\n\n\n\n"),
-                 (1,5,"abc\r\x1b[K","\n\n\n\n")
+                 (1,5,"abc\r\x1b[K","\n\n\n\n"),
+                 (1,1,"0123456789abcdefghijklmnopqrstuvwxyz","0123456789abcdefghijklmnopqrstuvwxyz\n"),
+                 (5,1,"0123456789ab\x1b[1;1Hcd\x1b[Kef","cdef6789ab\n\n\n")
                 ]
         print '\n'
         for c in cases:
@@ -119,6 +143,67 @@ class ScreenBuffTest(unittest.TestCase):
         sb.put_data(buff)
         self.assertItemsEqual(sb._wrap, [False, False, True, True, False])  
 
+    def test_scroll(self):
+        """Test if scrolling reuses rows of the screen"""
+        sb = ScreenBuff(5,3)
+        cells = sb._cells
+        sb.put_data("a\r\nb\r\nc\r\nd\r\nlonger")
+        self.assertEquals("d\nlonge", repr(sb))
+        self.assertEquals("r", sb.curr_line())
+        sb.put_data("\x1b[1;1H\x1bMx")
+        self.assertEquals("x\nd\n", repr(sb))
+        self.assertTrue(sb._cells is cells)
+
+    def test_reverse_scroll(self):
+        """Test if screen drawn upside down by 'less' keeps wrapped lines"""
+        sb = ScreenBuff(20, 8)
+        sb.put_data('\rL10 xxx\r\nL11 xxx\r\nL12 xxxxxxxxxxxxxxxx \x08xxxxxxxxx\r\n'
+                    'L13 xxx\r\nL14 xxx\r\nL15 xxxxxxxxxxxxxxxx \x08:\x1b[K')
+        # 'b' command
+        sb.put_data('\r\x1b[K\x1b[H\x1bMxxxxxxxxx\r\n\x1b[H\x1bML09 xxxxxxxxxxxxxxxx'
+                    '\x1b[H\x1bML08 xxx\r\n\x1b[H\x1bML07 xxx\r\n\x1b[H\x1bMxxxxxxxxx\r\n'
+                    '\x1b[H\x1bML06 xxxxxxxxxxxxxxxx\x1b[H\x1bML05 xxx\r\n\x1b[8;1H\r\x1b[K:\x1b[K')
+        self.assertEquals('L05 xxx\nL06 xxxxxxxxxxxxxxxxxxxxxxxxx\nL07 xxx\nL08 xxx\n'
+                          'L09 xxxxxxxxxxxxxxxxxxxxxxxxx\n', repr(sb))
+        # forward draw of the same screen gives the same text
+        fwd = ScreenBuff(20, 8)
+        fwd.put_data('L05 xxx\r\nL06 xxxxxxxxxxxxxxxx \x08xxxxxxxxx\r\nL07 xxx\r\nL08 xxx\r\n'
+                     'L09 xxxxxxxxxxxxxxxx \x08xxxxxxxxx\r\n:\x1b[K')
+        self.assertEquals(repr(fwd), repr(sb))
+        # full row which is not wrapped
+        sb.put_data('\x1b[H\x1bML04 xxxxxxxxxxxxxxxx\r\n\x1b[8;1H\r\x1b[K:\x1b[K')
+        self.assertTrue(repr(sb).startswith('L04 xxxxxxxxxxxxxxxx\nL05 xxx\n'))
+
+    def test_clear_below(self):
+        """Test if ESC[J clears the rest of the screen"""
+        sb = ScreenBuff(10, 5)
+        sb.put_data('a\r\nbbbb\r\nc\r\nd\x1b[2;3H\x1b[J')
+        self.assertEquals('a\nbb\n\n\n', repr(sb))
+        sb.put_data('\x1b[H\x1b[J\x1bMx\r\n\x1b[H\x1bMy\r\n')
+        self.assertEquals('y\nx\n\n\n', repr(sb))
+
+    def test_screen_rows(self):
+        """Rows are rendered again only if they are changed"""
+        sb = ScreenBuff(5, 4)
+        sb.put_data('a\r\nb\r\n0123456789\r\n')
+        self.assertEquals(['b\n', '01234', '56789\n'], sb.screen_rows())
+        rows = sb.screen_rows()
+        sb.put_data('c\r\n')
+        new_rows = sb.screen_rows()
+        self.assertEquals(['01234', '56789\n', 'c\n'], new_rows)
+        self.assertTrue(new_rows[0] is rows[1])
+        sb.put_data('\x1b[3;1Hd')
+        self.assertEquals('0123456789\nd\n', repr(sb))
+
+    def test_put_data_start(self):
+        """ScreenBuff takes data from the given position of buffer"""
+        sb = ScreenBuff(10, 3)
+        sb.wait_new_anchor((':',))
+        buff = 'skip\r\nab:cd'
+        self.assertEqual(sb.put_data(buff, start=6), 9)
+        self.assertEqual(repr(sb), 'ab:\n\n')
+
+
     def test_ESC(self):
         """Test if ScreenBuff ignores ESC sequences"""
         fin = '\n\n\n\n'
@@ -134,7 +219,7 @@ class PlugLessTest(unittest.TestCase):
     @mock.patch.object(PlugLess, 'flush') 
     def test_open(self, flush_mock, ssh_mock):
         channel = ssh_mock.return_value.get_shell.return_value
-        channel.recv_ready.side_effect= [True, False]   # 1st for actual data
+        channel.recv_ready.side_effect= [True, False, False]   # 1st for actual data
         channel.recv.return_value = ("xyz\r\n"+'(END)'+PlugLess.OPEN[1][0])
         pl = PlugLess(path='path', cols=5, rows=5)
         pl.put_request(PlugLess.OPEN)
@@ -149,7 +234,7 @@ class PlugLessTest(unittest.TestCase):
     @mock.patch.object(PlugLess, 'flush')
     def test_not_found(self, flush_mock, ssh_mock):
         channel = ssh_mock.return_value.get_shell.return_value
-        channel.recv_ready.return_value = [True]
+        channel.recv_ready.side_effect = [True, False]
         channel.recv.return_value = ("aaa: No such file or directory\r\n")
         pl = PlugLess(path='path', cols=5, rows=5)
         pl.put_request(PlugLess.OPEN)
@@ -158,6 +243,218 @@ class PlugLessTest(unittest.TestCase):
         self.assertFalse(pl.launched)
         channel.send.assert_called_with('less path\n')
 
+    @mock.patch('plugs.SSHChannel')
+    def test_recv_all(self, ssh_mock):
+        """Channel is drained at once, read size follows amount of data"""
+        channel = ssh_mock.return_value.get_shell.return_value
+        pending = ['x'*100000]
+        def recv(size):
+            data, pending[0] = pending[0][:size], pending[0][size:]
+            return data
+        channel.recv.side_effect = recv
+        channel.recv_ready.side_effect = lambda: bool(pending[0])
+        pl = PlugLess(path='path')
+        self.assertEqual(pl.recv_all(), 'x'*100000)
+        self.assertEqual(pl._recv_size, plugs.RECV_MAX_SIZE)
+        self.assertLess(channel.recv.call_count, 12)
+        pending[0] = 'abc'
+        self.assertEqual(pl.recv_all(), 'abc')
+        self.assertEqual(pl._recv_size, plugs.RECV_MAX_SIZE//2)
+        self.assertEqual(pl.recv_all(), '')
+
+class PlugLessCacheTest(unittest.TestCase):
+    PROMPT = ':\x1b[K'
+
+    def page(self, text):
+        """'less' output which draws a screen with text"""
+        return '\x1b[1;1H'+text+'\x1b[K\r\n\x1b[K\x1b[3;1H'+self.PROMPT
+
+    def setUp(self):
+        patcher = mock.patch('plugs.SSHChannel')
+        self.ssh = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(PlugLess, 'flush')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = self.ssh.return_value.get_shell.return_value
+        self._ready = False
+        self.channel.recv_ready.side_effect = self.recv_ready
+        self.pl = PlugLess(path='path', cols=10, rows=3)
+
+    def recv_ready(self):
+        """recv.return_value is received once by every check_response()"""
+        self._ready = not self._ready
+        return self._ready
+
+    def answer(self, data):
+        """feeds data to the plug, returns page text"""
+        self.channel.recv.return_value = data
+        self.assertTrue(self.pl.check_response())
+        return self.pl.get_result()
+
+    def request(self, task, data=None, args=None):
+        """puts request, returns page text and keys sent to 'less' """
+        self.channel.send.reset_mock()
+        self.pl.put_request(task, args)
+        if self.pl.has_task:
+            self.channel.recv.return_value = data
+            self.pl.check_response()
+            if self.pl.has_task:   # prompt of typed number was skipped
+                self.channel.recv.return_value = data
+                self.pl.check_response()
+        keys = [c[0][0] for c in self.channel.send.call_args_list]
+        return self.pl.get_result(), keys
+
+    def test_cache(self):
+        """pages seen already are taken from cache"""
+        self.pl.put_request(PlugLess.OPEN)
+        self.assertEqual(self.answer('p0\r\n'+PlugLess.OPEN[1][0]), 'p0\n\n')
+        self.assertEqual(self.request(PlugLess.FWD, self.page('p1')), ('p1\n\n', ['f']))
+        self.assertEqual(self.request(PlugLess.BACK), ('p0\n\n', []))
+        self.assertTrue(self.pl._first_screen)
+        self.assertEqual(self.request(PlugLess.FWD), ('p1\n\n', []))
+        self.assertEqual(self.request(PlugLess.REDRAW), ('p1\n\n', []))
+        # 'less' is still at the page 1
+        self.assertEqual(self.request(PlugLess.FWD, self.page('p2')), ('p2\n\n', ['f']))
+        self.request(PlugLess.BACK)
+        self.request(PlugLess.BACK)
+        # 'less' is at the page 2, client is at 0
+        self.pl.cache.clear()
+        self.assertEqual(self.request(PlugLess.REDRAW, self.page('p0')), ('p0\n\n', ['4b']))
+        self.assertEqual(self.request(PlugLess.FWD, self.page('p1')), ('p1\n\n', ['f']))
+
+    def test_counted_move(self):
+        """FWD and BACK move by a number of pages at once"""
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.assertEqual(self.request(PlugLess.FWD, self.page('p3'), 3), ('p3\n\n', ['6f']))
+        self.assertEqual((self.pl._page, self.pl._less_page), (3, 3))
+        self.assertEqual(self.request(PlugLess.BACK, self.page('p1'), 2), ('p1\n\n', ['4b']))
+        self.assertEqual(self.request(PlugLess.FWD, None, 2), ('p3\n\n', []))
+        self.assertEqual(self.request(PlugLess.BACK, None, 5), ('p0\n\n', []))
+        self.assertTrue(self.pl._first_screen)
+
+    def test_counted_move_end(self):
+        """move by pages stopped by the end of file loses the pages grid"""
+        end = '\x1b[1;1Hp2\x1b[K\r\n\x1b[K\x1b[3;1H(END) \x1b[K'
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.assertEqual(self.request(PlugLess.FWD, end, 5), ('p2\n\n', ['10f']))
+        self.assertTrue(self.pl._last_screen)
+        self.assertEqual(self.pl._origin, None)
+        self.assertEqual(self.request(PlugLess.BACK, self.page('p1')), ('p1\n\n', ['b']))
+
+    def test_prefetch(self):
+        """next pages are fetched in background"""
+        self.pl = PlugLess(path='path', cols=10, rows=3, prefetch=2)
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.channel.send.reset_mock()
+        self.assertTrue(self.pl.prefetch())
+        self.assertTrue(self.pl.has_task)
+        self.assertEqual(self.answer(self.page('p1')), 'p1\n\n')
+        self.assertTrue(self.pl.prefetch())
+        self.answer(self.page('p2'))
+        self.assertFalse(self.pl.prefetch())
+        self.assertEqual([c[0][0] for c in self.channel.send.call_args_list], ['f', 'f'])
+        # client is still at the first page
+        self.assertTrue(self.pl._first_screen)
+        self.assertEqual(self.request(PlugLess.FWD), ('p1\n\n', []))
+
+        self.assertTrue(self.pl.prefetch())     # page 3
+        self.channel.send.reset_mock()
+        self.assertEqual(self.request(PlugLess.FWD), ('p2\n\n', []))
+        # cached page is ready while prefetch is running
+        self.assertTrue(self.pl.has_task)
+        self.assertTrue(self.pl.result_ready)
+        self.pl.put_request(PlugLess.FWD)       # waits for prefetch
+        self.assertTrue(self.pl.has_task)
+        self.assertFalse(self.pl.result_ready)
+        self.assertRaises(AssertionError, self.pl.put_request, PlugLess.FWD)
+        self.assertEqual(self.answer(self.page('p3')), 'p3\n\n')
+        self.assertFalse(self.pl.has_task)
+        self.assertEqual(self.pl._page, 3)
+
+    def test_reanchor(self):
+        """'less' returns to the origin if it is not aligned to pages"""
+        self.pl = PlugLess(path='path', cols=10, rows=3, prefetch=2)
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.pl.prefetch()
+        self.answer(self.page('p1'))
+        self.pl.prefetch()
+        self.answer('\x1b[1;1Hp2\x1b[K\r\n\x1b[K\x1b[3;1H(END) \x1b[K')
+        self.assertEqual(self.pl._less_page, None)
+        self.assertEqual(self.request(PlugLess.FWD), ('p1\n\n', []))
+        self.assertEqual(self.request(PlugLess.FWD), ('p2\n\n', []))
+        self.assertTrue(self.pl._last_screen)
+        self.assertRaises(PlugLessException, self.pl.put_request, PlugLess.FWD)
+        self.pl.cache.clear()
+        self.channel.send.reset_mock()
+        self.pl.put_request(PlugLess.BACK)
+        self.channel.recv.return_value = self.page('p0')
+        self.assertFalse(self.pl.check_response())  # prompt of typed position
+        self.assertFalse(self.pl.check_response())
+        self.assertEqual(self.answer(self.page('p1')), 'p1\n\n')
+        self.assertEqual([c[0][0] for c in self.channel.send.call_args_list], ['0.000000%', 'f'])
+        self.assertEqual((self.pl._page, self.pl._less_page), (1, 1))
+
+    def test_line(self):
+        """LINE moves 'less' to the offset, the line becomes origin of pages"""
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.pl._located = (120, 9)
+        self.channel.send.reset_mock()
+        self.pl.put_request(PlugLess.LINE, 120)
+        self.channel.recv.return_value = self.page('p5')
+        self.assertFalse(self.pl.check_response())  # prompt of typed offset
+        self.assertEqual(self.answer(self.page('p5')), 'p5\n\n')
+        self.assertEqual([c[0][0] for c in self.channel.send.call_args_list], ['120P'])
+        self.assertEqual(self.pl._origin, ('line', 120))
+        self.assertEqual(self.pl.position(), (10, None))
+        self.assertEqual(self.request(PlugLess.FWD, self.page('p6')), ('p6\n\n', ['f']))
+        self.assertEqual(self.pl.position(), None)
+        self.assertEqual(self.request(PlugLess.BACK), ('p5\n\n', []))
+
+    def test_pages(self):
+        """PAGES sends keys at once and takes a page at every prompt"""
+        end = '\x1b[1;1Hp3\x1b[K\r\n\x1b[K\x1b[3;1H(END) \x1b[K'
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.channel.send.reset_mock()
+        self.pl.put_request(PlugLess.PAGES, 3)
+        self.assertEqual(self.answer(self.page('p1')+self.page('p2')+end),
+                         ['p1\n\n', 'p2\n\n', 'p3\n\n'])
+        self.assertEqual([c[0][0] for c in self.channel.send.call_args_list], ['fff'])
+        self.assertTrue(self.pl._last_screen)
+        self.assertEqual(self.request(PlugLess.BACK), ('p2\n\n', []))
+        self.assertEqual(self.request(PlugLess.BACK), ('p1\n\n', []))
+
+    def test_pages_end(self):
+        """PAGES stops taking pages at the end of file"""
+        end = '\x1b[1;1Hp2\x1b[K\r\n\x1b[K\x1b[3;1H(END) \x1b[K'
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.pl.put_request(PlugLess.PAGES, 4)
+        self.channel.recv.return_value = self.page('p1')+end+'\r\x1b[K\x07\r\x1b[K(END) \x1b[K'
+        self.assertFalse(self.pl.check_response())  # key left
+        self.assertEqual(self.answer('\r\x1b[K\x07\r\x1b[K(END) \x1b[K'), ['p1\n\n', 'p2\n\n'])
+        self.assertEqual(self.pl._page, 2)
+        self.assertRaises(PlugLessException, self.pl.put_request, PlugLess.PAGES, 2)
+
+    def test_file_changed(self):
+        """cache is dropped when the file changes"""
+        self.pl.put_request(PlugLess.OPEN)
+        self.answer('p0\r\n'+PlugLess.OPEN[1][0])
+        self.assertTrue(self.pl.has_file_check())
+        self.assertTrue(self.pl.start_file_check())
+        self.assertFalse(self.pl.start_file_check())
+        self.ssh.return_value.exec_remote.return_value = (['12 100'], [])
+        self.pl.file_checked(self.pl.stat_file())
+        self.assertEqual(len(self.pl.cache), 1)
+        self.pl.file_checked((12, 200))
+        self.assertEqual(len(self.pl.cache), 0)
+
     
 if __name__=="__main__":
     unittest.main()
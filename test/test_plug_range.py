@@ -0,0 +1,158 @@
+from plugs import PlugRange, PlugLess, PlugLessException
+import unittest, mock
+
+class PlugRangeTest(unittest.TestCase):
+    def setUp(self):
+        self.ssh = mock.Mock()
+        self.text = ''
+        self.file = self.ssh.open_file.return_value
+        self.file.read.side_effect = lambda offset, length: \
+                                            self.text[offset:offset+length]
+        self.file.size.side_effect = lambda: len(self.text)
+
+    def open(self, text, cols=5, rows=4):
+        self.text = text
+        pr = PlugRange(ssh=self.ssh, path='/log', cols=cols, rows=rows)
+        pr.put_request(PlugLess.OPEN)
+        return pr
+
+    def test_open(self):
+        """First page is read from the file start, long lines are wrapped"""
+        pr = self.open('ab\n0123456789xy\nc\n')
+        self.assertTrue(pr.launched)
+        self.assertFalse(pr.has_task)
+        self.assertEqual(pr.get_result(), 'ab\n0123456789')
+        self.assertEqual(pr.bottom, 13)
+
+    def test_open_failed(self):
+        """File which cannot be read is reported as a page"""
+        self.ssh.open_file.side_effect = IOError('No such file')
+        pr = PlugRange(ssh=self.ssh, path='/log')
+        pr.put_request(PlugLess.OPEN)
+        self.assertFalse(pr.launched)
+        self.assertEqual(pr.get_result(), 'No such file')
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.FWD)
+
+    def test_moves(self):
+        """FWD and BACK keep screen rows of wrapped lines"""
+        pr = self.open('ab\n0123456789xy\nc\nd\ne\nf\n')
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.BACK)
+        pr.put_request(PlugLess.FWD)
+        self.assertEqual(pr.get_result(), 'xy\nc\nd\n')
+        pr.put_request(PlugLess.FWD)
+        # the last page is always a full screen
+        self.assertEqual(pr.get_result(), 'd\ne\nf\n')
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.FWD)
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.get_result(), '56789xy\nc\n')
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.get_result(), 'ab\n0123456789')
+        self.assertEqual(pr.top, 0)
+
+    def test_utf8(self):
+        """rows are not cut inside UTF-8 chars, paging back gives the same rows"""
+        pr = self.open(('a'+'\xc3\xa9'*50+'\n')*10, cols=8, rows=4)
+        pages = [pr.get_result()]
+        self.assertEqual(pages[0], 'a\xc3\xa9\xc3\xa9\xc3\xa9' + '\xc3\xa9'*4*2)
+        for n in range(5):
+            pr.put_request(PlugLess.FWD)
+            pages.append(pr.get_result())
+        for page in pages:
+            page.decode('utf-8')
+        for page in reversed(pages[:-1]):
+            pr.put_request(PlugLess.BACK)
+            self.assertEqual(pr.get_result(), page)
+
+    def test_counted_moves(self):
+        """FWD and BACK take a number of pages"""
+        pr = self.open(''.join('%d\n'%i for i in range(20)))
+        pr.put_request(PlugLess.FWD, 3)
+        self.assertEqual(pr.get_result(), '9\n10\n11\n')
+        pr.put_request(PlugLess.BACK, 2)
+        self.assertEqual(pr.get_result(), '3\n4\n5\n')
+        pr.put_request(PlugLess.FWD, 50)
+        self.assertEqual(pr.get_result(), '17\n18\n19\n')
+        pr.put_request(PlugLess.BACK, 50)
+        self.assertEqual(pr.get_result(), '0\n1\n2\n')
+
+    def test_short_file(self):
+        """Rows after the file end are empty, the last line may have no '\\n'"""
+        pr = self.open('ab\ncd', rows=5)
+        self.assertEqual(pr.get_result(), 'ab\ncd\n\n\n')
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.FWD)
+
+    def test_pos(self):
+        """POS moves to the line start next to the position"""
+        pr = self.open(''.join('%d\n'%i for i in range(10)))
+        pr.put_request(PlugLess.POS, 50)
+        self.assertEqual(pr.get_result(), '5\n6\n7\n')
+        pr.put_request(PlugLess.POS, 100)
+        self.assertEqual(pr.get_result(), '7\n8\n9\n')
+        pr.put_request(PlugLess.POS, 0)
+        self.assertEqual(pr.get_result(), '0\n1\n2\n')
+
+    def test_long_line_back(self):
+        """Start of a line longer than the read window is found"""
+        pr = self.open('x\n'+'0123456789'*4+'\nend\n', cols=10, rows=3)
+        pr.put_request(PlugLess.POS, 100)
+        self.assertEqual(pr.get_result(), '0123456789\nend\n')
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.get_result(), '01234567890123456789')
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.get_result(), 'x\n0123456789')
+
+    def test_position(self):
+        """Line of the page top is tracked by moves and found by the index"""
+        pr = self.open('ab\n0123456789xy\nc\nd\ne\nf\n')
+        self.assertEqual(pr.position(), (1, None))
+        pr.put_request(PlugLess.FWD)
+        self.assertEqual(pr.position(), (2, None))
+        pr.put_request(PlugLess.FWD)
+        self.assertEqual(pr.position(), (4, None))
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.position(), (2, None))
+        pr.index = mock.Mock()
+        pr.index.total_lines.return_value = 6
+        pr.index.line_at.return_value = 2
+        pr.put_request(PlugLess.POS, 70)
+        self.assertEqual(pr.get_result(), 'c\nd\ne\n')
+        pr.index.line_at.assert_called_with(self.ssh, '/log', 16)
+        self.assertEqual(pr.position(), (3, 6))
+
+    def test_line(self):
+        """LINE moves to the offset found by locate_line"""
+        pr = self.open('ab\n0123456789xy\nc\nd\ne\nf\n')
+        pr.index = mock.Mock()
+        pr.index.offset_of.return_value = 16
+        self.assertEqual(pr.locate_line(3), 16)
+        pr.index.offset_of.assert_called_with(self.ssh, '/log', 2)
+        pr.put_request(PlugLess.LINE, 16)
+        self.assertEqual(pr.get_result(), 'c\nd\ne\n')
+        self.assertEqual(pr.position()[0], 3)
+        self.assertFalse(pr.index.line_at.called)
+
+    def test_pages(self):
+        """PAGES returns pages up to the end of file"""
+        pr = self.open('ab\n0123456789xy\nc\nd\ne\nf\ng\n')
+        pr.put_request(PlugLess.PAGES, 5)
+        self.assertEqual(pr.get_result(), ['xy\nc\nd\n', 'e\nf\ng\n'])
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.PAGES, 1)
+        pr.put_request(PlugLess.BACK)
+        self.assertEqual(pr.get_result(), 'xy\nc\nd\n')
+
+    def test_close(self):
+        """Remote file is closed with the log"""
+        pr = self.open('ab\n')
+        self.ssh.open_file.assert_called_once_with('/log')
+        pr.close()
+        self.file.close.assert_called_once_with()
+        self.assertFalse(self.ssh.close.called)
+
+    def test_busy(self):
+        """Request is refused while another one is served"""
+        pr = self.open('ab\n')
+        pr._lock.acquire()
+        self.assertRaises(PlugLessException, pr.put_request, PlugLess.REDRAW)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+from plugs import PlugSearch
+import os, subprocess, tempfile
+import unittest, mock
+
+
+class LocalChannel(object):
+    """ Channel of a command run by local shell, output is received in chunks """
+    def __init__(self, cmd, chunk=16):
+        proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        self.data = proc.communicate()[0]
+        self.chunk = chunk
+        self.eof_received = False
+        self.closed = False
+
+    def recv_ready(self):
+        return bool(self.data)
+
+    def recv(self, size):
+        size = min(size, self.chunk)
+        data, self.data = self.data[:size], self.data[size:]
+        self.eof_received = not self.data
+        return data
+
+
+class PlugSearchTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+        self.ssh = mock.Mock()
+        self.ssh.exec_channel.side_effect = LocalChannel
+
+    def search(self, text, **kwargs):
+        with open(self.path, 'wb') as f:
+            f.write(text)
+        search = PlugSearch(ssh=self.ssh, path=self.path, **kwargs)
+        search.put_request()
+        batches = []
+        while not search.done:
+            if search.check_response():
+                batches.append(search.get_result())
+        return search, batches
+
+    def test_forward(self):
+        """matches are taken as they come, line numbers and offsets are absolute"""
+        text = ''.join('line %d %s\n'%(i, 'error' if i%5==0 else 'ok') for i in range(20))
+        search, batches = self.search(text, pattern='err(or)?', offset=text.index('line 3'))
+        self.assertTrue(len(batches) > 1)
+        hits = sum(batches, [])
+        self.assertEqual([(h['line'], h['offset'], h['text']) for h in hits],
+                         [(6, text.index('line 5 '), 'line 5 error'),
+                          (11, text.index('line 10 '), 'line 10 error'),
+                          (16, text.index('line 15 '), 'line 15 error')])
+        self.assertEqual(search.error, None)
+
+    def test_context(self):
+        """context lines are kept with matches, limit stops the search,
+           adjacent matches are not context of each other like in grep"""
+        text = 'a\nX1\nb\nc\nd\nX2\nX3\ne\nX4\n'
+        search, batches = self.search(text, pattern='X', context=1, limit=3)
+        hits = sum(batches, [])
+        self.assertEqual([(h['text'], h['before'], h['after']) for h in hits],
+                         [('X1', ['a'], ['b']), ('X2', ['d'], []), ('X3', [], ['e'])])
+
+    def test_backward(self):
+        """backward search returns the nearest matches before the offset first"""
+        text = ''.join('%d\n'%i for i in range(30))
+        search, batches = self.search(text, pattern='^1', direction='back',
+                                      offset=text.index('15\n'), limit=3)
+        self.assertEqual([[h['line'] for h in hits] for hits in batches], [[15, 14, 13]])
+
+    def test_backward_from_end(self):
+        """backward search without offset starts at the end of file"""
+        text = ''.join('%d\n'%i for i in range(30))
+        search, batches = self.search(text, pattern='^2', direction='back', limit=2)
+        self.assertEqual([[h['line'] for h in hits] for hits in batches], [[30, 29]])
+
+    def test_error(self):
+        """grep error is reported"""
+        search, batches = self.search('abc\n', pattern='(')
+        self.assertEqual(batches, [[]])
+        self.assertTrue(search.error)
+        self.assertTrue(search.done)
+
+if __name__ == '__main__':
+    unittest.main()
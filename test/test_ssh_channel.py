@@ -0,0 +1,111 @@
+import ssh_channel
+import unittest
+from mock import Mock, patch
+
+
+class SSHPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ssh_channel.SSHPool(idle_timeout=10, host_limit=2)
+        patcher = patch('ssh_channel.SSHChannel')
+        self.ssh = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.ssh.side_effect = lambda **kw: Mock(**kw)
+
+    def test_shared(self):
+        """same credentials share one connection, others get their own"""
+        c1 = self.pool.acquire('host', 22, 'user', 'secret')
+        c2 = self.pool.acquire('host', 22, 'user', 'secret')
+        c3 = self.pool.acquire('host', 22, 'user', 'other')
+        self.assertIs(c1, c2)
+        self.assertIsNot(c1, c3)
+        c1.connect.assert_called_once_with()
+        self.assertEqual(self.ssh.call_count, 2)
+
+    @patch('time.time')
+    def test_idle(self, m_time):
+        """connection is closed after it is unused for idle_timeout"""
+        m_time.return_value = 100
+        c1 = self.pool.acquire('host', 22, 'user', 'secret')
+        self.pool.acquire('host', 22, 'user', 'secret')
+        self.pool.release(c1)
+        self.pool.release(c1)
+        m_time.return_value = 105
+        self.pool.expire()
+        self.assertFalse(c1.close.called)
+        # reused while idle
+        self.assertIs(c1, self.pool.acquire('host', 22, 'user', 'secret'))
+        self.pool.release(c1)
+        m_time.return_value = 120
+        self.pool.expire()
+        c1.close.assert_called_once_with()
+        self.assertIsNot(c1, self.pool.acquire('host', 22, 'user', 'secret'))
+
+    def test_dead(self):
+        """dead connection is replaced"""
+        c1 = self.pool.acquire('host', 22, 'user', 'secret')
+        c1.is_alive.return_value = False
+        c2 = self.pool.acquire('host', 22, 'user', 'secret')
+        self.assertIsNot(c1, c2)
+        c1.close.assert_called_once_with()
+
+    def test_host_limit(self):
+        """connections to a host are limited, idle ones are evicted"""
+        c1 = self.pool.acquire('host', 22, 'u1', 'secret')
+        self.pool.acquire('host', 22, 'u2', 'secret')
+        self.assertRaises(ssh_channel.SSHPoolException, 
+                          self.pool.acquire, 'host', 22, 'u3', 'secret')
+        self.pool.acquire('other', 22, 'u3', 'secret')
+        self.pool.release(c1)
+        self.pool.acquire('host', 22, 'u3', 'secret')
+        c1.close.assert_called_once_with()
+
+    def test_connect_error(self):
+        """failed connection is not kept in the pool"""
+        self.ssh.side_effect = None
+        self.ssh.return_value.connect.side_effect = [IOError('refused'), None]
+        self.assertRaises(IOError, self.pool.acquire, 'host', 22, 'user', 'secret')
+        self.assertIs(self.pool.acquire('host', 22, 'user', 'secret'), self.ssh.return_value)
+        self.assertEqual(self.ssh.return_value.connect.call_count, 2)
+
+class RemoteFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.text = ''.join(chr(ord('a')+i%26) for i in range(1000))
+        sftp = Mock()
+        self.file = sftp.open.return_value
+        self.file.stat.side_effect = lambda: Mock(st_size=len(self.text))
+        self.file.readv.side_effect = lambda chunks: \
+                        iter([self.text[o:o+l] for o, l in chunks])
+        self.rf = ssh_channel.RemoteFile(sftp, '/log', read_ahead=100)
+        sftp.open.assert_called_once_with('/log', 'rb')
+
+    def test_read_ahead(self):
+        """sequential reads are served from the read-ahead window"""
+        self.assertEqual(self.rf.read(0, 10), self.text[:10])
+        self.assertEqual(self.rf.read(10, 50), self.text[10:60])
+        self.file.readv.assert_called_once_with([(0, 100)])
+        self.assertEqual(self.rf.read(90, 20), self.text[90:110])
+        self.file.readv.assert_called_with([(90, 100)])
+        # large range is fetched at once
+        self.assertEqual(self.rf.read(200, 500), self.text[200:700])
+        self.file.readv.assert_called_with([(200, 500)])
+
+    def test_read_back(self):
+        """window is read before the range when moving backwards"""
+        self.rf.read(500, 10)
+        self.assertEqual(self.rf.read(450, 20), self.text[450:470])
+        self.file.readv.assert_called_with([(370, 100)])
+        self.assertEqual(self.rf.read(380, 10), self.text[380:390])
+        self.assertEqual(self.file.readv.call_count, 2)
+
+    def test_eof(self):
+        """reads are clipped by the file size which is updated at EOF"""
+        self.assertEqual(self.rf.read(950, 100), self.text[950:])
+        self.file.readv.assert_called_with([(950, 50)])
+        self.assertEqual(self.rf.read(1000, 10), '')
+        self.text += 'xyz'
+        self.assertEqual(self.rf.read(1000, 10), 'xyz')
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+from timers import Timers
+import timers
+import unittest
+
+
+class TimersTest(unittest.TestCase):
+    def setUp(self):
+        self.timers = Timers()
+
+    def test_due(self):
+        """keys come out by their deadlines, the earliest first"""
+        self.timers.schedule('b', 20)
+        self.timers.schedule('a', 10)
+        self.timers.schedule('c', 30)
+        self.assertEqual(self.timers.next_deadline(), 10)
+        self.assertEqual(self.timers.pop_due(5), [])
+        self.assertEqual(self.timers.pop_due(20), ['a', 'b'])
+        self.assertEqual(len(self.timers), 1)
+        self.assertEqual(self.timers.next_deadline(), 30)
+
+    def test_reschedule(self):
+        """the new deadline replaces the previous one, cancelled key never comes"""
+        self.timers.schedule('a', 10)
+        self.timers.schedule('b', 15)
+        self.timers.schedule('a', 40)
+        self.timers.cancel('b')
+        self.assertEqual(self.timers.next_deadline(), 40)
+        self.assertEqual(self.timers.pop_due(30), [])
+        self.assertEqual(self.timers.deadline('a'), 40)
+        self.assertNotIn('b', self.timers)
+        self.assertEqual(self.timers.pop_due(40), ['a'])
+        self.assertEqual(self.timers.next_deadline(), None)
+
+    def test_timeout(self):
+        self.assertEqual(self.timers.timeout(100, 5), 5)
+        self.timers.schedule('a', 102)
+        self.assertEqual(self.timers.timeout(100, 5), 2)
+        self.assertEqual(self.timers.timeout(103, 5), 0)
+
+    def test_compact(self):
+        """stale entries of rescheduled keys do not pile up"""
+        for n in range(10*timers.COMPACT_MIN_SIZE):
+            self.timers.schedule('a', n)
+        self.assertTrue(len(self.timers._heap) <= timers.COMPACT_MIN_SIZE + 2)
+        self.assertEqual(self.timers.pop_due(10**6), ['a'])
+
+if __name__=='__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+from tracing import Trace, TraceBuffer, LoopProfiler
+import os, tempfile
+import unittest, mock
+
+
+class TracingTest(unittest.TestCase):
+    @mock.patch('time.time')
+    def test_trace(self, m_time):
+        """spans are ms from the start ordered by time, mark_once keeps the first mark"""
+        m_time.return_value = 100.0
+        trace = Trace('log_next', 7)
+        for stamp, name in [(100.002, 'parsed'), (100.010, 'first_byte'),
+                            (100.020, 'first_byte'), (100.005, 'sent')]:
+            m_time.return_value = stamp
+            trace.mark_once(name)
+        res = trace.as_dict()
+        self.assertEqual([name for name, ms in res['spans']], ['parsed', 'sent', 'first_byte'])
+        self.assertAlmostEqual(res['spans'][-1][1], 10)
+        self.assertAlmostEqual(res['total'], 10)
+        self.assertEqual((res['cmd'], res['req_id'], res['start']), ('log_next', 7, 100.0))
+
+    def test_buffer(self):
+        """buffer keeps the last traces only"""
+        buff = TraceBuffer(size=3)
+        for n in range(5):
+            buff.add(Trace(str(n)))
+        self.assertEqual([t['cmd'] for t in buff.dump()], ['2', '3', '4'])
+        buff.clear()
+        self.assertEqual(buff.dump(), [])
+
+    def test_profiler(self):
+        """every rate-th iteration is profiled"""
+        def work():
+            return sum(range(100))
+        profiler = LoopProfiler(rate=3)
+        self.assertEqual(profiler.stats(), None)
+        profiled = 0
+        for n in range(9):
+            if profiler.begin():
+                profiled = profiled + 1
+                work()
+                profiler.end()
+        self.assertEqual(profiled, 3)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        summary = profiler.dump(path)
+        self.assertIn('work', summary)
+        self.assertTrue(os.path.getsize(path) > 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,8 @@
 import web_client
+import json
+import time
 import unittest
-from mock import Mock, patch, PropertyMock
+from mock import Mock, patch, PropertyMock, call
 
 
 
@@ -17,6 +19,13 @@ class WebClientTest(unittest.TestCase):
         self.wc.recv_from_client(data)
         logger.warning.assert_called_with('[AnyName]: Not a JSON! Ignoring...')
         self.assertFalse(logger.info.called)
+
+    def test_recv_from_client_bad_cmd(self):
+        """request with cmd which is not a string is answered by error"""
+        self.wc.recv_from_client('{"cmd":1}\r\n')
+        self.assertEqual(json.loads(str(self.wc._out_buff)),
+                         {'cmd':1, 'res':'error', 'data':"'cmd' must be a string"})
+        self.assertTrue(self.wc.running)
     
     @patch.object(web_client.WebClient, '_connect')    
     @patch('web_client.logger')
@@ -27,33 +36,47 @@ class WebClientTest(unittest.TestCase):
         logger.info.assert_called_with('[AnyName]: cmd = connect')
         conn.assert_called_with(cmd='connect', param='abc')
     
+    @patch.object(web_client.WebClient, '_connect')
+    def test_recv_from_client_long(self, conn):
+        """long request taken by small chunks is scanned once, '\\r\\n' may be split"""
+        req = '{"cmd":"connect","param":"%s"}\r\n'%('x'*100000)
+        req = req + req
+        for pos in range(0, len(req), web_client.BUFF_SIZE):
+            self.wc.recv_from_client(req[pos:pos+web_client.BUFF_SIZE])
+            self.assertTrue(self.wc._scanned >= len(self.wc._buff)-1)
+        self.assertEqual(conn.call_count, 2)
+        self.assertEqual(len(self.wc._buff), 0)
+        self.wc.recv_from_client('{"cmd":"connect"}\r')
+        self.wc.recv_from_client('\n')
+        self.assertEqual(conn.call_count, 3)
+
     @patch('time.time')
     @patch('uuid.uuid4')
     @patch.object(web_client.WebClient, '_put_answer_in_queue')
-    @patch('web_client.SSHChannel')
-    def test_connect(self, ssh, put_ans, m_uuid, m_time):
-        """test if _connect() tries to establish ssh session and returns correct result"""
+    @patch('web_client.SSH_POOL')
+    def test_connect(self, pool, put_ans, m_uuid, m_time):
+        """test if _connect() takes ssh session from the pool and returns correct result"""
         args = {"host":"abc", "port":666, 
                    "user":"devil", "secret":"hell"}
         m_time.return_value=1234
-        ssh_conn = ssh.return_value
+        ssh_conn = pool.acquire.return_value
         m_uuid.return_value='abc-def'
         #positive
         res = {"cmd":"any", "res":"ok", "conn_id":'abc-def'}
         self.wc._connect(cmd = 'any', **args)
-        ssh.assert_called_with(**args)
-        put_ans.assert_called_with(res)
+        pool.acquire.assert_called_with(**args)
+        put_ans.assert_called_with(res, None)
         self.assertEqual(self.wc._sessions['abc-def'], [ssh_conn, 1234]) 
         
         #negative
-        ssh.reset_mock()
+        pool.reset_mock()
         m_uuid.reset_mock()
-        ssh.side_effect = Exception()
+        pool.acquire.side_effect = Exception()
         res = {"cmd":"any", "res":"error"}
         self.wc._connect(cmd = 'any', **args)
-        ssh.assert_called_with(**args)
+        pool.acquire.assert_called_with(**args)
         self.assertItemsEqual(m_uuid.call_args_list, [])
-        put_ans.assert_called_with(res)        
+        put_ans.assert_called_with(res, None)
     
     @patch('time.time')
     @patch('uuid.uuid4')
@@ -62,6 +85,7 @@ class WebClientTest(unittest.TestCase):
         """ create new log session on log_open call """
         conn = Mock()
         log = m_plug.return_value
+        log.BLOCKING = False
         args = {'conn_id':'abc-def', 'cmd':'cmd','some_arg':'some_val'}
         self.wc._sessions = {'abc-def':[conn, 100]}
         m_uuid.return_value='aaa-bbb'
@@ -72,6 +96,23 @@ class WebClientTest(unittest.TestCase):
                         [log, web_client.WebClient.PL_ACTIVE, 'cmd', 'abc-def'])
         self.assertEqual(self.wc._sessions['abc-def'], [conn, 333])                
         self.assertIn(log, self.wc._sock_read_fd)
+        # line index is left for log_line
+        self.assertFalse(log.update_index.called)
+
+    @patch('uuid.uuid4')
+    @patch.object(web_client.WebClient, '_log_response')
+    @patch('web_client.PlugRange')
+    def test_log_open_range(self, m_plug, log_response, m_uuid):
+        """ range engine reads the first page at once and is not polled """
+        conn = Mock()
+        log = m_plug.return_value
+        log.BLOCKING = True
+        self.wc._sessions = {'abc-def':[conn, 100]}
+        m_uuid.return_value='aaa-bbb'
+        self.wc._log_open(conn_id='abc-def', cmd='cmd', engine='range')
+        log.put_request.assert_called_once_with(web_client.PlugLess.OPEN)
+        log_response.assert_called_once_with('aaa-bbb')
+        self.assertNotIn(log, self.wc._sock_read_fd)
 
     
     @patch.object(web_client.WebClient, '_log_open')
@@ -94,8 +135,9 @@ class WebClientTest(unittest.TestCase):
         self.wc.recv_from_client('{"cmd":"log_open","conn_id":"aaa-112"}\r\n')
         log_open.assert_called_with(cmd='log_open', conn_id='aaa-112')
 
-    def test_disconnect(self):
-        """test if _disconnect() closes all log channels and ssh channel"""
+    @patch('web_client.SSH_POOL')
+    def test_disconnect(self, pool):
+        """test if _disconnect() closes all log channels and releases ssh channel"""
 
         s1 = Mock()
         s2 = Mock()
@@ -111,8 +153,7 @@ class WebClientTest(unittest.TestCase):
         self.assertDictEqual(self.wc._log_sessions,
                    {'002':[log,None,None, 'bbb'],
                     '003':[log,None,None, 'ccc']})
-        s1.close.assert_called_once_with()
-        self.assertItemsEqual(s2.close.call_args_list, [])
+        pool.release.assert_called_once_with(s1)
         self.assertEqual(log.close.call_count,2)
     
 
@@ -158,51 +199,522 @@ class WebClientTest(unittest.TestCase):
 
 
     def test_put_answer_in_queue(self):
-        self.assertEquals(self.wc._out_buff, [])
+        self.assertEquals(self.wc._out_buff, '')
         self.assertEquals(self.wc._sock_write_fd,[])
         data = {'abc':123}
         self.wc._put_answer_in_queue(data)
         self.assertEquals(self.wc._sock_write_fd,[self.wc.sock])
-        self.assertEquals(self.wc._out_buff, ['{"abc": 123}\r\n'])
+        self.assertEquals(self.wc._out_buff, '{"abc": 123}\r\n')
+        # answers are coalesced
+        self.wc._put_answer_in_queue({'x':1})
+        self.assertEquals(self.wc._out_buff, '{"abc": 123}\r\n{"x": 1}\r\n')
+
+    @patch.object(web_client.WebClient, '_log_cmd')
+    @patch.object(web_client.WebClient, '_connect')
+    def test_recv_from_client_pipelined(self, conn, log_cmd):
+        """all requests of a chunk are executed, long requests are accepted"""
+        self.wc._log_sessions['111'] = [Mock(), 0, None, 'aaa']
+        self.wc.recv_from_client('{"cmd":"connect","host":"%s"}\r\n'%('h'*2000) +
+                                 '{"cmd":"log_next","log_id":"111"}\r\n{"cmd":"log_prev",')
+        conn.assert_called_once_with(cmd='connect', host='h'*2000)
+        log_cmd.assert_called_once_with(cmd='log_next', log_id='111')
+        self.wc.recv_from_client('"log_id":"111"}\r\n')
+        log_cmd.assert_called_with(cmd='log_prev', log_id='111')
+
+    @patch.object(web_client.WebClient, '_log_cmd')
+    @patch('web_client.SSH_POOL')
+    def test_binary_framing(self, pool, log_cmd):
+        """connect switches to binary frames, answers carry request ids"""
+        def frame(req_id, text):
+            return web_client.FRAME_HEADER.pack(len(text), req_id) + text
+        self.wc._log_sessions['111'] = [Mock(), 0, None, 'aaa']
+        page = frame(7, '{"cmd":"log_next","log_id":"111"}')
+        self.wc.recv_from_client('{"cmd":"connect","framing":"binary"}\r\n' + page[:5])
+        answer = self.wc._out_buff
+        length, req_id = web_client.FRAME_HEADER.unpack_from(answer)
+        self.assertEqual(req_id, 0)
+        self.assertEqual(json.loads(str(answer[web_client.FRAME_HEADER.size:]))['res'], 'ok')
+        self.assertEqual(len(answer), web_client.FRAME_HEADER.size + length)
+        self.assertFalse(log_cmd.called)
+        self.wc.recv_from_client(page[5:] + frame(8, '{"cmd":"log_prev","log_id":"111"}'))
+        self.assertEqual(log_cmd.call_args_list,
+                         [call(cmd='log_next', log_id='111', req_id=7),
+                          call(cmd='log_prev', log_id='111', req_id=8)])
+        self.wc._out_buff = bytearray()
+        self.wc._put_answer_in_queue({'x':1}, 8)
+        self.assertEqual(self.wc._out_buff, frame(8, '{"x": 1}'))
+
+    def test_send_to_client(self):
+        """all queued answers are sent at once"""
+        sent = []
+        self.sock.send.side_effect = lambda data: sent.append(data.tobytes()) or len(data)
+        self.wc._put_answer_in_queue({'abc':123})
+        self.wc._put_answer_in_queue({'x':1})
+        self.wc.send_to_client()
+        self.assertEquals(sent, ['{"abc": 123}\r\n{"x": 1}\r\n'])
+        self.assertEquals(self.wc._out_buff, '')
+        self.assertEquals(self.wc._sock_write_fd, [])
 
     @patch.object(web_client, 'OUT_BUFF_SIZE')
-    def test_put_answer_in_queue_long(self, buff):
+    def test_send_to_client_partial(self, buff):
+        """partial writes are continued when the socket is writable again"""
         web_client.OUT_BUFF_SIZE = 4 # mock is used here to correctly restore constant after all
-        self.assertEquals(self.wc._out_buff, [])
-        self.assertEquals(self.wc._sock_write_fd,[])
-        data = {'abc':123}
-        self.wc._put_answer_in_queue(data)
+        sent = []
+        def send(data):
+            if len(sent) == 3:
+                raise web_client.socket.error(web_client.errno.EAGAIN, 'would block')
+            sent.append(data.tobytes()[:3])
+            return 3
+        self.sock.send.side_effect = send
+        self.wc._put_answer_in_queue({'abc':123})
+        self.wc.send_to_client()
+        self.assertEquals(sent, ['{"a', 'bc"', ': 1'])
         self.assertEquals(self.wc._sock_write_fd, [self.wc.sock])
-        self.assertEquals(self.wc._out_buff, ['{"ab', 'c": ', '123}', '\r\n'])
+        self.assertEquals(self.wc._out_buff, '23}\r\n')
+        sent[:] = []
+        self.wc.send_to_client()
+        self.assertEquals(''.join(sent), '23}\r\n')
+        self.assertEquals(self.wc._sock_write_fd, [])
+
+    @patch.object(web_client.WebClient, '_client_disconnect')
+    def test_send_to_client_error(self, disconnect):
+        """client is disconnected if the socket fails"""
+        self.sock.send.side_effect = web_client.socket.error(web_client.errno.EPIPE, 'broken')
+        self.wc._put_answer_in_queue({'abc':123})
+        self.wc.send_to_client()
+        disconnect.assert_called_once_with()
     
     @patch.object(web_client.WebClient, '_touch_conn')
     @patch.object(web_client.WebClient, '_put_answer_in_queue')
     def test_log_response(self, put_mock, m):
         plug = Mock()
         plug.get_result.return_value('okay\r\nokay\r\n')
+        plug.position.return_value = None
         self.wc._log_sessions['123-xyz'] = [plug, self.wc.PL_ACTIVE, 'open_log', 777]
         self.wc._log_response('123-xyz')
         
         self.assertItemsEqual(self.wc._log_sessions, {'123-xyz':[plug, self.wc.PL_IDLE, None, 777] })
-        put_mock.assert_called_with({'cmd':'open_log','res':'ok', 'data':plug.get_result.return_value, 'log_id':'123-xyz'})
+        put_mock.assert_called_with({'cmd':'open_log','res':'ok', 'data':plug.get_result.return_value, 'log_id':'123-xyz'}, None)
+
+    @patch.object(web_client, 'COMMAND_LATENCY')
+    @patch('time.time')
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    def test_command_latency(self, put_mock, m_time, latency):
+        """time from the start of the request to the answer is recorded by command"""
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False)
+        log.position.return_value = None
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        m_time.return_value = 10
+        self.wc._log_cmd(cmd='log_next', log_id='111')
+        m_time.return_value = 10.25
+        self.wc._log_response('111')
+        latency.observe.assert_called_once_with(0.25, cmd='log_next')
+        self.assertEqual(self.wc._log_started, {})
+
+    def log_for_trace(self):
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False, received=0)
+        log.check_response.return_value = True
+        log.get_result.return_value = 'page\n'
+        log.position.return_value = None
+        log._WebClient__log_id = '111'
+        log.is_closed.return_value = False
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.sock.send.side_effect = lambda data: len(data)
+        return log
+
+    def test_trace(self):
+        """spans of traced request are kept when its answer is written"""
+        log = self.log_for_trace()
+        self.wc._tracing = True
+        self.wc.recv_from_client('{"cmd":"log_next","log_id":"111"}\r\n')
+        self.assertEqual(self.wc.dump_traces(), [])
+        self.wc.handle_read(log)
+        self.wc.send_to_client()
+        traces = self.wc.dump_traces()
+        self.assertEqual([(t['cmd'], [name for name, ms in t['spans']]) for t in traces],
+                         [('log_next', ['parsed', 'sent', 'dispatched', 'first_byte',
+                                        'anchor', 'serialized', 'written'])])
+        self.assertEqual(self.wc._log_traces, {})
+        self.assertEqual(len(self.wc._out_traces), 0)
+
+    def test_trace_queued(self):
+        """trace of queued request goes on when the request is started,
+           skipped request is traced till its answer"""
+        log = self.log_for_trace()
+        self.wc._tracing = True
+        self.wc.recv_from_client('{"cmd":"log_next","log_id":"111"}\r\n'
+                                 '{"cmd":"log_page","log_id":"111"}\r\n'
+                                 '{"cmd":"log_pos","log_id":"111","position":5}\r\n')
+        self.wc.handle_read(log)
+        self.wc.handle_read(log)
+        self.wc.send_to_client()
+        spans = dict((t['cmd'], [name for name, ms in t['spans']]) for t in self.wc.dump_traces())
+        self.assertEqual(spans['log_page'], ['parsed', 'queued', 'dispatched', 'serialized', 'written'])
+        self.assertEqual(spans['log_pos'], ['parsed', 'queued', 'dispatched', 'dequeued', 'sent',
+                                            'first_byte', 'anchor', 'serialized', 'written'])
+        self.assertEqual(self.wc._queued_traces, {})
+
+    def test_trace_cmd(self):
+        """trace command switches tracing and answers with traces kept"""
+        self.log_for_trace()
+        self.wc.recv_from_client('{"cmd":"log_next","log_id":"111"}\r\n')
+        self.assertEqual(self.wc._log_traces, {})   # tracing is off
+        self.wc._log_sessions['111'][1] = self.wc.PL_IDLE
+        self.wc.recv_from_client('{"cmd":"trace","enable":true}\r\n'
+                                 '{"cmd":"log_close","log_id":"111"}\r\n')
+        self.wc.send_to_client()
+        self.wc.recv_from_client('{"cmd":"trace","enable":false,"clear":true}\r\n')
+        answers = [json.loads(line) for line in str(self.wc._out_buff).split('\r\n') if line]
+        self.assertEqual(answers[-1]['tracing'], False)
+        self.assertEqual([t['cmd'] for t in answers[-1]['data']], ['log_close'])
+        self.assertEqual(self.wc.dump_traces(), [])
+
+    def test_stats(self):
+        """stats answer has process metrics and counters of the client"""
+        log = Mock(received=300)
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_ACTIVE, 'log_next', 'aaa']
+        self.wc._log_queues['111'] = web_client.deque([{'cmd':'log_prev'}])
+        self.wc.recv_from_client('{"cmd":"stats"}\r\n')
+        answer = json.loads(str(self.wc._out_buff).strip())
+        self.assertEqual(answer['res'], 'ok')
+        self.assertEqual(answer['data']['client']['logs'],
+                         {'111': {'conn_id':'aaa', 'active':True, 'cmd':'log_next',
+                                  'received':300, 'queue':1}})
+        self.assertEqual(answer['data']['client']['sessions'], 1)
+        process = answer['data']['process']
+        self.assertTrue(process['rtpager_logs'][0]['value'] >= 1)
+        self.assertTrue(process['rtpager_log_queue_depth'][0]['value'] >= 1)
+        self.assertIn('rtpager_command_seconds', process)
+        self.assertIn('rtpager_channel_received_bytes_total', process)
+
+    def test_clients_gauge(self):
+        """disconnected client is not counted while it is still referenced"""
+        def clients():
+            return web_client.METRICS.snapshot()['rtpager_clients'][0]['value']
+        count = clients()
+        other = web_client.WebClient(Mock(), 'Other')
+        self.assertEqual(clients(), count+1)
+        other._client_disconnect()
+        self.assertEqual(clients(), count)
+        self.assertNotIn(other, web_client._clients())
+
+    @patch.object(web_client.WebClient, '_log_response')
+    def test_log_cmd_cached(self, log_response):
+        """_log_cmd answers at once if page was taken from cache"""
+        log = Mock(BLOCKING=False, result_ready=False)
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        log.has_task = True
+        self.wc._log_cmd(cmd='log_next', log_id='111')
+        log.put_request.assert_called_with(web_client.PlugLess.FWD, None)
+        self.assertFalse(log_response.called)
+        self.wc._log_sessions['111'][1] = self.wc.PL_IDLE   # page has been sent
+        log.has_task = False
+        self.wc._log_cmd(cmd='log_prev', log_id='111')
+        log_response.assert_called_once_with('111')
+        log.prefetch.assert_called_once_with()
+        # cached page does not wait for prefetch running meanwhile
+        self.wc._log_sessions['111'][1] = self.wc.PL_IDLE
+        log.has_task = True
+        log.result_ready = True
+        self.wc._log_cmd(cmd='log_next', log_id='111')
+        self.assertEqual(log_response.call_count, 2)
+
+    def test_log_pages(self):
+        """log_pages asks for a number of pages"""
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False)
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_cmd(cmd='log_pages', log_id='111', count=20)
+        log.put_request.assert_called_once_with(web_client.PlugLess.PAGES, 20)
+
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    def test_log_queue(self, put_ans):
+        """requests to a busy log wait in queue, moves are coalesced"""
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False)
+        log.position.return_value = None
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_cmd(cmd='log_page', log_id='111', req_id=1)
+        for n in range(2, 5):
+            self.wc._log_cmd(cmd='log_next', log_id='111', req_id=n)
+        self.wc._log_cmd(cmd='log_page', log_id='111', req_id=5)
+        self.wc._log_cmd(cmd='log_prev', log_id='111', req_id=6)
+        log.put_request.assert_called_once_with(web_client.PlugLess.REDRAW, None)
+        skipped = [(c[0][0]['res'], c[0][1]) for c in put_ans.call_args_list]
+        self.assertEqual(skipped, [('skipped', 2), ('skipped', 3), ('skipped', 5)])
+        self.assertEqual([req['req_id'] for req in self.wc._log_queues['111']], [4, 6])
+        # the page is ready, the next request starts
+        log.has_task = True
+        self.wc._log_response('111')
+        log.put_request.assert_called_with(web_client.PlugLess.FWD, 3)
+        self.assertEqual(self.wc._log_req_ids['111'], 4)
+        # a jump supersedes moves
+        self.wc._log_cmd(cmd='log_pos', log_id='111', position=0, req_id=7)
+        self.assertEqual(put_ans.call_args[0], ({'cmd':'log_prev', 'res':'skipped', 'log_id':'111'}, 6))
+        self.assertEqual([req['req_id'] for req in self.wc._log_queues['111']], [7])
+        self.wc._disconnect_log('111')
+        self.assertEqual(self.wc._log_queues, {})
+
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    def test_log_queue_limit(self, put_ans):
+        """moves are not joined beyond the pages a single move takes"""
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False)
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_ACTIVE, 'log_page', 'aaa']
+        limit = web_client.PAGES_BATCH_LIMIT
+        for n, count in enumerate([limit-10, 10, 1, limit]):
+            self.wc._log_cmd(cmd='log_next', log_id='111', count=count, req_id=n)
+        self.assertEqual([(req['req_id'], req['count']) for req in self.wc._log_queues['111']],
+                         [(1, limit), (2, 1), (3, limit)])
+        self.assertEqual([c[0][1] for c in put_ans.call_args_list], [0])
+
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    @patch('web_client.PlugSearch')
+    def test_log_search(self, m_search, put_ans):
+        """matches are streamed by the search channel, new search cancels the old one"""
+        m_search.side_effect = lambda **kwargs: Mock(done=False, error=None, kwargs=kwargs)
+        log = Mock(log_path='/log')
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_search(cmd='log_search', log_id='111', pattern='err', req_id=3)
+        search = self.wc._searches['111']
+        self.assertEqual(search.kwargs['path'], '/log')
+        search.put_request.assert_called_once_with()
+        self.assertIn(search, self.wc._sock_read_fd)
+        search.check_response.return_value = True
+        search.get_result.return_value = [{'line':1}]
+        self.wc.handle_read(search)
+        put_ans.assert_called_with({'cmd':'log_search', 'res':'ok', 'log_id':'111',
+                                    'hits':[{'line':1}], 'done':False}, 3)
+        self.wc._log_search(cmd='log_search', log_id='111', pattern='warn')
+        search.close.assert_called_once_with()
+        self.assertNotIn(search, self.wc._sock_read_fd)
+        search = self.wc._searches['111']
+        search.done = True
+        search.get_result.return_value = []
+        self.wc.handle_read(search)
+        self.assertTrue(put_ans.call_args[0][0]['done'])
+        self.assertEqual(self.wc._searches, {})
+        self.assertEqual(self.wc._sock_read_fd, [self.sock])
+
+    @patch.object(web_client, 'FOLLOW_CLIENT_LINES', 5)
+    @patch.object(web_client, 'FOLLOW_OUT_LIMIT', 10)
+    @patch('web_client.PlugFollow')
+    def test_log_follow(self, m_follow):
+        """appended lines are pushed, kept lines are limited while client is slow"""
+        follow = m_follow.return_value
+        follow.req_id = None
+        self.wc._sessions['aaa'] = [Mock(), time.time()]
+        log = Mock(log_path='/log')
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_follow(cmd='log_follow', log_id='111')
+        self.assertEqual(json.loads(str(self.wc._out_buff)), {'cmd':'log_follow', 'res':'ok', 'log_id':'111'})
+        self.assertIn(follow, self.wc._sock_read_fd)
+        # client has not taken the answer yet
+        follow.check_response.return_value = True
+        follow.is_closed.return_value = False
+        follow.batch_deadline.return_value = time.time()
+        follow.buffered.return_value = 8
+        self.wc.handle_read(follow)
+        follow.drop.assert_called_once_with(3)
+        self.assertFalse(follow.get_result.called)
+        # answers are sent, the batch goes out when it is retried
+        self.wc._out_buff = bytearray()
+        follow.get_result.return_value = ([u'x'], 3)
+        follow.batch_ready.return_value = True
+        self.wc._pool_expired()
+        self.assertEqual(self.wc._out_buff, bytearray())
+        with patch('time.time', return_value=time.time()+web_client.FOLLOW_BATCH_DELAY):
+            self.wc._pool_expired()
+        self.assertEqual(json.loads(str(self.wc._out_buff)),
+                         {'cmd':'log_follow', 'res':'ok', 'log_id':'111', 'lines':['x'], 'dropped':3})
+        self.wc._log_cmd(cmd='log_close', log_id='111')
+        follow.close.assert_called_once_with()
+        self.assertEqual(self.wc._follows, {})
+        self.assertEqual(len(self.wc._timers), 0)
+
+    @patch('web_client.PlugFollow')
+    def test_follow_closed(self, m_follow):
+        """follow is stopped when its channel is found closed by read event"""
+        follow = m_follow.return_value
+        follow.req_id = None
+        self.wc._sessions['aaa'] = [Mock(), time.time()]
+        self.wc._log_sessions['111'] = [Mock(log_path='/log'), self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_follow(cmd='log_follow', log_id='111')
+        self.wc._out_buff = bytearray()
+        follow.check_response.return_value = False
+        follow.is_closed.return_value = True
+        self.wc.handle_read(follow)
+        self.assertEqual(json.loads(str(self.wc._out_buff))['res'], 'error')
+        self.assertEqual(self.wc._follows, {})
+        self.assertNotIn(follow, self.wc._sock_read_fd)
+
+    def test_log_closed(self):
+        """log is disconnected when its channel is found closed by read event"""
+        log = self.log_for_trace()
+        log.check_response.return_value = False
+        log.is_closed.return_value = True
+        self.wc._sock_read_fd.append(log)
+        self.wc.handle_read(log)
+        self.assertEqual(self.wc._log_sessions, {})
+        self.assertNotIn(log, self.wc._sock_read_fd)
+        log.close.assert_called_once_with()
+
+    @patch('time.time')
+    def test_file_check(self, m_time):
+        """file of the log is checked while the log is used, the next check waits for the result"""
+        m_time.return_value = 100
+        log = Mock()
+        log.has_file_check.return_value = True
+        log.stat_file.return_value = (1, 2)
+        self.wc._sessions['aaa'] = [Mock(), 100]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._pool_expired()
+        self.assertEqual(self.wc.next_deadline(), None)
+        # the first use checks at once
+        self.wc._log_used('111')
+        self.wc._pool_expired()
+        log.file_checked.assert_called_once_with((1, 2), None)
+        self.assertEqual(self.wc.next_deadline(), 100 + web_client.PAGE_CACHE_CHECK_PERIOD)
+        # used meanwhile, checked again
+        self.wc._log_used('111')
+        m_time.return_value = 100 + web_client.PAGE_CACHE_CHECK_PERIOD
+        self.wc._pool_expired()
+        self.assertEqual(log.file_checked.call_count, 2)
+        # idle log is not checked and its timer stops
+        m_time.return_value = 100 + 2*web_client.PAGE_CACHE_CHECK_PERIOD
+        self.wc._pool_expired()
+        self.assertEqual(log.file_checked.call_count, 2)
+        self.assertEqual(self.wc.next_deadline(), None)
+        self.wc._log_used('111')
+        self.wc._disconnect_log('111')
+        self.assertEqual(self.wc.next_deadline(), None)
+        self.assertEqual(self.wc._used_logs, set())
+
+    def test_no_file_check(self):
+        """logs which keep nothing to be checked get no file check timer"""
+        log = Mock()
+        log.has_file_check.return_value = False
+        self.wc._sessions['aaa'] = [Mock(), 100]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_used('111')
+        self.assertEqual(self.wc.next_deadline(), None)
+
+    def test_log_response_failed(self):
+        """page which cannot be answered gives an error, queued requests go on"""
+        log = self.log_for_trace()
+        log.get_result.return_value = '\xc3'
+        self.wc.recv_from_client('{"cmd":"log_next","log_id":"111"}\r\n'
+                                 '{"cmd":"log_prev","log_id":"111"}\r\n')
+        self.wc.handle_read(log)
+        answer = json.loads(str(self.wc._out_buff))
+        self.assertEqual((answer['cmd'], answer['res']), ('log_next', 'error'))
+        self.assertEqual(self.wc._log_sessions['111'][1:3], [self.wc.PL_ACTIVE, 'log_prev'])
+
+    @patch.object(web_client.WebClient, '_log_response')
+    def test_log_line(self, log_response):
+        """log_line moves log to the offset found by the line index"""
+        log = Mock(BLOCKING=False, has_task=True, result_ready=False)
+        log.locate_line.return_value = 1234
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [log, self.wc.PL_IDLE, None, 'aaa']
+        self.wc._log_line(cmd='log_line', log_id='111', line=77)
+        log.locate_line.assert_called_once_with(77)
+        log.put_request.assert_called_once_with(web_client.PlugLess.LINE, 1234)
+        self.assertEqual(self.wc._log_sessions['111'][1:3], [self.wc.PL_ACTIVE, 'log_line'])
+        self.assertFalse(log_response.called)
+
+    @patch('uuid.uuid4')
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    @patch('web_client.SSH_POOL')
+    def test_connect_compress(self, pool, put_ans, m_uuid):
+        """compression is negotiated on connect and dropped on disconnect"""
+        m_uuid.return_value = 'abc-def'
+        self.wc._connect(cmd='connect', host='h', compress=['zstd', 'deflate'])
+        self.assertEqual(put_ans.call_args[0][0]['compress'], 'deflate')
+        self.assertIn('abc-def', self.wc._compressors)
+        m_uuid.return_value = 'abc-xyz'
+        self.wc._connect(cmd='connect', host='h', compress='zstd')
+        self.assertNotIn('compress', put_ans.call_args[0][0])
+        self.assertNotIn('abc-xyz', self.wc._compressors)
+        self.wc._disconnect('abc-def')
+        self.assertEqual(self.wc._compressors, {})
+
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    def test_log_response_compressed(self, put_mock):
+        """pages are deflated by one stream per session, short pages are not"""
+        import base64, zlib
+        plug = Mock(BLOCKING=False)
+        plug.position.return_value = None
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._compressors['aaa'] = web_client._PageCompressor()
+        self.wc._log_sessions['111'] = [plug, self.wc.PL_ACTIVE, 'log_next', 'aaa']
+        inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        pages = ['line %d\n'%i*10 for i in range(100)]
+        for page in (''.join(pages), ''.join(pages[50:])+'new\n'):
+            plug.get_result.return_value = page
+            self.wc._log_response('111')
+            res = put_mock.call_args[0][0]
+            self.assertEqual(res['encoding'], 'deflate')
+            self.assertEqual(inflate.decompress(base64.b64decode(res['data'])), page)
+        plug.get_result.return_value = 'short\n'
+        self.wc._log_response('111')
+        res = put_mock.call_args[0][0]
+        self.assertNotIn('encoding', res)
+        self.assertEqual(res['data'], 'short\n')
+        plug.get_result.return_value = pages[:60]
+        self.wc._log_response('111')
+        res = put_mock.call_args[0][0]
+        self.assertEqual([inflate.decompress(base64.b64decode(p)) for p in res['data']], pages[:60])
+
+    @patch.object(web_client.WebClient, '_put_answer_in_queue')
+    def test_log_response_delta(self, put_mock):
+        """log opened with delta gets differences from the page sent last"""
+        plug = Mock(BLOCKING=False)
+        plug.position.return_value = None
+        self.wc._sessions['aaa'] = [Mock(), 1]
+        self.wc._log_sessions['111'] = [plug, self.wc.PL_ACTIVE, 'log_open', 'aaa']
+        self.wc._sent_pages['111'] = None
+        page = ''.join('line %d\n'%i for i in range(20))
+        plug.get_result.return_value = page
+        self.wc._log_response('111')
+        self.assertEqual(put_mock.call_args[0][0]['data'], page)
+        plug.get_result.return_value = ''.join('line %d\n'%i for i in range(2, 22))
+        self.wc._log_response('111')
+        res = put_mock.call_args[0][0]
+        self.assertNotIn('data', res)
+        self.assertEqual(res['delta'], {'scroll':2, 'rows':[[18, ['line 20\n', 'line 21\n']]], 'count':20})
+        # totally new page is sent as is
+        plug.get_result.return_value = 'other\n'*20
+        self.wc._log_response('111')
+        self.assertEqual(put_mock.call_args[0][0]['data'], 'other\n'*20)
+        self.wc._disconnect_log('111')
+        self.assertEqual(self.wc._sent_pages, {})
 
+    @patch('web_client.SSH_POOL')
     @patch.object(web_client.WebClient, '_client_disconnect')
     @patch.object(web_client,'SESSION_TIMEOUT')
     @patch('time.time')
     @patch('select.select')
-    def test_run_session_expired(self, select_mock, time_mock, to_mock, cd_mock):
+    def test_run_session_expired(self, select_mock, time_mock, to_mock, cd_mock, pool):
         select_s = [[[],[],[]] for x in xrange(8)]
         select_s.append([[self.sock],[],[]])    # this will cause stop at 9th lap
         select_mock.side_effect = select_s
         self.sock.recv.return_value = ''
 
         web_client.SESSION_TIMEOUT = 30
-        time_mock.side_effect = [5*x for x in range(16)]   # timeput will expire (becomes > 30) at 4th lap
+        time_mock.side_effect = [5*x for x in range(32)]   # timeput will expire (becomes > 30) at 4th lap
         
         ssh_ch_mock = Mock()
         ssh_not_exp_mock = Mock()
         self.wc._sessions= {'666-xxx':(ssh_ch_mock, 0),
                             '777-yyy':(ssh_not_exp_mock, 999)}  # will not expire
+        self.wc._schedule_session('666-xxx')
+        self.wc._schedule_session('777-yyy')
 
         # cross fingers and hope it won't freeze
         self.wc.run()
@@ -210,7 +722,7 @@ class WebClientTest(unittest.TestCase):
         # normally this should be empty, but here we have overriden _client_disconnect
         self.assertEquals(self.wc._sessions, {'777-yyy':(ssh_not_exp_mock, 999)}) 
         
-        ssh_ch_mock.close.assert_called_with()
+        pool.release.assert_called_with(ssh_ch_mock)
         cd_mock.assert_called_with()
 
 if __name__=='__main__':
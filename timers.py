@@ -0,0 +1,74 @@
+""" Deadlines of keyed jobs kept by a binary heap.
+
+    Every key has at most one deadline, scheduling it again replaces the
+    previous one. Replaced and cancelled deadlines stay in the heap until
+    they come up and are skipped then, so schedule() costs O(log n) and
+    cancel() O(1) whatever the number of keys is.
+"""
+import heapq
+import itertools
+
+COMPACT_MIN_SIZE = 64   # heap is rebuilt when stale entries outnumber live ones by this
+
+
+class Timers(object):
+    def __init__(self):
+        self._heap = []             # (deadline, sequence number, key)
+        self._deadlines = {}        # key: current deadline of the key
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def deadline(self, key):
+        """ @return deadline of the key, None if there is none """
+        return self._deadlines.get(key)
+
+    def schedule(self, key, when):
+        """ Sets the deadline of the key
+            @param when - time.time() based deadline
+        """
+        if self._deadlines.get(key) == when:
+            return
+        self._deadlines[key] = when
+        heapq.heappush(self._heap, (when, next(self._seq), key))
+        if len(self._heap) > 2*len(self._deadlines) + COMPACT_MIN_SIZE:
+            self._compact()
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """ @return the earliest deadline, None if nothing is scheduled """
+        self._skip_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def timeout(self, now, limit):
+        """ @return seconds from now till the earliest deadline, at most limit """
+        deadline = self.next_deadline()
+        if deadline is None:
+            return limit
+        return min(limit, max(0, deadline - now))
+
+    def pop_due(self, now):
+        """ Removes keys whose deadlines have come
+            @return list of the keys, the earliest first
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, seq, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == when:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    def _skip_stale(self):
+        while self._heap and self._deadlines.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _compact(self):
+        self._heap = [(when, next(self._seq), key) for key, when in self._deadlines.iteritems()]
+        heapq.heapify(self._heap)
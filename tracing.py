@@ -0,0 +1,125 @@
+""" Traces of single client requests and sampled profiling of serving loops.
+
+    A trace is started when a request is parsed and is marked by spans as the
+    request goes through the server, e.g. 'parsed', 'dispatched', 'sent' (keys
+    are sent to 'less'), 'first_byte', 'anchor', 'serialized', 'written' (the
+    last byte of the answer is passed to the socket). Finished traces are kept
+    by a ring buffer of the client.
+"""
+import cProfile
+import pstats
+import threading
+import time
+import StringIO
+from collections import deque
+
+TRACE_BUFFER_SIZE = 256     # finished traces kept by every client
+PROFILE_RATE = 100          # every rate-th loop iteration is profiled
+
+
+class Trace(object):
+    __slots__ = ('cmd', 'req_id', 'start', 'spans')
+
+    def __init__(self, cmd=None, req_id=None):
+        self.cmd = cmd
+        self.req_id = req_id
+        self.start = time.time()
+        self.spans = []         # list of (name, timestamp)
+
+    def mark(self, name):
+        self.spans.append((name, time.time()))
+
+    def mark_once(self, name):
+        """ Marks the span unless it is marked already """
+        for span in self.spans:
+            if span[0] == name:
+                return
+        self.mark(name)
+
+    def as_dict(self):
+        """ @return trace with span times in ms from the start, ordered by time """
+        spans = [[name, (stamp-self.start)*1000] for name, stamp in sorted(self.spans, key=lambda s: s[1])]
+        return {'cmd': self.cmd, 'req_id': self.req_id, 'start': self.start,
+                'spans': spans, 'total': spans[-1][1] if spans else 0}
+
+
+class TraceBuffer(object):
+    """ Keeps the last size finished traces """
+    def __init__(self, size=TRACE_BUFFER_SIZE):
+        self._traces = deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._traces)
+
+    def add(self, trace):
+        self._traces.append(trace)
+
+    def clear(self):
+        self._traces.clear()
+
+    def dump(self):
+        """ @return list of traces as dicts, the oldest first """
+        return [trace.as_dict() for trace in list(self._traces)]
+
+
+class LoopProfiler(object):
+    """ Profiles every rate-th iteration of serving loops by cProfile.
+        Every thread gets its own profile, dump() sums them up.
+
+            if profiler.begin():
+                ...iteration...
+                profiler.end()
+    """
+    def __init__(self, rate=PROFILE_RATE):
+        self.rate = max(1, rate)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def _profile(self):
+        profile = getattr(self._local, 'profile', None)
+        if profile is None:
+            profile = self._local.profile = cProfile.Profile()
+            self._local.count = 0
+            with self._lock:
+                self._profiles.append(profile)
+        return profile
+
+    def begin(self):
+        """ @return True if the iteration is profiled, end() has to be called after it """
+        profile = self._profile()
+        self._local.count = self._local.count + 1
+        if self._local.count % self.rate:
+            return False
+        profile.enable()
+        return True
+
+    def end(self):
+        self._local.profile.disable()
+
+    def stats(self):
+        """ @return pstats.Stats of all profiled iterations, None if there are none """
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(profile, stream=StringIO.StringIO())
+                else:
+                    stats.add(profile)
+            except TypeError:   # the profile has no data yet
+                pass
+        return stats
+
+    def dump(self, path):
+        """ Writes the stats to path for pstats
+            @return text summary of the most expensive calls, None if nothing was profiled
+        """
+        stats = self.stats()
+        if stats is None:
+            return None
+        stats.dump_stats(path)
+        stats.stream = StringIO.StringIO()
+        stats.sort_stats('cumulative').print_stats(20)
+        return stats.stream.getvalue()
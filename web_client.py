@@ -1,62 +1,213 @@
+import base64
+import errno
+import fcntl
 import json
 import logging
+import os
 import threading
 import socket
 import select
+import signal
+import struct
 import uuid
 import time
-from plugs import PlugLess, PlugLs
-from ssh_channel import SSHChannel
+import weakref
+import zlib
+from collections import deque
+from plugs import PlugLess, PlugRange, PlugLs, PlugSearch, PlugFollow
+from plugs import PAGE_CACHE_CHECK_PERIOD, FOLLOW_BATCH_DELAY, PAGES_BATCH_LIMIT
+from page_delta import split_rows, page_delta
+from ssh_channel import SSH_POOL
+from metrics import METRICS
+from tracing import Trace, TraceBuffer
+from timers import Timers
 
 SESSION_TIMEOUT = 300
+SELECT_TIMEOUT = 5          # max seconds to wait for events, stop() is noticed within it
 BUFF_SIZE = 512
-OUT_BUFF_SIZE = 512 # TODO check maximum allowed chunk size for nonblocking write
+OUT_BUFF_SIZE = 64*1024     # max bytes passed to a single send()
+MAX_MSG_SIZE = 1024*1024    # longer requests are dropped
+FRAME_HEADER = struct.Struct('!II') # binary frame: payload length, request id; JSON payload follows
+LOG_QUEUE_SIZE = 16         # max requests waiting for a busy log
+FOLLOW_CLIENT_LINES = 10000 # max appended lines kept for all follows of a client
+FOLLOW_OUT_LIMIT = 1024*1024    # follow lines wait while more answer bytes than this are unsent
+LOG_MOVES = ('log_page', 'log_next', 'log_prev', 'log_pos', 'log_line')
+COMPRESS_MIN_SIZE = 512     # pages shorter than this are sent as is
+COMPRESSIONS = ('deflate',) # page compressions supported, in order of preference
+TRACING = False             # trace requests of new clients, see tracing.py
 logger = logging.getLogger('%s'%(__name__))
 logger.addHandler(logging.NullHandler())
 
+_CLIENTS = weakref.WeakSet()    # all WebClient instances, read by gauges
+_CLIENTS_LOCK = threading.Lock()
+
+def _clients():
+    with _CLIENTS_LOCK:
+        return list(_CLIENTS)
+
+COMMAND_LATENCY = METRICS.histogram('rtpager_command_seconds',
+                                    'Time from the start of a log request to its answer', ('cmd',))
+QUEUED_BYTES = METRICS.counter('rtpager_queued_bytes_total', 'Bytes of answers queued for clients')
+METRICS.gauge('rtpager_clients', 'Connected clients', lambda: len(_clients()))
+METRICS.gauge('rtpager_ssh_sessions', 'SSH sessions open by clients',
+              lambda: sum(len(c._sessions) for c in _clients()))
+METRICS.gauge('rtpager_logs', 'Logs open by clients',
+              lambda: sum(len(c._log_sessions) for c in _clients()))
+METRICS.gauge('rtpager_log_queue_depth', 'Requests waiting for busy logs',
+              lambda: sum(len(q) for c in _clients() for q in c._log_queues.values()))
+METRICS.gauge('rtpager_unsent_bytes', 'Bytes of answers queued but not sent yet',
+              lambda: sum(c._unsent_bytes() for c in _clients()))
+
+class _PageCompressor(object):
+    """ Raw deflate stream shared by all pages of a ssh session.
+        Every page is ended by sync flush, so it can be inflated as soon
+        as it is received, while the history of previous pages is kept
+        and helps to compress the next ones.
+        Pages have to be inflated in the order they were compressed.
+    """
+    def __init__(self):
+        self._deflate = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                         -zlib.MAX_WBITS)
+
+    def compress(self, text):
+        """ @return base64 of compressed text """
+        data = self._deflate.compress(text) + self._deflate.flush(zlib.Z_SYNC_FLUSH)
+        return base64.b64encode(data)
+
+
+class _PendingStream(object):
+    """ Placeholder of a search or follow channel which is being started """
+    pass
+
+
 class WebClient(threading.Thread):
     PL_ACTIVE = True
     PL_IDLE = False
     
-    def __init__(self, sock, addr):
+    def __init__(self, sock, addr, executor=None, profiler=None):
         """
             @param sock - client's socket object
             @param addr - client's addr, used by logger
+            @param executor - used to run blocking calls when the client is driven
+                              by event_loop.EventLoop instead of its own thread
+            @param profiler - tracing.LoopProfiler sampling iterations of run()
         """
         threading.Thread.__init__(self)
         self.name = '['+str(addr)+']: '
         self.sock = sock
-        self._buff = ''
-        self._out_buff = []
+        self.sock.setblocking(0)
+        self._executor = executor
+        self._profiler = profiler
+        self._buff = bytearray()        # received data of requests which are not complete yet
+        self._scanned = 0               # bytes of _buff known to have no '\r\n'
+        self._framed = False            # True if binary frames are used instead of JSON lines
+        self._out_buff = bytearray()    # answers queued for the client
+        self._out_pos = 0               # bytes of _out_buff which are sent already
         self._sock_write_fd = []
         self._sock_read_fd = [self.sock]
         self.running = True
         self._sessions = {}     # key: ssh connection uuid; value: list [ssh connection, last timestamp]
         self._log_sessions = {} # key: logfile uuid; value: list [plug instance, is_active, current_command, conn_id]
+        self._compressors = {}  # key: ssh connection uuid; value: _PageCompressor
+        self._sent_pages = {}   # key: uuid of log which takes deltas; value: rows of the page sent last
+        self._log_req_ids = {}  # key: logfile uuid; value: id of the request the log serves
+        self._log_queues = {}   # key: logfile uuid; value: deque of requests waiting for the log
+        self._searches = {}     # key: logfile uuid; value: PlugSearch (or _PendingStream) of the log
+        self._follows = {}      # key: logfile uuid; value: PlugFollow (or _PendingStream) of the log
+        self._log_started = {}  # key: logfile uuid; value: (command, time the log has started it)
+        self._queued_bytes = 0  # bytes of all answers queued for the client
+        self._tracing = TRACING
+        self._trace = None      # trace of the request being served, None if it is not traced
+        self._traces = TraceBuffer()    # finished traces
+        self._log_traces = {}   # key: logfile uuid; value: trace of the request the log serves
+        self._queued_traces = {}    # key: id() of request waiting in a log queue; value: its trace
+        self._out_traces = deque()  # (bytes queued when the answer is, trace) for unsent answers
+        self._timers = Timers() # deadlines keyed by (kind, uuid), kinds: 'session', 'file_check', 'follow'
+        self._used_logs = set() # uuids of logs used since their files were checked last
+        with _CLIENTS_LOCK:
+            _CLIENTS.add(self)
 
 
     def recv_from_client(self, data):
-        self._buff = self._buff + str(data)
-        if '\r\n' in self._buff:
-            raw_cmd, self._buff = self._buff.split('\r\n', 1)
-        else:
-            if  len(self._buff)>1024:
-                logger.warning(self.name+'Input buffer overrun, longer than 1024 bytes: %s'%self._buff)
-                self._buff = ''
-            return
+        """ Executes all complete requests the data brings.
+            Requests are JSON texts ended by '\\r\\n' or, once client has asked
+            for binary framing on connect, binary frames: FRAME_HEADER with
+            payload length and request id followed by JSON payload.
+            Answers to framed requests are framed with the same request id.
+        """
+        self._buff += data
+        pos = 0
+        while self.running:
+            if self._framed:
+                if len(self._buff) - pos < FRAME_HEADER.size:
+                    break
+                length, req_id = FRAME_HEADER.unpack_from(self._buff, pos)
+                if length > MAX_MSG_SIZE:
+                    logger.warning(self.name+'Frame is longer than %d bytes, dropping client'%MAX_MSG_SIZE)
+                    self._client_disconnect()
+                    return
+                end = pos + FRAME_HEADER.size + length
+                if end > len(self._buff):
+                    break
+                raw_cmd = str(self._buff[pos+FRAME_HEADER.size:end])
+            else:
+                # data scanned before is not searched again, '\r' may end it
+                end = self._buff.find('\r\n', max(pos, self._scanned))
+                if end < 0:
+                    self._scanned = max(pos, len(self._buff)-1)
+                    if len(self._buff) - pos > MAX_MSG_SIZE:
+                        logger.warning(self.name+'Input buffer overrun, longer than %d bytes'%MAX_MSG_SIZE)
+                        pos = len(self._buff)
+                    break
+                raw_cmd = str(self._buff[pos:end])
+                end = end + 2
+                req_id = None
+            pos = end
+            self._exec_request(raw_cmd, req_id)
+        del self._buff[:pos]
+        self._scanned = max(0, self._scanned - pos)
+
+    def _exec_request(self, raw_cmd, req_id=None):
+        """ @param req_id - id of framed request, None for JSON line """
+        trace = Trace(req_id=req_id) if self._tracing else None
         logger.debug(self.name+"some data has arrived: " + raw_cmd)
         try:
             req = json.loads(raw_cmd)
         except (ValueError, TypeError) as e:
             logger.warning(self.name+"Not a JSON! Ignoring...")
             return
+        if not isinstance(req, dict):
+            logger.warning(self.name+"Not a JSON object! Ignoring...")
+            return
+        if req_id is not None:
+            req['req_id'] = req_id
 
         if req.get('cmd', None) == None:
             logger.warning(self.name+"there is no 'cmd' field! Ignoring...")
             return
+        if not isinstance(req['cmd'], basestring):
+            logger.warning(self.name+"'cmd' is not a string: %r"%(req['cmd'],))
+            res = {'cmd':req['cmd'], 'res':'error', 'data':"'cmd' must be a string"}
+            self._put_answer_in_queue(res, req_id)
+            return
+
+        logger.info(self.name+"cmd = "+req['cmd'])
+        if trace is None:
+            self._dispatch(req)
+            return
+        trace.cmd = req['cmd']
+        trace.mark('parsed')
+        self._trace = trace
+        try:
+            self._dispatch(req)
+        finally:
+            trace.mark('dispatched')
+            if self._trace is trace:    # the request is not answered yet
+                self._record_trace(trace)
+            self._trace = None
 
+    def _dispatch(self, req):
         cmd = req['cmd']
-        logger.info(self.name+"cmd = "+cmd)
         conn_id = req.get('conn_id', None) 
         log_id = req.get('log_id', None)
         
@@ -64,6 +215,16 @@ class WebClient(threading.Thread):
             self._connect(**req)
             return
 
+        elif cmd == 'stats':
+            res = {'cmd':cmd, 'res':'ok',
+                   'data':{'process':METRICS.snapshot(), 'client':self.stats()}}
+            self._put_answer_in_queue(res, req.get('req_id'))
+            return
+
+        elif cmd == 'trace':
+            self._trace_cmd(**req)
+            return
+
         elif self._is_valid(conn_id=conn_id):
             if cmd == 'log_open':
                 self._log_open(**req)
@@ -75,71 +236,270 @@ class WebClient(threading.Thread):
                 self._disconnect(conn_id)
 
         elif self._is_valid(log_id=log_id):
-            if cmd in ['log_page', 'log_next', 'log_prev', 'log_pos', 'log_close']:
+            if cmd in ['log_page', 'log_next', 'log_prev', 'log_pos', 'log_pages', 'log_close']:
                 self._log_cmd(**req)
                 return
+            if cmd == 'log_line':
+                self._log_line(**req)
+                return
+            if cmd == 'log_search':
+                self._log_search(**req)
+                return
+            if cmd == 'log_follow':
+                self._log_follow(**req)
+                return
+            if cmd in ['log_search_cancel', 'log_unfollow']:
+                self._stop_stream(self._searches if cmd == 'log_search_cancel' else self._follows,
+                                  log_id)
+                res = {'cmd':cmd, 'res':'ok', 'log_id':log_id}
+                self._put_answer_in_queue(res, req.get('req_id'))
+                return
 
         logger.warning(self.name+"unable to excecute command: " + req['cmd'])
             
     def run(self):
         while self.running:
-            reads,w,x = select.select(self._sock_read_fd, self._sock_write_fd,
-                                      self._sock_read_fd ,0.5)
-            for read_obj in reads:
-                if read_obj==self.sock:
-                    data = self.sock.recv(BUFF_SIZE)
-                    if not data:
-                        logger.info(self.name+"Client disconnect")
-                        self._client_disconnect()
-                        return
-                    self.recv_from_client(data)            
-                else:
-                    if read_obj.check_response():
-                        log_id = read_obj.__log_id
-                        if self._log_sessions[log_id][1]:
-                            self._log_response(log_id)
-            if w:
-                self.send_to_client()
-
-            for ex_obj in x:
-                if ex_obj==self.sock:
-                    logger.error(self.name+ "Client's connection error")
-                    self._client_disconnect()
-                    return
-                else:
-                    logger.error(self.name+ "Log channel error, log_id=%s"%ex_obj.__log_id)
-                    self._disconnect_log(ex_obj.__log_id)
+            if self._profiler is not None and self._profiler.begin():
+                try:
+                    alive = self._run_once()
+                finally:
+                    self._profiler.end()
+            else:
+                alive = self._run_once()
+            if not alive:
+                return
+
+    def _run_once(self):
+        """ Waits for events of the client and processes them
+            @return False if client has gone
+        """
+        try:
+            reads,w,x = select.select(self._sock_read_fd, self._sock_write_fd, self._sock_read_fd,
+                                      self._timers.timeout(time.time(), SELECT_TIMEOUT))
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return True     # interrupted by a signal, e.g. SIGUSR1 dumping traces
+        for read_obj in reads:
+            if not self.handle_read(read_obj):
+                return False
+        if w:
+            self.send_to_client()
+
+        for ex_obj in x:
+            if not self.handle_error(ex_obj):
+                return False
+
+        self._pool_expired()
+        return True
+
+    def handle_read(self, read_obj):
+        """ Processes data available in client's socket or in log channel
+            @return False if client has gone
+        """
+        if read_obj==self.sock:
+            data = self.sock.recv(BUFF_SIZE)
+            if not data:
+                logger.info(self.name+"Client disconnect")
+                self._client_disconnect()
+                return False
+            self.recv_from_client(data)            
+        elif read_obj in self._searches.values():
+            self._search_response(read_obj)
+        elif read_obj in self._follows.values():
+            if read_obj.check_response():
+                self._follow_response(read_obj)
+            if read_obj.is_closed():
+                self._follow_closed(read_obj)
+            else:
+                self._schedule_follow(read_obj)
+        else:
+            trace = self._log_traces.get(read_obj.__log_id) if self._log_traces else None
+            if trace is not None:
+                trace.mark_once('first_byte')
+            if read_obj.check_response():
+                log_id = read_obj.__log_id
+                if self._log_sessions[log_id][1]:
+                    if trace is not None:
+                        trace.mark('anchor')
+                    self._log_response(log_id)
+                read_obj.prefetch()
+            # closed channel becomes readable, so it is found without polling
+            if read_obj.is_closed() and self._is_valid(log_id=read_obj.__log_id):
+                logger.warning(self.name+"Log channel has been unexpectedly closed, log_id=%s"
+                               %read_obj.__log_id)
+                self._disconnect_log(read_obj.__log_id)
+        return True
 
-            self._pool_expired()
+    def handle_error(self, ex_obj):
+        """ Processes error condition on client's socket or on log channel
+            @return False if client has gone
+        """
+        if ex_obj==self.sock:
+            logger.error(self.name+ "Client's connection error")
+            self._client_disconnect()
+            return False
+        elif ex_obj in self._searches.values():
+            logger.error(self.name+ "Search channel error, log_id=%s"%ex_obj.__log_id)
+            self._stop_stream(self._searches, ex_obj.__log_id)
+        elif ex_obj in self._follows.values():
+            logger.error(self.name+ "Follow channel error, log_id=%s"%ex_obj.__log_id)
+            self._follow_closed(ex_obj)
+        else:
+            logger.error(self.name+ "Log channel error, log_id=%s"%ex_obj.__log_id)
+            self._disconnect_log(ex_obj.__log_id)
+        return True
+
+    def _call_blocking(self, func, callback, *args):
+        """ Runs blocking func(*args) and passes (result, error) to callback.
+            The call goes to the executor if there is one, 
+            otherwise it is made in place.
+        """
+        trace = self._take_trace()
+        if trace is not None:
+            trace.mark('blocking')
+            callback = self._traced(trace, callback)
+        if self._executor:
+            self._executor.submit(self, func, args, callback)
+            return
+        try:
+            res = func(*args)
+        except Exception as e:
+            callback(None, e)
+        else:
+            callback(res, None)
+
+    def _take_trace(self):
+        """ @return trace of the request being served, it is not current any more """
+        trace, self._trace = self._trace, None
+        return trace
+
+    def _traced(self, trace, callback):
+        """ @return callback of blocking call which serves the traced request """
+        def traced(res, e):
+            trace.mark('unblocked')
+            self._with_trace(trace, callback, res, e)
+        return traced
+
+    def _with_trace(self, trace, func, *args, **kwargs):
+        """ Calls func(*args, **kwargs) with the trace as the current one, the trace
+            is finished if func has neither answered nor taken it
+        """
+        saved, self._trace = self._trace, trace
+        try:
+            func(*args, **kwargs)
+        finally:
+            if trace is not None and self._trace is trace:
+                self._record_trace(trace)
+            self._trace = saved
+
+    def _record_trace(self, trace):
+        self._traces.add(trace)
+
+    def _trace_cmd(self, **kwargs):
+        """ Answers with traces kept by the client.
+            'enable' turns tracing on or off, 'clear' drops the traces sent.
+        """
+        if 'enable' in kwargs:
+            self._tracing = bool(kwargs['enable'])
+            logger.info(self.name+'Tracing is %s'%('on' if self._tracing else 'off'))
+        res = {'cmd':kwargs['cmd'], 'res':'ok', 'tracing':self._tracing, 'data':self._traces.dump()}
+        if kwargs.get('clear'):
+            self._traces.clear()
+        self._put_answer_in_queue(res, kwargs.get('req_id'))
+
+    def dump_traces(self):
+        """ @return traces kept by the client, the oldest first """
+        return self._traces.dump()
+
+    def next_deadline(self):
+        """ @return time _pool_expired() has to be called at, None if nothing waits """
+        return self._timers.next_deadline()
 
     def _pool_expired(self):
-            expired = []
-            for log_id, (log, status, cmd, conn) in self._log_sessions.iteritems():
-                if log.channel.exit_status_ready():
-                    logger.warning(self.name+"Log channel has been unexpectedly closed,\
-                                                 log_id=%s"%log_id)
-                    expired.append(log_id)
-            for l in expired:
-                self._disconnect_log(l)
-
-            expired = []
-            for conn_id, (conn, prev_time) in self._sessions.iteritems(): 
-                if prev_time + SESSION_TIMEOUT < time.time():
-                    logger.warning(self.name+"SSH session has expired,\
-                                                 conn_id=%s"%conn_id)
-                    expired.append(conn_id)
-
-            for c in expired:
-                self._disconnect(c)
+        """ Runs the jobs whose deadlines have come """
+        now = time.time()
+        for kind, key in self._timers.pop_due(now):
+            if kind == 'session':
+                self._session_due(key, now)
+            elif kind == 'file_check':
+                self._file_check_due(key)
+            elif kind == 'follow':
+                self._follow_due(key)
+
+    def _schedule_session(self, conn_id):
+        """ Sets the deadline of SSH session by its last use.
+            Uses of the session do not move the deadline, it is checked when it comes.
+        """
+        self._timers.schedule(('session', conn_id), self._sessions[conn_id][1] + SESSION_TIMEOUT)
+
+    def _session_due(self, conn_id, now):
+        if not self._is_valid(conn_id=conn_id):
+            return
+        if self._sessions[conn_id][1] + SESSION_TIMEOUT > now:
+            self._schedule_session(conn_id)     # used since the deadline was set
+            return
+        logger.warning(self.name+"SSH session has expired, conn_id=%s"%conn_id)
+        self._disconnect(conn_id)
+
+    def _schedule_file_check(self, log_id):
+        self._timers.schedule(('file_check', log_id), time.time() + PAGE_CACHE_CHECK_PERIOD)
+
+    def _log_used(self, log_id):
+        """ Files of logs are checked for changes only while the logs are used,
+            the first use after an idle period starts the check at once
+        """
+        log = self._log_sessions[log_id][0]
+        if not log.has_file_check():
+            return
+        self._used_logs.add(log_id)
+        if ('file_check', log_id) not in self._timers:
+            self._timers.schedule(('file_check', log_id), time.time())
+
+    def _file_check_due(self, log_id):
+        if log_id not in self._used_logs or not self._is_valid(log_id=log_id):
+            return      # idle, the next use starts checks again
+        log = self._log_sessions[log_id][0]
+        if not log.start_file_check():  # checked recently or the check is running
+            self._schedule_file_check(log_id)
+            return
+        self._used_logs.discard(log_id)
+
+        def checked(file_id, e):
+            log.file_checked(file_id, e)
+            if self._is_valid(log_id=log_id):
+                self._schedule_file_check(log_id)
+
+        self._call_blocking(log.stat_file, checked)
+
+    def _schedule_follow(self, follow):
+        """ Sets the time lines kept by the follow are sent at """
+        key = ('follow', follow.__log_id)
+        deadline = follow.batch_deadline()
+        if deadline is None:
+            self._timers.cancel(key)
+            return
+        now = time.time()
+        if deadline <= now:     # batch is held back by slow client
+            deadline = now + FOLLOW_BATCH_DELAY
+        self._timers.schedule(key, deadline)
+
+    def _follow_due(self, log_id):
+        follow = self._follows.get(log_id)
+        if follow is None or isinstance(follow, _PendingStream):
+            return
+        if follow.batch_ready():
+            self._follow_response(follow)
+        self._schedule_follow(follow)
 
-            
-                    
     def stop(self):
         self.running = False
 
     def _client_disconnect(self):
         logger.info(self.name+'Terminating')
         self.running = False
+        with _CLIENTS_LOCK:
+            _CLIENTS.discard(self)
         self.sock.close()
         rm_list = self._sessions.keys()
         for rm_id in rm_list:
@@ -153,60 +513,128 @@ class WebClient(threading.Thread):
         conn = self._touch_conn(conn_id)
         kwargs['ssh'] = conn
 
-        try:
+        def list_dir():
             ls_exec = PlugLs(**kwargs)
-        except Exception as e:
-            logger.warning(self.name+'Unable to run ls: %s'%str(e))
-            res = {'cmd':kwargs['cmd'], 'res':'error', 'data':str(e)}
-        else:
             ls_exec.put_request(path)
             ls_exec.check_response()
-            (out, err) = ls_exec.get_result()
-            if err==[]:
-                ex_res = 'ok'
-                data = out
+            return ls_exec.get_result()
+
+        def listed(result, e):
+            if e:
+                logger.warning(self.name+'Unable to run ls: %s'%str(e))
+                res = {'cmd':kwargs['cmd'], 'res':'error', 'data':str(e)}
             else:
-                ex_res = 'err'
-                data = err
-            res = {'cmd':kwargs['cmd'], 'res':ex_res, 'data':data}
-        self._put_answer_in_queue(res)
+                (out, err) = result
+                if err==[]:
+                    ex_res = 'ok'
+                    data = out
+                else:
+                    ex_res = 'err'
+                    data = err
+                res = {'cmd':kwargs['cmd'], 'res':ex_res, 'data':data}
+            self._put_answer_in_queue(res, kwargs.get('req_id'))
+
+        self._call_blocking(list_dir, listed)
 
     def _connect(self, **kwargs):
+        if kwargs.get('framing') == 'binary' and not self._framed:
+            # everything after this request goes in binary frames
+            logger.info(self.name+'Switching to binary framing')
+            self._framed = True
         host = kwargs.get('host', None)
         
         port = kwargs.get('port', 22)
         user = kwargs.get('user', None)
         secret = kwargs.get('secret',None)
-        try:
-            ssh_conn = SSHChannel(host=host, port=port, user=user, secret=secret)
-            ssh_conn.connect()
-        except Exception as e:
-            logger.warning('Unable to start ssh session: %s'%str(e))
-            res = {'cmd':kwargs['cmd'], 'res':'error'}
-        else:
-            conn_id = str(uuid.uuid4())
-            self._sessions[conn_id] = [ssh_conn, time.time()]
-            logger.info(self.name+'New ssh session was registered, conn_id = %s' % conn_id)
-            res = {'cmd':kwargs['cmd'], 'res':'ok', 'conn_id':conn_id}
-        
-        self._put_answer_in_queue(res)
+
+        def open_conn():
+            return SSH_POOL.acquire(host=host, port=port, user=user, secret=secret)
+
+        def connected(ssh_conn, e):
+            if e:
+                logger.warning('Unable to start ssh session: %s'%str(e))
+                res = {'cmd':kwargs['cmd'], 'res':'error'}
+            elif not self.running:
+                SSH_POOL.release(ssh_conn)
+                return
+            else:
+                conn_id = str(uuid.uuid4())
+                self._sessions[conn_id] = [ssh_conn, time.time()]
+                self._schedule_session(conn_id)
+                logger.info(self.name+'New ssh session was registered, conn_id = %s' % conn_id)
+                res = {'cmd':kwargs['cmd'], 'res':'ok', 'conn_id':conn_id}
+                compress = self._choose_compression(kwargs.get('compress'))
+                if compress:
+                    self._compressors[conn_id] = _PageCompressor()
+                    res['compress'] = compress
+            self._put_answer_in_queue(res, kwargs.get('req_id'))
+
+        self._call_blocking(open_conn, connected)
+
+    def _choose_compression(self, offered):
+        """ @param offered - compression name or list of names client supports
+            @return compression to use for pages or None
+        """
+        if not offered:
+            return None
+        if not isinstance(offered, list):
+            offered = [offered]
+        for name in COMPRESSIONS:
+            if name in offered:
+                return name
+        return None
 
     def _log_open(self, **kwargs):
+        started = time.time()
         conn_id = kwargs['conn_id']
         conn = self._touch_conn(conn_id)
         kwargs['ssh'] = conn
-        log = PlugLess(**kwargs)
-        
-        log_id = str(uuid.uuid4())
-        log.__log_id = log_id
-        self._log_sessions[log_id] = [log, self.PL_ACTIVE, kwargs['cmd'], conn_id]
-        self._sock_read_fd.append(log)
-        logger.info(self.name+'New log was registered, log_id = %s' % log_id)
-        log.put_request(PlugLess.OPEN)
+        engine = {'less': PlugLess, 'range': PlugRange}.get(kwargs.get('engine', 'less'))
+        if engine is None:
+            res = {'cmd':kwargs['cmd'], 'res':'error', 'data':'Unknown engine'}
+            self._put_answer_in_queue(res, kwargs.get('req_id'))
+            return
+
+        def open_log():
+            log = engine(**kwargs)
+            if log.BLOCKING:
+                log.put_request(PlugLess.OPEN)
+            return log
+
+        def opened(log, e):
+            if e:
+                logger.warning(self.name+'Unable to open log: %s'%str(e))
+                res = {'cmd':kwargs['cmd'], 'res':'error', 'data':str(e)}
+                self._put_answer_in_queue(res, kwargs.get('req_id'))
+                return
+            if not self.running or not self._is_valid(conn_id=conn_id):
+                log.close()
+                return
+            log_id = str(uuid.uuid4())
+            log.__log_id = log_id
+            self._log_sessions[log_id] = [log, self.PL_ACTIVE, kwargs['cmd'], conn_id]
+            self._log_req_ids[log_id] = kwargs.get('req_id')
+            self._log_started[log_id] = (kwargs['cmd'], started)
+            self._set_log_trace(log_id)
+            if kwargs.get('delta'):
+                self._sent_pages[log_id] = None
+            logger.info(self.name+'New log was registered, log_id = %s' % log_id)
+            if log.BLOCKING:
+                self._log_response(log_id)
+            else:
+                self._sock_read_fd.append(log)
+                log.put_request(PlugLess.OPEN)
+            # line index is built by the first log_line, a full pass over
+            # a big file must not hold the open
+
+        self._call_blocking(open_log, opened)
         
     def _log_cmd(self, **kwargs):
         log_id = kwargs['log_id']
         cmd = kwargs['cmd']
+        if cmd != 'log_close' and self._log_sessions[log_id][1] == self.PL_ACTIVE:
+            self._queue_log_cmd(kwargs)
+            return
 
         log_cmd = None
         log_arg = None
@@ -214,27 +642,245 @@ class WebClient(threading.Thread):
             log_cmd = PlugLess.REDRAW
         elif cmd=='log_next':
             log_cmd = PlugLess.FWD
+            log_arg = kwargs.get('count')
         elif cmd=='log_prev':
             log_cmd = PlugLess.BACK
+            log_arg = kwargs.get('count')
         elif cmd=='log_pos':
             log_cmd = PlugLess.POS
             log_arg = kwargs.get('position', 0)
+        elif cmd=='log_pages':
+            log_cmd = PlugLess.PAGES
+            log_arg = kwargs.get('count', 1)
         elif cmd=='log_close':
             self._disconnect_log(log_id)
             res = {'cmd':cmd, 'res':'ok', 'log_id':log_id}
-            self._put_answer_in_queue(res)
+            self._put_answer_in_queue(res, kwargs.get('req_id'))
             return
         else:
             return
 
+        self._touch_log(log_id, self.PL_ACTIVE, cmd=cmd)
+        self._log_req_ids[log_id] = kwargs.get('req_id')
+        self._log_started[log_id] = (cmd, time.time())
+        self._set_log_trace(log_id)
+        self._log_used(log_id)
+        self._log_request(log_id, cmd, log_cmd, log_arg)
+
+    def _log_line(self, **kwargs):
+        """ Moves log to the line, the line offset is found by the line index """
+        log_id = kwargs['log_id']
+        cmd = kwargs['cmd']
+        if self._log_sessions[log_id][1] == self.PL_ACTIVE:
+            self._queue_log_cmd(kwargs)
+            return
         log = self._touch_log(log_id, self.PL_ACTIVE, cmd=cmd)
+        self._log_req_ids[log_id] = kwargs.get('req_id')
+        self._log_started[log_id] = (cmd, time.time())
+        self._set_log_trace(log_id)
+        self._log_used(log_id)
+
+        def located(offset, e):
+            if e:
+                logger.warning(self.name+'Unable to locate line: %s'%str(e))
+                self._log_requested(log_id, cmd, e)
+            elif self._is_valid(log_id=log_id):
+                self._log_request(log_id, cmd, PlugLess.LINE, offset)
+
+        self._call_blocking(log.locate_line, located, kwargs.get('line', 1))
+
+    def _queue_log_cmd(self, req):
+        """ Keeps request to a busy log until the log is idle.
+            Queued moves in the same direction are joined into a single move
+            by a number of pages up to PAGES_BATCH_LIMIT, moves followed by a jump and redraws followed
+            by anything are dropped as their pages would not be seen anyway.
+            Dropped requests are answered with 'skipped'.
+        """
+        log_id = req['log_id']
+        cmd = req['cmd']
+        queue = self._log_queues.setdefault(log_id, deque())
+        if cmd == 'log_page' and queue:
+            self._skip_log_cmd(req)     # a newer page is on the way anyway
+            return
+        while queue and (queue[-1]['cmd'] == 'log_page' or
+                         cmd in ('log_pos', 'log_line') and queue[-1]['cmd'] in LOG_MOVES):
+            self._skip_log_cmd(queue.pop())
+        if queue and cmd in ('log_next', 'log_prev') and queue[-1]['cmd'] == cmd:
+            prev_count, count = queue[-1].get('count', 1), req.get('count', 1)
+            if isinstance(prev_count, (int, long)) and isinstance(count, (int, long)) and \
+                    prev_count + count <= PAGES_BATCH_LIMIT:
+                self._skip_log_cmd(queue.pop())
+                req = dict(req, count=prev_count+count)
+        if len(queue) >= LOG_QUEUE_SIZE:
+            logger.warning(self.name+'Too many requests for log_id = %s'%log_id)
+            res = {'cmd':cmd, 'res':'error', 'log_id':log_id, 'data':'Too many requests'}
+            self._put_answer_in_queue(res, req.get('req_id'))
+            return
+        queue.append(req)
+        trace = self._take_trace()
+        if trace is not None:
+            trace.mark('queued')
+            self._queued_traces[id(req)] = trace
+
+    def _skip_log_cmd(self, req):
+        res = {'cmd':req['cmd'], 'res':'skipped', 'log_id':req['log_id']}
+        self._with_trace(self._queued_traces.pop(id(req), None),
+                         self._put_answer_in_queue, res, req.get('req_id'))
+
+    def _next_log_cmd(self, log_id):
+        """ Starts the request which waits for the log to be idle """
+        queue = self._log_queues.get(log_id)
+        if not queue or not self._is_valid(log_id=log_id) or \
+                self._log_sessions[log_id][1] == self.PL_ACTIVE:
+            return
+        req = queue.popleft()
+        trace = self._queued_traces.pop(id(req), None)
+        if trace is not None:
+            trace.mark('dequeued')
+        self._with_trace(trace, self._log_line if req['cmd'] == 'log_line' else self._log_cmd, **req)
+
+    def _log_search(self, **kwargs):
+        """ Starts search in the log, the previous search of the log is cancelled.
+            Matches are sent as they are found by a number of answers,
+            the last one has 'done' set.
+        """
+        self._start_stream(self._searches, PlugSearch, kwargs)
+
+    def _log_follow(self, **kwargs):
+        """ Starts sending lines appended to the log until log_unfollow """
+        log_id = kwargs['log_id']
+        if log_id in self._follows:
+            res = {'cmd':kwargs['cmd'], 'res':'ok', 'log_id':log_id}
+            self._put_answer_in_queue(res, kwargs.get('req_id'))
+            return
+        self._start_stream(self._follows, PlugFollow, kwargs, ack=True)
+
+    def _start_stream(self, streams, plug_class, kwargs, ack=False):
+        """ Starts plug which sends data of the log by its own channel.
+            The previous plug of the log in streams is stopped.
+            @param ack - answer the request as soon as the plug is started
+        """
+        log_id = kwargs['log_id']
+        self._stop_stream(streams, log_id)
+        log, state, cmd, conn_id = self._log_sessions[log_id]
+        kwargs['ssh'] = self._touch_conn(conn_id)
+        kwargs['path'] = log.log_path
+        token = _PendingStream()
+        streams[log_id] = token
+
+        def start():
+            stream = plug_class(**kwargs)
+            stream.put_request()
+            return stream
+
+        def started(stream, e):
+            if e:
+                logger.warning(self.name+'Unable to start %s: %s'%(kwargs['cmd'], str(e)))
+                if streams.get(log_id) is token:
+                    del streams[log_id]
+                res = {'cmd':kwargs['cmd'], 'res':'error', 'log_id':log_id, 'data':str(e)}
+                self._put_answer_in_queue(res, kwargs.get('req_id'))
+                return
+            if not self.running or streams.get(log_id) is not token:
+                stream.close()      # cancelled meanwhile
+                return
+            stream.__log_id = log_id
+            stream.req_id = kwargs.get('req_id')
+            streams[log_id] = stream
+            self._sock_read_fd.append(stream)
+            if ack:
+                res = {'cmd':kwargs['cmd'], 'res':'ok', 'log_id':log_id}
+                self._put_answer_in_queue(res, stream.req_id)
+
+        self._call_blocking(start, started)
+
+    def _search_response(self, search):
+        """ Sends matches found by the search """
+        log_id = search.__log_id
+        if not search.check_response():
+            return
+        res = {'cmd':'log_search', 'res':'ok', 'log_id':log_id,
+               'hits':search.get_result(), 'done':search.done}
+        if search.error:
+            res['res'] = 'error'
+            res['data'] = search.error
+        self._put_answer_in_queue(res, search.req_id)
+        if search.done:
+            self._stop_stream(self._searches, log_id)
+
+    def _follow_response(self, follow):
+        """ Sends lines appended to the log unless the client is slow to take
+            answers. Lines of all follows of the client are limited by
+            FOLLOW_CLIENT_LINES, the oldest ones are dropped.
+        """
+        if len(self._out_buff) - self._out_pos > FOLLOW_OUT_LIMIT:
+            kept = sum(f.buffered() for f in self._follows.values()
+                       if not isinstance(f, _PendingStream))
+            if kept > FOLLOW_CLIENT_LINES:
+                follow.drop(kept - FOLLOW_CLIENT_LINES)
+            return
+        lines, dropped = follow.get_result()
+        res = {'cmd':'log_follow', 'res':'ok', 'log_id':follow.__log_id, 'lines':lines}
+        if dropped:
+            res['dropped'] = dropped
+        self._put_answer_in_queue(res, follow.req_id)
+
+    def _follow_closed(self, follow):
+        log_id = follow.__log_id
+        logger.warning(self.name+"Follow channel has been closed, log_id=%s"%log_id)
+        self._stop_stream(self._follows, log_id)
+        res = {'cmd':'log_follow', 'res':'error', 'log_id':log_id, 'data':'Follow has stopped'}
+        self._put_answer_in_queue(res, follow.req_id)
+
+    def _stop_stream(self, streams, log_id):
+        """ Stops search or follow of the log if there is any """
+        stream = streams.pop(log_id, None)
+        if streams is self._follows:
+            self._timers.cancel(('follow', log_id))
+        if stream is None or isinstance(stream, _PendingStream):
+            return
+        logger.info(self.name+'Stream is over, log_id = %s'%log_id)
+        if stream in self._sock_read_fd:
+            self._sock_read_fd.remove(stream)
         try:
-            if log_cmd:
-                log.put_request(log_cmd, log_arg)
+            stream.close()
         except:
+            pass
+
+    def _log_request(self, log_id, cmd, log_cmd, log_arg=None):
+        log = self._log_sessions[log_id][0]
+        if log.BLOCKING:
+            self._call_blocking(log.put_request,
+                                lambda res, e: self._log_requested(log_id, cmd, e),
+                                log_cmd, log_arg)
+            return
+        try:
+            log.put_request(log_cmd, log_arg)
+        except Exception as e:
+            self._log_requested(log_id, cmd, e)
+        else:
+            self._log_requested(log_id, cmd)
+
+    def _log_requested(self, log_id, cmd, error=None):
+        """ Answers the client if the page is ready right after the request """
+        if not self._is_valid(log_id=log_id):
+            return      # log was closed meanwhile
+        log = self._log_sessions[log_id][0]
+        if error:
             self._touch_log(log_id) # reset state
             res = {'cmd': cmd, 'res':'error', 'log_id':log_id}
-            self._put_answer_in_queue(res)
+            self._with_trace(self._log_traces.pop(log_id, None),
+                             self._put_answer_in_queue, res, self._log_req_ids.get(log_id))
+            self._command_done(log_id)
+            self._next_log_cmd(log_id)
+        else:
+            trace = self._log_traces.get(log_id)
+            if trace is not None:
+                trace.mark('sent')
+            # page was taken from cache (maybe while prefetch is running) or read by blocking call
+            if not log.has_task or log.result_ready:
+                self._log_response(log_id)
+                log.prefetch()
 
 
     def _touch_log(self, log_id, state=PL_IDLE, cmd=None):
@@ -274,8 +920,10 @@ class WebClient(threading.Thread):
         for l in logs_to_close:
             self._disconnect_log(l)
 
-        self._sessions[conn_id][0].close()
+        SSH_POOL.release(self._sessions[conn_id][0])
         del self._sessions[conn_id]    
+        self._timers.cancel(('session', conn_id))
+        self._compressors.pop(conn_id, None)
         logger.info(self.name+"conn_id = %s is no longer available"%conn_id) 
 
     def _disconnect_log(self, log_id):
@@ -289,36 +937,211 @@ class WebClient(threading.Thread):
         if log in self._sock_read_fd:
             self._sock_read_fd.remove(log)
         del self._log_sessions[log_id]
+        self._timers.cancel(('file_check', log_id))
+        self._used_logs.discard(log_id)
+        self._sent_pages.pop(log_id, None)
+        self._log_req_ids.pop(log_id, None)
+        for req in self._log_queues.pop(log_id, ()):
+            trace = self._queued_traces.pop(id(req), None)
+            if trace is not None:
+                self._record_trace(trace)
+        self._log_started.pop(log_id, None)
+        trace = self._log_traces.pop(log_id, None)
+        if trace is not None:
+            trace.mark('closed')
+            self._record_trace(trace)
+        self._stop_stream(self._searches, log_id)
+        self._stop_stream(self._follows, log_id)
 
     def _log_response(self, log_id):
-        log_data = self._log_sessions[log_id][0].get_result()
-        logger.info(self.name + 'Log is ready, log_id = %s'%log_id)
-        res = {'cmd': self._log_sessions[log_id][2], 'res':'ok', 'log_id':log_id, 'data':log_data}
-         
-        self._put_answer_in_queue(res)
+        """ Answers the request the log serves, the log goes on with queued requests
+            even if the answer cannot be made
+        """
+        log = self._log_sessions[log_id][0]
+        cmd = self._log_sessions[log_id][2]
+        try:
+            log_data = log.get_result()
+            logger.info(self.name + 'Log is ready, log_id = %s'%log_id)
+            res = {'cmd': cmd, 'res':'ok', 'log_id':log_id, 'data':log_data}
+            position = log.position()
+            if position:
+                res['line'], res['lines'] = position
+            if log_id in self._sent_pages:
+                self._put_delta(res, log_id)
+            self._compress_pages(res, self._log_sessions[log_id][3])
+             
+            self._with_trace(self._log_traces.pop(log_id, None),
+                             self._put_answer_in_queue, res, self._log_req_ids.get(log_id))
+        except Exception as e:
+            logger.exception(self.name+'Unable to answer, log_id = %s'%log_id)
+            if log_id in self._sent_pages:
+                self._sent_pages[log_id] = None     # the next page goes as is
+            res = {'cmd': cmd, 'res':'error', 'log_id':log_id, 'data':str(e)}
+            self._put_answer_in_queue(res, self._log_req_ids.get(log_id))
         self._touch_log(log_id)
+        self._command_done(log_id)
+        self._next_log_cmd(log_id)
+
+    def _set_log_trace(self, log_id):
+        """ The current trace goes on with the request the log serves """
+        trace = self._take_trace()
+        if trace is not None:
+            self._log_traces[log_id] = trace
+
+    def _command_done(self, log_id):
+        """ Records time the log has taken to answer the request """
+        started = self._log_started.pop(log_id, None)
+        if started:
+            COMMAND_LATENCY.observe(time.time()-started[1], cmd=started[0])
     
-    def _put_answer_in_queue(self, data):
+    def _put_delta(self, res, log_id):
+        """ Replaces page text of the answer by the difference from the page
+            sent last, if the difference is much shorter than the page:
+            'delta': {'scroll': k, 'rows': [[i, [row, ...]], ...], 'count': n}
+            means that the new page has n rows, row i is the old row i+k
+            unless it is replaced by one of runs of rows.
+        """
+        data = res['data']
+        if not isinstance(data, str):
+            # a number of pages, client keeps no page to apply delta to
+            self._sent_pages[log_id] = None
+            return
+        rows = split_rows(data)
+        old, self._sent_pages[log_id] = self._sent_pages[log_id], rows
+        if old is None:
+            return
+        scroll, runs = page_delta(old, rows)
+        if sum(len(row) for first, texts in runs for row in texts)*2 > len(data):
+            return
+        del res['data']
+        res['delta'] = {'scroll':scroll, 'rows':runs, 'count':len(rows)}
+
+    def _compress_pages(self, res, conn_id):
+        """ Compresses page text (or list of pages) of the answer
+            if the session has negotiated compression
+        """
+        compressor = self._compressors.get(conn_id)
+        if compressor is None or 'data' not in res:
+            return
+        data = res['data']
+        if isinstance(data, list):
+            if sum(len(page) for page in data) < COMPRESS_MIN_SIZE:
+                return
+            res['data'] = [compressor.compress(page) for page in data]
+        else:
+            if not isinstance(data, str) or len(data) < COMPRESS_MIN_SIZE:
+                return
+            res['data'] = compressor.compress(data)
+        res['encoding'] = 'deflate'
+
+    def _put_answer_in_queue(self, data, req_id=None):
         ''' Puts data into output (client's) queue
             @param data: dict with data
+            @param req_id: id of the request answered, used by binary framing
         '''
         logger.info('Going to put answer data in queue')
-        enc = json.dumps(data)+'\r\n'
-        enc_len = len(enc)
-        for pos in range(0, enc_len, OUT_BUFF_SIZE):
-            self._out_buff.append(enc[pos:pos+OUT_BUFF_SIZE])
+        text = json.dumps(data)
+        trace = self._take_trace()
+        if trace is not None:
+            trace.mark('serialized')
+        size = len(self._out_buff)
+        if self._framed:
+            self._out_buff += FRAME_HEADER.pack(len(text), req_id or 0)
+            self._out_buff += text
+        else:
+            self._out_buff += text+'\r\n'
+        size = len(self._out_buff) - size
+        self._queued_bytes = self._queued_bytes + size
+        QUEUED_BYTES.inc(size)
+        if trace is not None:
+            self._out_traces.append((self._queued_bytes, trace))
         self._sock_write_fd = [self.sock]
 
+    def _unsent_bytes(self):
+        return len(self._out_buff) - self._out_pos
+
+    def _traces_written(self):
+        """ Finishes traces of answers which are sent completely """
+        sent = self._queued_bytes - self._unsent_bytes()
+        while self._out_traces and self._out_traces[0][0] <= sent:
+            trace = self._out_traces.popleft()[1]
+            trace.mark('written')
+            self._record_trace(trace)
+
+    def stats(self):
+        """ @return counters of the client and of its logs, JSON serializable """
+        logs = {}
+        for log_id, (log, status, cmd, conn_id) in self._log_sessions.items():
+            logs[log_id] = {'conn_id':conn_id, 'active':status == self.PL_ACTIVE, 'cmd':cmd,
+                            'received':log.received,
+                            'queue':len(self._log_queues.get(log_id, ()))}
+        return {'sessions':len(self._sessions), 'logs':logs,
+                'queued_bytes':self._queued_bytes, 'unsent_bytes':self._unsent_bytes()}
+
     def send_to_client(self):
-        if self._out_buff:
-            data = self._out_buff.pop(0)
-            self.sock.send(data)
-        else:
+        """ Sends as much of queued answers as the socket accepts """
+        view = memoryview(self._out_buff)
+        try:
+            while self._out_pos < len(view):
+                sent = self.sock.send(view[self._out_pos:self._out_pos+OUT_BUFF_SIZE])
+                if not sent:
+                    break
+                self._out_pos = self._out_pos + sent
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logger.warning(self.name+'Unable to send answer: %s'%str(e))
+                self._client_disconnect()
+                return
+        del view
+        if self._out_traces:
+            self._traces_written()
+
+        # buffer is replaced rather than resized, slices of it may still be exported
+        if self._out_pos >= len(self._out_buff):
+            self._out_buff = bytearray()
+            self._out_pos = 0
             self._sock_write_fd = []
+        elif self._out_pos > OUT_BUFF_SIZE:
+            # drop the sent part, the rest is kept for the next writable event
+            self._out_buff = self._out_buff[self._out_pos:]
+            self._out_pos = 0
     
 
+def dump_traces(profiler=None, profile_path=None):
+    """ Writes traces kept by all clients to the log,
+        and the profile of serving loops to profile_path
+    """
+    for client in _clients():
+        for trace in client.dump_traces():
+            logger.info(client.name+'trace: '+json.dumps(trace))
+    if profiler is not None:
+        summary = profiler.dump(profile_path)
+        if summary:
+            logger.info('Profile is written to %s\n%s'%(profile_path, summary))
+
+
 def main():
+    import argparse
     import logging.config
+    from event_loop import EventLoop, EXECUTOR_WORKERS
+    from metrics import MetricsServer
+    from tracing import LoopProfiler, PROFILE_RATE
+
+    parser = argparse.ArgumentParser(description='rt-pager server')
+    parser.add_argument('--threaded', action='store_true',
+                        help='serve every client by its own thread')
+    parser.add_argument('--workers', type=int, default=EXECUTOR_WORKERS,
+                        help='threads used for blocking ssh calls by the event loop')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics in Prometheus format on 127.0.0.1:PORT/metrics')
+    parser.add_argument('--trace', action='store_true',
+                        help='trace requests of all clients, SIGUSR1 writes the traces to the log')
+    parser.add_argument('--profile', type=int, nargs='?', const=PROFILE_RATE, metavar='RATE',
+                        help='profile every RATE-th iteration of serving loops')
+    parser.add_argument('--profile-out', default='rt-pager.prof',
+                        help='file SIGUSR1 and exit write the profile to')
+    args = parser.parse_args()
+
     logging.config.fileConfig('log.conf')
     global logger
     # create logger
@@ -334,18 +1157,68 @@ def main():
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     s.bind((host,port))
     s.listen(backlog)
+
+    if args.metrics_port:
+        print 'metrics on http://%s:%s/metrics'%(host, args.metrics_port)
+        MetricsServer(host, args.metrics_port).start()
+
+    global TRACING
+    TRACING = args.trace
+    profiler = LoopProfiler(args.profile) if args.profile else None
+
+    # SIGUSR1 handler only asks the serving loop to dump traces: the dump takes
+    # _CLIENTS_LOCK which the interrupted thread may hold
+    if not args.threaded:
+        loop = EventLoop(s, WebClient, workers=args.workers, profiler=profiler)
+        signal.signal(signal.SIGUSR1, lambda signum, frame:
+                          loop.call_soon(dump_traces, profiler, args.profile_out))
+        try:
+            loop.run()
+        except KeyboardInterrupt:
+            pass
+        loop.close()
+        dump_traces(profiler, args.profile_out)
+        return
+
+    dump_r, dump_w = os.pipe()
+    fcntl.fcntl(dump_w, fcntl.F_SETFL, fcntl.fcntl(dump_w, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def request_dump(signum, frame):
+        try:
+            os.write(dump_w, 'x')
+        except OSError:
+            pass        # pipe is full, the dump is requested already
+
+    signal.signal(signal.SIGUSR1, request_dump)
     conn_list = []
     while 1:
         try:
+            try:
+                reads = select.select([s, dump_r], [], [])[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue    # SIGUSR1, the pipe wakes the next select
+                raise
+            if dump_r in reads:
+                os.read(dump_r, 4096)
+                dump_traces(profiler, args.profile_out)
+            if s not in reads:
+                continue
             client, address = s.accept()     
-            wc = WebClient(client, address)
+            wc = WebClient(client, address, profiler=profiler)
             wc.start()
             conn_list.append(wc)
+        except socket.error as e:
+            if e.errno == errno.EINTR:
+                continue
+            [t.stop() for t in conn_list]
+            break
         except:
             [t.stop() for t in conn_list]
             break
 
     [t.join() for t in conn_list]
+    dump_traces(profiler, args.profile_out)
 
 if __name__=="__main__":
     main()